@@ -0,0 +1,88 @@
+"""Durable cache of generated AI text in the ai_content_cache table.
+
+Entries are content-addressed: the key is a SHA-256 of the model name, the
+system instruction and the prompt built from the patient context, so any
+change to the record, prompt or model misses the cache. The triggers in
+migrations/004_ai_content_cache.sql also delete a patient's entries when
+their rows change. Entries expire after AI_CACHE_MAX_AGE_HOURS and the table
+is trimmed to AI_CACHE_MAX_ENTRIES, least recently used first.
+"""
+import hashlib
+import logging
+import os
+import threading
+from data import execute_query
+
+logger = logging.getLogger(__name__)
+
+MAX_AGE_HOURS = float(os.getenv("AI_CACHE_MAX_AGE_HOURS", 24 * 7))
+MAX_ENTRIES = int(os.getenv("AI_CACHE_MAX_ENTRIES", 50000))
+PRUNE_EVERY = 100
+
+_stores = 0
+_stores_lock = threading.Lock()
+
+
+def content_key(model_name, instruction, context):
+    digest = hashlib.sha256()
+    for part in (model_name, instruction, context):
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def get_cached_content(cache_key):
+    """Returns the cached text for ``cache_key``, or None. Cache errors count as misses."""
+    try:
+        rows = execute_query("""
+            UPDATE ai_content_cache SET last_used_at = now()
+            WHERE cache_key = %s AND created_at > now() - make_interval(secs => %s)
+            RETURNING content
+        """, (cache_key, MAX_AGE_HOURS * 3600))
+    except Exception as e:
+        logger.warning(f"AI cache lookup failed: {e}")
+        return None
+    return rows[0]['content'] if rows else None
+
+
+def has_content(cache_key):
+    """True if an unexpired entry exists for ``cache_key``; does not count as a use."""
+    rows = execute_query("""
+        SELECT 1 FROM ai_content_cache
+        WHERE cache_key = %s AND created_at > now() - make_interval(secs => %s)
+    """, (cache_key, MAX_AGE_HOURS * 3600))
+    return bool(rows)
+
+
+def store_content(cache_key, patient_id, kind, model_name, content):
+    global _stores
+    try:
+        execute_query("""
+            INSERT INTO ai_content_cache (cache_key, patient_id, kind, model, content)
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (cache_key) DO UPDATE SET content = EXCLUDED.content,
+                created_at = now(), last_used_at = now()
+        """, (cache_key, str(patient_id), kind, model_name, content))
+    except Exception as e:
+        logger.warning(f"AI cache store failed: {e}")
+        return
+    with _stores_lock:
+        _stores += 1
+        prune = _stores % PRUNE_EVERY == 0
+    if prune:
+        prune_cache()
+
+
+def prune_cache():
+    """Deletes expired entries and trims the table to MAX_ENTRIES."""
+    try:
+        execute_query("DELETE FROM ai_content_cache WHERE created_at <= now() - make_interval(secs => %s)",
+                      (MAX_AGE_HOURS * 3600,), name='prune_ai_cache_expired')
+        execute_query("""
+            DELETE FROM ai_content_cache WHERE cache_key IN (
+                SELECT cache_key FROM ai_content_cache ORDER BY last_used_at DESC OFFSET %s
+            )
+        """, (MAX_ENTRIES,), name='prune_ai_cache_overflow')
+    except Exception as e:
+        logger.warning(f"AI cache prune failed: {e}")
+
@@ -1,51 +1,165 @@
-from flask import Flask, render_template, jsonify, request, redirect, url_for, session, flash
-from data import get_patient_list, get_patient_details, get_patient_filters, delete_patient, execute_query
-from predictor import process_uploaded_data, get_conditional_risk_analysis
-from interven import initialize_chat, get_ai_response, get_ai_summary, generate_intervention_text, generate_intervention_pdf_from_text, send_intervention_email
+from logs import configure_logging
+configure_logging()  # before the imports below, which log while loading models and clients
+
+from flask import Flask, Response, render_template, jsonify, request, redirect, url_for, session, flash, stream_with_context
+from data import get_patient_list, get_patient_details, get_patient_filters, delete_patient, execute_query, iter_patient_export, get_pool_stats, get_cache_stats, apply_migrations, get_dashboard_data
+from predictor import predictor, inference_scheduler, process_uploaded_data, get_conditional_risk_analysis, get_cohort_condition_impact
+from model_registry import list_versions, active_version, set_active_version
+from ingest import ingest_upload, DEFAULT_CHUNK_SIZE
+from jobs import JobAlreadyRunning, get_run, get_latest_run
+from rescore import DEFAULT_CHUNK_SIZE as DEFAULT_RESCORE_CHUNK_SIZE, DEFAULT_WORKERS as DEFAULT_RESCORE_WORKERS, run_rescore
+from pregenerate import JOB_NAME as SUMMARY_JOB, DEFAULT_CONCURRENCY, DEFAULT_REQUESTS_PER_MINUTE, run_summary_job, start_summary_job
+from outbox import get_email, run_sender, start_sender, OUTBOX_SENDER_AUTOSTART
+import campaign
+from patient_context import CONTEXT_TOKEN_BUDGET, context_token_report, get_context_stats
+from interven import ChatSessionManager, get_ai_response, stream_ai_response, get_ai_summary, generate_intervention_text, stream_intervention_text, generate_intervention_pdf_from_text, intervention_pdf_filename, queue_intervention_email
+import click
+import csv
+import datetime
+import decimal
+import io
+import itertools
 import json
+import logging
 import os
 import socket # Import the socket library to catch specific network errors
 import hashlib
 import secrets
+import threading
+import metrics
+
+logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
-app.secret_key = secrets.token_hex(16)
+metrics.init_app(app)
+# A fixed key keeps sessions valid across workers and restarts
+app.secret_key = os.getenv("FLASK_SECRET_KEY") or secrets.token_hex(16)
 # This app is designed for demonstration and educational purposes.
 # For a production environment, consider more robust session management.
-chat_sessions = {}
+chat_sessions = ChatSessionManager()
+
+def start_background_threads():
+    """Starts this serving process's model version watcher and email senders; later calls do nothing.
+
+    Called from the servers' startup hooks (gunicorn.conf.py, asgi.py) and on
+    each request for any other server. Importing the app starts nothing, so
+    CLI commands and process-pool children never own a thread.
+    """
+    predictor.watch_active_version()
+    if OUTBOX_SENDER_AUTOSTART:
+        start_sender()
+
+@app.before_request
+def ensure_background_threads():
+    start_background_threads()
+
+def chat_user_key(session_data=None):
+    """Identifies the browser session for chat history: the logged-in user, else an anonymous id.
+
+    Uses the Flask session unless another session mapping is given.
+    """
+    session_data = session if session_data is None else session_data
+    if 'userid' in session_data:
+        return f"user:{session_data['userid']}"
+    if 'chat_id' not in session_data:
+        session_data['chat_id'] = secrets.token_hex(16)
+    return f"anon:{session_data['chat_id']}"
 
 # User authentication functions
 def hash_password(password):
     """Hash a password using SHA-256"""
     return hashlib.sha256(password.encode()).hexdigest()
 
+# Login table per role; the stored passwords are compared as entered
+LOGIN_TABLES = {'user': 'patient_login', 'admin': 'admin_login'}
+
 def verify_user(username, password,role):
     """Verify user credentials against the database"""
-
-    if role== "user":
-        try:
-            hashed_password = hash_password(password)
-            query = f"SELECT patient_login.id,patient_login.username FROM patient_login WHERE username = \'{username}\' AND password = \'{password}\' "
-            print(query)
-            result = execute_query(query, [username, hashed_password])
-            print(result[0])
-            return result[0] if result else None
-        except Exception as e:
-            print(f"Error verifying user: {e}")
-            return None
-    elif role =="admin":
-        try:
-            hashed_password = hash_password(password)
-            query = f"SELECT admin_login.id , admin_login.username FROM admin_login WHERE username = \'{username}\' AND password = \'{password}\' "
-            print(query)
-            result = execute_query(query, [username, hashed_password])
-            print(result[0])
-            return result[0] if result else None
-        except Exception as e:
-            print(f"Error verifying user: {e}")
-            return None
-
-
+    table = LOGIN_TABLES.get(role)
+    if table is None:
+        return None
+    try:
+        result = execute_query(
+            f"SELECT id, username FROM {table} WHERE username = %s AND password = %s",
+            (username, password), name=f'verify_{role}'
+        )
+        return result[0] if result else None
+    except Exception:
+        logger.exception("Error verifying user", extra={'role': role})
+        return None
+
+@app.cli.command('migrate')
+def migrate_command():
+    """Apply pending database migrations from the migrations/ directory."""
+    applied = apply_migrations()
+    click.echo(f"Applied {len(applied)} migration(s)" if applied else "Database schema is up to date")
+
+@app.cli.command('pregenerate-summaries')
+@click.option('--tiers', default='5,4', help='Comma-separated risk tiers to cover, highest first.')
+@click.option('--concurrency', default=DEFAULT_CONCURRENCY, help='Parallel Gemini requests.')
+@click.option('--rpm', default=DEFAULT_REQUESTS_PER_MINUTE, help='Maximum Gemini requests per minute (0 = unlimited).')
+@click.option('--restart', is_flag=True, help='Start over instead of resuming an unfinished run.')
+def pregenerate_summaries_command(tiers, concurrency, rpm, restart):
+    """Generate and cache AI summaries for high-risk patients."""
+    tier_list = [int(tier) for tier in tiers.split(',') if tier.strip()]
+    run = run_summary_job(tiers=tier_list, concurrency=concurrency, requests_per_minute=rpm, resume=not restart)
+    click.echo(f"Run {run['id']} {run['status']}: {run['progress']}")
+
+@app.cli.command('rescore')
+@click.option('--chunk-size', default=DEFAULT_RESCORE_CHUNK_SIZE, help='Rows read and scored per chunk.')
+@click.option('--workers', default=DEFAULT_RESCORE_WORKERS, help='Scoring processes.')
+@click.option('--restart', is_flag=True, help='Start over instead of resuming an unfinished run.')
+def rescore_command(chunk_size, workers, restart):
+    """Rescore every patient in patient_analysis with the active models."""
+    run = run_rescore(chunk_size=chunk_size, workers=workers, resume=not restart)
+    click.echo(f"Run {run['id']} {run['status']}: {run['progress']}")
+
+@app.cli.command('activate-model')
+@click.argument('version')
+def activate_model_command(version):
+    """Point models/ACTIVE at VERSION; running workers switch to it after warming it up."""
+    set_active_version(version)
+    click.echo(f"Activated model version {version}")
+
+@app.cli.command('campaign')
+@click.option('--search', default='', help='Patient list search text.')
+@click.option('--risk-tier', default='', help='Only this risk tier.')
+@click.option('--age-range', default='', help='Only this age range, e.g. 51-70.')
+@click.option('--plan-concurrency', default=campaign.DEFAULT_PLAN_CONCURRENCY, help='Parallel plan generations.')
+@click.option('--pdf-concurrency', default=campaign.DEFAULT_PDF_CONCURRENCY, help='Parallel PDF renders.')
+@click.option('--email-concurrency', default=campaign.DEFAULT_EMAIL_CONCURRENCY, help='Parallel outbox writers.')
+@click.option('--rpm', default=campaign.DEFAULT_REQUESTS_PER_MINUTE, help='Maximum Gemini requests per minute (0 = unlimited).')
+@click.option('--restart', is_flag=True, help='Start over instead of resuming an unfinished run.')
+def campaign_command(search, risk_tier, age_range, plan_concurrency, pdf_concurrency, email_concurrency, rpm, restart):
+    """Email an intervention plan PDF to every patient matching the filters."""
+    run = campaign.run_campaign(search=search, risk_tier=risk_tier, age_range=age_range,
+                                plan_concurrency=plan_concurrency, pdf_concurrency=pdf_concurrency,
+                                email_concurrency=email_concurrency, requests_per_minute=rpm, resume=not restart)
+    click.echo(f"Run {run['id']} {run['status']}: {run['progress']}")
+
+@app.cli.command('context-report')
+@click.option('--sample', default=200, help='Patients to sample.')
+@click.option('--budget', default=CONTEXT_TOKEN_BUDGET, help='Token budget for the compact context (0 = no limit).')
+def context_report_command(sample, budget):
+    """Compare estimated prompt tokens of the full and compact patient context."""
+    ids = [row['desynpuf_id'] for row in execute_query(
+        "SELECT desynpuf_id FROM patient_analysis ORDER BY random() LIMIT %s", (sample,))]
+    reports = [context_token_report(get_patient_details(patient_id), budget) for patient_id in ids]
+    if not reports:
+        click.echo("No patients to sample")
+        return
+    full = sum(report['full_tokens'] for report in reports)
+    compact = sum(report['compact_tokens'] for report in reports)
+    trimmed = sum(1 for report in reports if report['dropped_lines'])
+    click.echo(f"{len(reports)} patients: {full / len(reports):.0f} -> {compact / len(reports):.0f} tokens on average "
+               f"({1 - compact / full:.0%} smaller), {trimmed} trimmed to the {budget}-token budget")
+
+@app.cli.command('send-emails')
+@click.option('--once', is_flag=True, help='Exit once no queued email is due instead of waiting for more.')
+def send_emails_command(once):
+    """Deliver queued email from the outbox over a reused SMTP session."""
+    outcomes = run_sender(once=once)
+    click.echo(f"Email outbox drained: {outcomes}")
 
 
 @app.route('/')
@@ -62,8 +176,6 @@ def login():
     username = request.form.get('username')
     password = request.form.get('password')
     role =request.form.get('role')
-    print(username)
-    print(role)
     
     if not username or not password:
         flash('Please enter both username and password.', 'error')
@@ -76,12 +188,8 @@ def login():
             session['username'] = user['username']
            
 
-            if role == "admin":
-                print("coming here → ADMIN DASHBOARD")
-                return redirect(url_for('index'))
-            else:
-                print("coming here → USER INDEX")
-                return redirect(url_for('index'))
+            logger.info("User logged in", extra={'username': username, 'role': role})
+            return redirect(url_for('index'))
     else:
         flash("Invalid credentials", "error")
         return render_template("login.html")
@@ -104,21 +212,27 @@ def index():
         search = request.args.get('search', '')
         risk_tier = request.args.get('risk_tier', '')
         age_range = request.args.get('age_range', '')
-        page = int(request.args.get('page', 1))
+        page = max(int(request.args.get('page', 1)), 1)
+        after = request.args.get('after')
+        before = request.args.get('before')
+        exact_count = request.args.get('exact_count') == '1'
         
         limit = 10
         offset = (page - 1) * limit
         
         # Fetch patient data from the database
-        patients, total_records = get_patient_list(
+        patients, total_records, page_info = get_patient_list(
             search=search, 
             risk_tier=risk_tier, 
             age_range=age_range,
             limit=limit,
-            offset=offset
+            offset=offset,
+            after=after,
+            before=before,
+            exact_count=exact_count
         )
         
-        total_pages = (total_records + limit - 1) // limit if total_records > 0 else 1
+        total_pages = max((total_records + limit - 1) // limit, page) if total_records > 0 else 1
         filter_options = get_patient_filters()
         
         # Render the main page with the fetched data
@@ -127,6 +241,7 @@ def index():
                              total_records=total_records,
                              total_pages=total_pages,
                              current_page=page,
+                             page_info=page_info,
                              filter_options=filter_options,
                              current_filters={
                                  'search': search,
@@ -134,7 +249,7 @@ def index():
                                  'age_range': age_range
                              })
     except Exception as e:
-        print(f"Error in index route: {e}")
+        logger.exception("Error in index route")
         return render_template('error.html', error="Could not load patient list.")
 
 @app.route('/patient/<patient_id>')
@@ -148,7 +263,7 @@ def patient_detail(patient_id):
         return render_template('patient_detail.html', patient=patient)
         
     except Exception as e:
-        print(f"Error in patient_detail route for ID {patient_id}: {e}")
+        logger.exception(f"Error in patient_detail route for ID {patient_id}")
         return render_template('error.html', error="Could not load patient details.")
 
 @app.route('/dashboard')
@@ -158,7 +273,7 @@ def dashboard():
         filter_options = get_patient_filters()
         return render_template('dashboard.html', filter_options=filter_options)
     except Exception as e:
-        print(f"Error in dashboard route: {e}")
+        logger.exception("Error in dashboard route")
         return render_template('error.html', error="Could not load dashboard.")
     
     
@@ -174,9 +289,25 @@ def upload():
             results = process_uploaded_data(form_data)
             return jsonify(results)
         except Exception as e:
-            print(f"Error processing uploaded data: {e}")
+            logger.exception("Error processing uploaded data")
             return jsonify({'error': str(e)}), 500
 
+@app.route('/upload/bulk', methods=['POST'])
+def upload_bulk():
+    """Handles CSV/Parquet uploads, scoring and storing patients in chunks."""
+    upload_file = request.files.get('file')
+    if not upload_file or not upload_file.filename:
+        return jsonify({'error': 'No file uploaded'}), 400
+    try:
+        chunk_size = int(request.form.get('chunk_size', DEFAULT_CHUNK_SIZE))
+        report = ingest_upload(upload_file.stream, upload_file.filename, chunk_size)
+        return jsonify(report)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.exception("Error processing bulk upload")
+        return jsonify({'error': str(e)}), 500
+
 # --- API ENDPOINTS ---
 
 @app.route('/api/patient/<patient_id>', methods=['DELETE'])
@@ -189,60 +320,178 @@ def api_delete_patient(patient_id):
         else:
             return jsonify({'success': False, 'error': 'Failed to delete patient from database'}), 500
     except Exception as e:
-        print(f"Error in delete patient API: {e}")
+        logger.exception("Error in delete patient API")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+EXPORT_FORMATS = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+def _json_value(value):
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return str(value)
+
+@app.route('/api/patients/export')
+def api_export_patients():
+    """Streams every patient matching the admin list filters as CSV or NDJSON, with all scores and condition flags."""
+    export_format = request.args.get('format', 'csv').lower()
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({'error': f"Unsupported export format '{export_format}'. Use csv or ndjson."}), 400
+
+    batches = iter_patient_export(request.args.get('search', ''), request.args.get('risk_tier', ''),
+                                  request.args.get('age_range', ''))
+    try:
+        # Run the query before answering so a database error is still a proper 500
+        first = next(batches, None)
+    except Exception as e:
+        logger.exception("Error starting patient export")
+        return jsonify({'error': 'Could not export patients.'}), 500
+
+    def generate():
+        try:
+            if first is None:
+                return
+            columns = first[0]
+            if export_format == 'csv':
+                buffer = io.StringIO()
+                writer = csv.writer(buffer)
+                writer.writerow(columns)
+                for _, rows in itertools.chain([first], batches):
+                    writer.writerows(rows)
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+            else:
+                for _, rows in itertools.chain([first], batches):
+                    yield ''.join(json.dumps(dict(zip(columns, row)), default=_json_value) + '\n' for row in rows)
+        except Exception as e:
+            # Headers are already sent; the client sees a truncated file
+            logger.exception("Error while streaming patient export")
+        finally:
+            batches.close()
+
+    filename = f"patients_{datetime.date.today().isoformat()}.{export_format}"
+    return Response(stream_with_context(generate()), mimetype=EXPORT_FORMATS[export_format],
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"', 'X-Accel-Buffering': 'no'})
+
 @app.route('/api/dashboard_data')
 def api_dashboard_data():
     """API endpoint to provide aggregated data for the dashboard charts."""
     try:
         risk_tier = request.args.get('risk_tier', '')
+        if risk_tier and not risk_tier.isdecimal():
+            return jsonify({'error': f"Invalid risk tier '{risk_tier}'"}), 400
         age_range = request.args.get('age_range', '')
-        
-        # --- Build SQL query with filters ---
-        base_query_from = "FROM patient_analysis"
-        where_clauses = ["WHERE 1=1"]
-        params = []
-
-        if risk_tier:
-            where_clauses.append("risk_tier = %s")
-            params.append(int(risk_tier))
-        
-        age_map = {'18-30': "age BETWEEN 18 AND 30", '31-50': "age BETWEEN 31 AND 50", '51-70': "age BETWEEN 51 AND 70", '70+': "age >= 70"}
-        if age_range in age_map:
-            where_clauses.append(age_map[age_range])
-        
-        final_where_clause = " ".join(where_clauses)
+        return jsonify(get_dashboard_data(risk_tier, age_range))
+    except Exception as e:
+        logger.exception("Error in dashboard data API")
+        return jsonify({'error': str(e)}), 500
 
-        # --- Execute queries for different charts ---
-        risk_scores_query = f"SELECT AVG(risk_30d_hospitalization) as avg_30d, AVG(risk_60d_hospitalization) as avg_60d, AVG(risk_90d_hospitalization) as avg_90d {base_query_from} {final_where_clause};"
-        risk_scores_data = execute_query(risk_scores_query, params)[0]
+@app.route('/metrics')
+def prometheus_metrics():
+    """Prometheus scrape endpoint."""
+    body, content_type = metrics.metrics_response()
+    return Response(body, content_type=content_type)
 
-        tier_where_clauses = ["WHERE risk_tier IS NOT NULL"]
-        if age_range in age_map:
-            tier_where_clauses.append(age_map[age_range])
-        tier_final_where = " ".join(tier_where_clauses)
-        risk_tier_distribution_query = f"SELECT risk_tier, COUNT(*) as count FROM patient_analysis {tier_final_where} GROUP BY risk_tier ORDER BY risk_tier;"
-        risk_tier_data = execute_query(risk_tier_distribution_query)
+@app.route('/api/pool_stats')
+def api_pool_stats():
+    """API endpoint exposing database connection pool usage."""
+    try:
+        return jsonify(get_pool_stats())
+    except Exception as e:
+        logger.exception("Error in pool stats API")
+        return jsonify({'error': str(e)}), 500
 
-        roi_query = f"SELECT SUM(annual_intervention_cost) as total_costs, SUM(cost_savings) as total_savings {base_query_from} {final_where_clause};"
-        roi_data = execute_query(roi_query, params)[0]
+@app.route('/api/cache_stats')
+def api_cache_stats():
+    """API endpoint exposing cache hit/miss counters, live chat sessions and prompt context sizes."""
+    return jsonify({**get_cache_stats(), 'chat_sessions': chat_sessions.stats(), 'prompt_context': get_context_stats()})
+
+@app.route('/api/models')
+def api_models():
+    """Model versions on disk, the active one, the one this worker is serving, and its batching stats."""
+    return jsonify({'versions': list_versions(), 'active': active_version(), 'serving': predictor.model_version,
+                    'scheduler': inference_scheduler.stats()})
+
+@app.route('/api/models/activate', methods=['POST'])
+def api_activate_model():
+    """Activates a model version; it is warmed up in the background before taking traffic."""
+    version = (request.get_json(silent=True) or {}).get('version')
+    try:
+        set_active_version(version)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
-        return jsonify({
-            'risk_scores': {
-                'avg_30d': risk_scores_data.get('avg_30d', 0) or 0,
-                'avg_60d': risk_scores_data.get('avg_60d', 0) or 0,
-                'avg_90d': risk_scores_data.get('avg_90d', 0) or 0
-            },
-            'risk_tier_distribution': risk_tier_data,
-            'intervention_roi': {
-                'total_costs': roi_data.get('total_costs', 0) or 0,
-                'total_savings': roi_data.get('total_savings', 0) or 0
-            }
-        })
+    def warm_up():
+        try:
+            predictor.activate(version)
+        except Exception as e:
+            logger.exception(f"Error activating model version {version}")
+
+    threading.Thread(target=warm_up, name='model-activate', daemon=True).start()
+    return jsonify({'active': version, 'serving': predictor.model_version}), 202
+
+@app.route('/api/jobs/ai_summaries', methods=['GET', 'POST'])
+def api_summary_job():
+    """GET: status of the latest AI summary pre-generation run. POST: start (or resume) a run."""
+    if request.method == 'GET':
+        return jsonify(get_latest_run(SUMMARY_JOB) or {})
+    options = request.get_json(silent=True) or {}
+    try:
+        run_id = start_summary_job(
+            tiers=options.get('tiers', [5, 4]),
+            concurrency=int(options.get('concurrency', DEFAULT_CONCURRENCY)),
+            requests_per_minute=int(options.get('rpm', DEFAULT_REQUESTS_PER_MINUTE)),
+            resume=not options.get('restart', False)
+        )
+    except JobAlreadyRunning as e:
+        return jsonify({'error': str(e)}), 409
     except Exception as e:
-        print(f"Error in dashboard data API: {e}")
-        return jsonify({'error': str(e)}), 500
+        logger.exception("Error starting summary job")
+        return jsonify({'error': 'Could not start the summary job.'}), 500
+    return jsonify(get_run(run_id)), 202
+
+@app.route('/api/jobs/runs/<int:run_id>')
+def api_job_run(run_id):
+    """Status and progress of one background job run."""
+    run = get_run(run_id)
+    if not run:
+        return jsonify({'error': 'Job run not found'}), 404
+    return jsonify(run)
+
+@app.route('/api/campaigns', methods=['GET', 'POST'])
+def api_campaigns():
+    """GET: progress of the latest intervention campaign. POST: start (or resume) one for a filtered cohort."""
+    if request.method == 'GET':
+        run = get_latest_run(campaign.JOB_NAME)
+        return jsonify(campaign.get_campaign(run['id']) if run else {})
+    options = request.get_json(silent=True) or {}
+    try:
+        run_id = campaign.start_campaign(
+            search=options.get('search', ''),
+            risk_tier=options.get('risk_tier', ''),
+            age_range=options.get('age_range', ''),
+            plan_concurrency=int(options.get('plan_concurrency', campaign.DEFAULT_PLAN_CONCURRENCY)),
+            pdf_concurrency=int(options.get('pdf_concurrency', campaign.DEFAULT_PDF_CONCURRENCY)),
+            email_concurrency=int(options.get('email_concurrency', campaign.DEFAULT_EMAIL_CONCURRENCY)),
+            requests_per_minute=int(options.get('rpm', campaign.DEFAULT_REQUESTS_PER_MINUTE)),
+            resume=not options.get('restart', False)
+        )
+    except JobAlreadyRunning as e:
+        return jsonify({'error': str(e)}), 409
+    except Exception as e:
+        logger.exception("Error starting campaign")
+        return jsonify({'error': 'Could not start the campaign.'}), 500
+    return jsonify(campaign.get_campaign(run_id)), 202
+
+@app.route('/api/campaigns/<int:run_id>')
+def api_campaign(run_id):
+    """Progress of one campaign, with the delivery status of the emails it queued."""
+    run = campaign.get_campaign(run_id)
+    if not run:
+        return jsonify({'error': 'Campaign not found'}), 404
+    return jsonify(run)
 
 @app.route('/api/conditional_risk/<patient_id>')
 def api_conditional_risk(patient_id):
@@ -251,9 +500,20 @@ def api_conditional_risk(patient_id):
         analysis = get_conditional_risk_analysis(patient_id)
         return jsonify(analysis)
     except Exception as e:
-        print(f"Error in conditional risk API: {e}")
+        logger.exception("Error in conditional risk API")
         return jsonify({'error': 'Failed to calculate conditional risk analysis.'}), 500
 
+@app.route('/api/cohort_condition_impact')
+def api_cohort_condition_impact():
+    """API endpoint for condition impact across the patients matching the list filters."""
+    try:
+        return jsonify(get_cohort_condition_impact(
+            request.args.get('search', ''), request.args.get('risk_tier', ''), request.args.get('age_range', '')
+        ))
+    except Exception as e:
+        logger.exception("Error in cohort condition impact API")
+        return jsonify({'error': 'Failed to calculate cohort condition impact.'}), 500
+
 @app.route('/api/ai_summary/<patient_id>')
 def api_ai_summary(patient_id):
     """API endpoint to generate a concise AI summary for a patient."""
@@ -265,7 +525,7 @@ def api_ai_summary(patient_id):
         summary = get_ai_summary(patient_data)
         return jsonify({'summary': summary})
     except Exception as e:
-        print(f"Error in AI summary API: {e}")
+        logger.exception("Error in AI summary API")
         return jsonify({'error': 'AI summary generation failed.'}), 500
 
 @app.route('/api/generate_intervention_text/<patient_id>')
@@ -283,14 +543,54 @@ def api_generate_intervention_text(patient_id):
         else:
             return jsonify({'error': 'Failed to generate intervention plan text'}), 500
     except Exception as e:
-        print(f"Error in generate_intervention_text API: {e}")
+        logger.exception("Error in generate_intervention_text API")
         return jsonify({'error': 'An unexpected server error occurred.'}), 500
 
+def sse_event(data, event=None):
+    """Formats one Server-Sent Events message with a JSON payload."""
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+def sse_response(chunks, on_abort=None):
+    """Streams text chunks as SSE ``data: {"text": ...}`` events, then a ``done`` event.
+
+    If the client disconnects, the server closes this generator, which closes
+    ``chunks`` and so cancels the generation. ``on_abort`` runs whenever the
+    stream does not complete.
+    """
+    def generate():
+        completed = False
+        try:
+            for text in chunks:
+                yield sse_event({'text': text})
+            completed = True
+            yield sse_event({}, event='done')
+        except GeneratorExit:
+            chunks.close()
+            raise
+        except Exception as e:
+            logger.exception("Error while streaming AI response")
+            yield sse_event({'error': 'AI generation failed.'}, event='error')
+        finally:
+            if not completed and on_abort:
+                on_abort()
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/generate_intervention_text/<patient_id>/stream')
+def api_stream_intervention_text(patient_id):
+    """SSE variant of /api/generate_intervention_text that sends the plan as it is generated."""
+    patient_data = get_patient_details(patient_id)
+    if not patient_data:
+        return jsonify({'error': 'Patient not found'}), 404
+    return sse_response(stream_intervention_text(patient_data))
+
 @app.route('/api/send_intervention/<patient_id>', methods=['POST'])
 def api_send_intervention(patient_id):
     """
-    API endpoint to generate and email a PDF intervention plan from provided text.
-    Handles detailed error feedback from the email sending function.
+    API endpoint to generate a PDF intervention plan from provided text and queue it for email.
+    Returns 202 with the outbox id; /api/emails/<id> reports delivery.
     """
     try:
         data = request.json
@@ -304,30 +604,39 @@ def api_send_intervention(patient_id):
         if not patient_data:
             return jsonify({'success': False, 'error': 'Patient not found'}), 404
 
-        # Generate the PDF from the provided text
-        pdf_filename = generate_intervention_pdf_from_text(patient_data, plan_text)
-        if not pdf_filename:
+        # Render the PDF in memory from the provided text
+        pdf_bytes = generate_intervention_pdf_from_text(patient_data, plan_text)
+        if not pdf_bytes:
             return jsonify({'success': False, 'error': 'Failed to generate PDF plan'}), 500
 
-        # Send the generated PDF via email
+        # Queue the email; the outbox senders deliver it in the background
         patient_name = patient_data.get('name', 'Patient')
-        email_sent, message = send_intervention_email(email, pdf_filename, patient_name)
-
-        # Clean up the temporary PDF file
-        if os.path.exists(pdf_filename):
-            os.remove(pdf_filename)
+        try:
+            email_id = queue_intervention_email(email, pdf_bytes, patient_name,
+                                                intervention_pdf_filename(patient_data), patient_id=patient_id)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 500
 
-        if email_sent:
-            return jsonify({'success': True, 'message': f'Intervention plan sent to {email} successfully!'})
-        else:
-            # The 'message' from the email function is now the specific error
-            return jsonify({'success': False, 'error': message}), 500
+        return jsonify({
+            'success': True,
+            'job_id': email_id,
+            'status_url': url_for('api_email_status', email_id=email_id),
+            'message': f'Intervention plan queued for delivery to {email}.'
+        }), 202
     
     except Exception as e:
         # Catch all other unexpected errors
-        print(f"Error in send_intervention API: {e}")
+        logger.exception("Error in send_intervention API")
         return jsonify({'success': False, 'error': 'An unexpected server error occurred.'}), 500
 
+@app.route('/api/emails/<int:email_id>')
+def api_email_status(email_id):
+    """Delivery status of an email queued by /api/send_intervention."""
+    email = get_email(email_id)
+    if not email:
+        return jsonify({'error': 'Email not found'}), 404
+    return jsonify(email)
+
 @app.route('/api/chatbot', methods=['POST'])
 def api_chatbot():
     """API endpoint for the AI assistant chatbot."""
@@ -343,18 +652,45 @@ def api_chatbot():
         if not patient_data:
             return jsonify({'error': 'Patient not found'}), 404
 
-        # Initialize a new chat session for each request for simplicity
-        chat_session = initialize_chat(patient_data)
+        chat_session = chat_sessions.get(chat_user_key(), patient_data)
         if not chat_session:
             return jsonify({'error': 'Could not initialize AI chat session'}), 500
             
-        ai_response = get_ai_response(chat_session, user_input)
+        with chat_session.lock:
+            ai_response = get_ai_response(chat_session.chat, user_input)
+            chat_sessions.save(chat_session)
         
         return jsonify({'response': ai_response})
     except Exception as e:
-        print(f"Error in chatbot API: {e}")
+        logger.exception("Error in chatbot API")
         return jsonify({'error': 'Failed to get response from AI assistant.'}), 500
 
+@app.route('/api/chatbot/stream', methods=['POST'])
+def api_chatbot_stream():
+    """SSE variant of /api/chatbot that sends the reply as it is generated."""
+    data = request.json or {}
+    patient_id = data.get('patient_id')
+    user_input = data.get('message')
+    if not patient_id or not user_input:
+        return jsonify({'error': 'Missing patient_id or message'}), 400
+
+    patient_data = get_patient_details(patient_id)
+    if not patient_data:
+        return jsonify({'error': 'Patient not found'}), 404
+
+    user_key = chat_user_key()
+    chat_session = chat_sessions.get(user_key, patient_data)
+    if not chat_session:
+        return jsonify({'error': 'Could not initialize AI chat session'}), 500
+
+    def reply():
+        with chat_session.lock:
+            yield from stream_ai_response(chat_session.chat, user_input)
+            chat_sessions.save(chat_session)
+
+    # An abandoned or failed reply leaves the chat history mid-turn, so start over next time
+    return sse_response(reply(), on_abort=lambda: chat_sessions.discard(user_key, patient_id))
+
 if __name__ == '__main__':
     # Runs the Flask application
     # In a production environment, use a proper WSGI server like Gunicorn or uWSGI
@@ -0,0 +1,379 @@
+"""ASGI entry point with async handlers for the AI endpoints.
+
+Run with an ASGI server, e.g. ``uvicorn asgi:application --workers 2``.
+
+The endpoints that mostly wait on Gemini are served here with asyncpg and
+the SDK's async calls, so one process can hold hundreds of in-flight AI
+requests without a thread each:
+
+- GET  /api/ai_summary/<patient_id>
+- GET  /api/generate_intervention_text/<patient_id>[/stream]
+- POST /api/chatbot[/stream]
+
+Every other request, including those that send email, goes to the Flask app
+on a thread of its own. URLs, sessions and JSON shapes are the same as under
+``flask run`` or gunicorn.
+"""
+import asyncio
+import json
+import logging
+import os
+import re
+import sys
+import time
+from http.cookies import SimpleCookie
+
+import asyncpg
+from asgiref.sync import ThreadSensitiveContext
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.http import dump_cookie
+
+from app import app as flask_app, chat_sessions, chat_user_key, start_background_threads
+from data import db_config, record_cache, PATIENT_DETAILS_QUERY
+from metrics import HTTP_REQUEST_SECONDS, observe_query
+from interven import (get_ai_summary_async, generate_intervention_text_async, get_ai_response_async,
+                      stream_ai_response_async, stream_intervention_text_async)
+
+logger = logging.getLogger(__name__)
+
+ASYNC_POOL_MIN = int(os.getenv("ASYNC_DB_POOL_MIN", 1))
+ASYNC_POOL_MAX = int(os.getenv("ASYNC_DB_POOL_MAX", 20))
+
+
+# --- Database ---
+
+_PLACEHOLDER = re.compile(r"%\((\w+)\)s|%s|%%")
+
+def convert_query(query):
+    """Rewrites a psycopg2 query for asyncpg.
+
+    ``%s`` and ``%(name)s`` placeholders become ``$1, $2, ...`` and ``%%``
+    becomes ``%``. Returns ``(sql, names)``, where names lists the named
+    parameters in ``$n`` order (empty for positional queries).
+    """
+    names = []
+    positional = 0
+
+    def replace(match):
+        nonlocal positional
+        if match.group(0) == '%%':
+            return '%'
+        if match.group(1):
+            if match.group(1) not in names:
+                names.append(match.group(1))
+            return f"${names.index(match.group(1)) + 1}"
+        positional += 1
+        return f"${positional}"
+
+    return _PLACEHOLDER.sub(replace, query), names
+
+def bind_params(names, params):
+    if names:
+        return [params[name] for name in names]
+    return list(params or ())
+
+_pool = None
+_pool_lock = asyncio.Lock()
+
+async def get_async_pool():
+    global _pool
+    async with _pool_lock:
+        if _pool is None:
+            _pool = await asyncpg.create_pool(
+                host=db_config['host'],
+                database=db_config['database'],
+                user=db_config['user'],
+                password=db_config['password'],
+                port=int(db_config['port']),
+                ssl='require',
+                min_size=ASYNC_POOL_MIN,
+                max_size=ASYNC_POOL_MAX
+            )
+    return _pool
+
+async def fetch_all(query, params=None, name=None):
+    """Async counterpart of data.execute_query for read queries, recording the same latency metrics."""
+    name = name or sys._getframe(1).f_code.co_name
+    sql, names = convert_query(query)
+    started = time.perf_counter()
+    try:
+        pool = await get_async_pool()
+        async with pool.acquire() as conn:
+            rows = await conn.fetch(sql, *bind_params(names, params))
+    except Exception as e:
+        observe_query(name, time.perf_counter() - started, failed=True)
+        logger.error(f"Error executing query {name}: {e}", extra={'query': name})
+        raise
+    observe_query(name, time.perf_counter() - started)
+    return [dict(row) for row in rows]
+
+async def get_patient_details_async(patient_id):
+    """data.get_patient_details over asyncpg, sharing the same record cache.
+
+    The cache's stores (SQLite, Redis) are synchronous, so they are called
+    from a thread rather than on the event loop.
+    """
+    value, generation = await asyncio.to_thread(record_cache.lookup, patient_id)
+    if value is None:
+        rows = await fetch_all(PATIENT_DETAILS_QUERY, (patient_id,))
+        value = rows[0] if rows else None
+        await asyncio.to_thread(record_cache.fill, patient_id, value, generation)
+    return value
+
+
+# --- HTTP helpers ---
+
+async def read_json(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            break
+    try:
+        return json.loads(body) if body else {}
+    except ValueError:
+        return {}
+
+async def send_json(send, data, status=200, headers=()):
+    body = json.dumps(data).encode('utf-8')
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json'),
+                            (b'content-length', str(len(body)).encode())] + list(headers)})
+    await send({'type': 'http.response.body', 'body': body})
+
+def sse_event(data, event=None):
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n".encode('utf-8')
+
+async def send_sse(receive, send, chunks, on_abort=None, headers=()):
+    """Streams text chunks as SSE events, like app.sse_response.
+
+    A client disconnect cancels the producer, which closes ``chunks`` and so
+    the upstream Gemini stream. ``on_abort`` runs when the stream does not complete.
+    """
+    await send({'type': 'http.response.start', 'status': 200,
+                'headers': [(b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache'),
+                            (b'x-accel-buffering', b'no')] + list(headers)})
+
+    async def produce():
+        try:
+            async for text in chunks:
+                await send({'type': 'http.response.body', 'body': sse_event({'text': text}), 'more_body': True})
+            await send({'type': 'http.response.body', 'body': sse_event({}, event='done')})
+            return True
+        except asyncio.CancelledError:
+            await chunks.aclose()
+            raise
+        except Exception as e:
+            logger.exception("Error while streaming AI response")
+            await send({'type': 'http.response.body',
+                        'body': sse_event({'error': 'AI generation failed.'}, event='error')})
+            return False
+
+    async def wait_for_disconnect():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    producer = asyncio.ensure_future(produce())
+    watcher = asyncio.ensure_future(wait_for_disconnect())
+    await asyncio.wait([producer, watcher], return_when=asyncio.FIRST_COMPLETED)
+    watcher.cancel()
+    completed = False
+    if producer.done():
+        completed = producer.result()
+    else:
+        producer.cancel()
+        await asyncio.gather(producer, return_exceptions=True)
+    if not completed and on_abort:
+        on_abort()
+
+
+# --- Sessions ---
+
+def load_session(scope):
+    """Reads the signed Flask session cookie; returns ``(session_dict, serializer)``."""
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    cookie_name = flask_app.config['SESSION_COOKIE_NAME']
+    cookies = SimpleCookie()
+    for name, value in scope.get('headers', []):
+        if name == b'cookie':
+            cookies.load(value.decode('latin-1'))
+    if cookie_name in cookies:
+        try:
+            max_age = int(flask_app.permanent_session_lifetime.total_seconds())
+            return dict(serializer.loads(cookies[cookie_name].value, max_age=max_age)), serializer
+        except Exception:
+            pass
+    return {}, serializer
+
+def resolve_chat_user(scope):
+    """Returns ``(user_key, extra_headers)``, setting the session cookie if an anonymous id was minted."""
+    session_data, serializer = load_session(scope)
+    had_chat_id = 'chat_id' in session_data
+    user_key = chat_user_key(session_data)
+    if had_chat_id or 'userid' in session_data:
+        return user_key, []
+    cookie = dump_cookie(
+        flask_app.config['SESSION_COOKIE_NAME'], serializer.dumps(session_data),
+        path=flask_app.config['SESSION_COOKIE_PATH'] or '/',
+        httponly=flask_app.config['SESSION_COOKIE_HTTPONLY'],
+        secure=flask_app.config['SESSION_COOKIE_SECURE'],
+        samesite=flask_app.config['SESSION_COOKIE_SAMESITE']
+    )
+    return user_key, [(b'set-cookie', cookie.encode('latin-1'))]
+
+async def acquire_chat_lock(chat_session):
+    # Poll rather than block a worker thread, so a cancelled request never holds the lock
+    while not chat_session.lock.acquire(blocking=False):
+        await asyncio.sleep(0.05)
+
+
+# --- Handlers ---
+
+async def ai_summary(scope, receive, send, patient_id):
+    try:
+        patient_data = await get_patient_details_async(patient_id)
+        if not patient_data:
+            return await send_json(send, {'error': 'Patient not found'}, 404)
+        summary = await get_ai_summary_async(patient_data)
+        await send_json(send, {'summary': summary})
+    except Exception as e:
+        logger.exception("Error in AI summary API")
+        await send_json(send, {'error': 'AI summary generation failed.'}, 500)
+
+async def intervention_text(scope, receive, send, patient_id):
+    try:
+        patient_data = await get_patient_details_async(patient_id)
+        if not patient_data:
+            return await send_json(send, {'error': 'Patient not found'}, 404)
+        plan_text = await generate_intervention_text_async(patient_data)
+        if plan_text:
+            await send_json(send, {'plan_text': plan_text})
+        else:
+            await send_json(send, {'error': 'Failed to generate intervention plan text'}, 500)
+    except Exception as e:
+        logger.exception("Error in generate_intervention_text API")
+        await send_json(send, {'error': 'An unexpected server error occurred.'}, 500)
+
+async def intervention_text_stream(scope, receive, send, patient_id):
+    patient_data = await get_patient_details_async(patient_id)
+    if not patient_data:
+        return await send_json(send, {'error': 'Patient not found'}, 404)
+    await send_sse(receive, send, stream_intervention_text_async(patient_data))
+
+async def _chat_request(scope, receive, send):
+    """Shared preamble of the chatbot handlers; returns the arguments they need, or None after replying."""
+    data = await read_json(receive)
+    patient_id = data.get('patient_id')
+    user_input = data.get('message')
+    if not patient_id or not user_input:
+        await send_json(send, {'error': 'Missing patient_id or message'}, 400)
+        return None
+
+    patient_data = await get_patient_details_async(patient_id)
+    if not patient_data:
+        await send_json(send, {'error': 'Patient not found'}, 404)
+        return None
+
+    user_key, headers = resolve_chat_user(scope)
+    # Creating a session may upload cached context, which the SDK only does synchronously
+    chat_session = await asyncio.to_thread(chat_sessions.get, user_key, patient_data)
+    if not chat_session:
+        await send_json(send, {'error': 'Could not initialize AI chat session'}, 500, headers)
+        return None
+    return patient_id, user_input, user_key, chat_session, headers
+
+async def chatbot(scope, receive, send):
+    try:
+        request = await _chat_request(scope, receive, send)
+        if request is None:
+            return
+        patient_id, user_input, user_key, chat_session, headers = request
+        await acquire_chat_lock(chat_session)
+        try:
+            ai_response = await get_ai_response_async(chat_session.chat, user_input)
+            await asyncio.to_thread(chat_sessions.save, chat_session)
+        finally:
+            chat_session.lock.release()
+        await send_json(send, {'response': ai_response}, headers=headers)
+    except Exception as e:
+        logger.exception("Error in chatbot API")
+        await send_json(send, {'error': 'Failed to get response from AI assistant.'}, 500)
+
+async def chatbot_stream(scope, receive, send):
+    request = await _chat_request(scope, receive, send)
+    if request is None:
+        return
+    patient_id, user_input, user_key, chat_session, headers = request
+
+    async def reply():
+        await acquire_chat_lock(chat_session)
+        try:
+            async for text in stream_ai_response_async(chat_session.chat, user_input):
+                yield text
+            await asyncio.to_thread(chat_sessions.save, chat_session)
+        finally:
+            chat_session.lock.release()
+
+    # An abandoned or failed reply leaves the chat history mid-turn, so start over next time
+    await send_sse(receive, send, reply(), headers=headers,
+                   on_abort=lambda: chat_sessions.discard(user_key, patient_id))
+
+
+# (method, Flask rule used as the metrics route label, path pattern, handler)
+ROUTES = [
+    ('GET', '/api/ai_summary/<patient_id>', re.compile(r'^/api/ai_summary/([^/]+)$'), ai_summary),
+    ('GET', '/api/generate_intervention_text/<patient_id>',
+     re.compile(r'^/api/generate_intervention_text/([^/]+)$'), intervention_text),
+    ('GET', '/api/generate_intervention_text/<patient_id>/stream',
+     re.compile(r'^/api/generate_intervention_text/([^/]+)/stream$'), intervention_text_stream),
+    ('POST', '/api/chatbot', re.compile(r'^/api/chatbot$'), chatbot),
+    ('POST', '/api/chatbot/stream', re.compile(r'^/api/chatbot/stream$'), chatbot_stream),
+]
+
+
+def _timed_send(send, method, route):
+    """Wraps ``send`` to record the request's latency when the response starts, as Flask requests are."""
+    started = time.perf_counter()
+
+    async def timed(message):
+        if message['type'] == 'http.response.start':
+            HTTP_REQUEST_SECONDS.labels(method, route, message['status']).observe(time.perf_counter() - started)
+        await send(message)
+    return timed
+
+
+# --- Flask fallback ---
+
+_flask_wsgi = WsgiToAsgi(flask_app)
+
+async def flask_asgi(scope, receive, send):
+    # asgiref runs WSGI apps on one thread shared by the whole process, which
+    # would serialise every Flask request. A ThreadSensitiveContext (asgiref's
+    # public API for this, as Django uses per request) gives each request its
+    # own thread; Flask is thread-safe.
+    async with ThreadSensitiveContext():
+        await _flask_wsgi(scope, receive, send)
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                start_background_threads()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if _pool is not None:
+                    await _pool.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    if scope['type'] == 'http':
+        for method, route, pattern, handler in ROUTES:
+            match = pattern.match(scope['path'])
+            if match and scope['method'] == method:
+                return await handler(scope, receive, _timed_send(send, method, route), *match.groups())
+
+    await flask_asgi(scope, receive, send)
@@ -0,0 +1,428 @@
+"""Caches shared by the data layer.
+
+``TTLCache`` is a per-process LRU used for small reference lookups. The record
+stores below sit in front of ``get_patient_details`` and can be shared by every
+gunicorn worker on a host (SQLite on /dev/shm) or across hosts (Redis).
+
+Record stores guard against a reader caching a row that a concurrent writer
+has just replaced: a miss hands out a generation token, invalidation bumps the
+key's generation, and ``set`` is dropped when the token no longer matches.
+
+Cached records are patient data and are stored pickled, and unpickling runs
+whatever the payload says. So a store must be writable by this service alone:
+the SQLite file lives in a directory private to the service's user, is created
+0600, and is refused if its owner or mode says anyone else can reach it; a
+Redis store must likewise be reachable by this service only.
+"""
+import logging
+import os
+import pickle
+import random
+import sqlite3
+import stat
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class TTLCache:
+    """Small thread-safe LRU cache with a per-key time-to-live.
+
+    Keys are tuples whose first element names the kind of data cached, so a
+    whole kind can be dropped with ``invalidate_namespace``.
+    """
+
+    _MISSING = object()
+
+    def __init__(self, maxsize=256, default_ttl=300.0):
+        self.maxsize = maxsize
+        self.default_ttl = default_ttl
+        self._data = OrderedDict()  # key -> (value, expires_at), least recently used first
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "invalidations": 0}
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[1] <= now:
+                del self._data[key]
+                self._stats["expirations"] += 1
+                entry = None
+            if entry is None:
+                self._stats["misses"] += 1
+                return default
+            self._data.move_to_end(key)
+            self._stats["hits"] += 1
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.default_ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def peek(self, key, default=None):
+        """Like ``get`` but without touching the LRU order or the counters."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[1] <= time.monotonic():
+                return default
+            return entry[0]
+
+    def get_or_load(self, key, loader, ttl=None):
+        """Return the cached value for ``key``, calling ``loader()`` to fill a miss."""
+        value = self.get(key, self._MISSING)
+        if value is self._MISSING:
+            value = loader()
+            self.set(key, value, ttl)
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            if self._data.pop(key, None) is not None:
+                self._stats["invalidations"] += 1
+
+    def invalidate_namespace(self, namespace):
+        with self._lock:
+            stale = [key for key in self._data if key[0] == namespace]
+            for key in stale:
+                del self._data[key]
+            self._stats["invalidations"] += len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._stats["invalidations"] += len(self._data)
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["misses"]
+            return {
+                "size": len(self._data),
+                "max_size": self.maxsize,
+                **self._stats,
+                "hit_rate": round(self._stats["hits"] / lookups, 4) if lookups else 0.0
+            }
+
+
+
+def _new_generation():
+    return random.getrandbits(62) + 1
+
+
+class MemoryRecordStore:
+    """Per-process record store; each worker keeps its own copy."""
+
+    backend = 'memory'
+
+    def __init__(self, maxsize=2048, ttl=300.0):
+        self.ttl = ttl
+        self._cache = TTLCache(maxsize=maxsize, default_ttl=ttl)
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0}
+
+    def get(self, key):
+        entry = self._cache.get(key)  # (generation, payload or None for a tombstone)
+        generation, payload = entry if entry else (0, None)
+        with self._lock:
+            self._stats["hits" if payload is not None else "misses"] += 1
+        return payload, generation
+
+    def set(self, key, payload, generation):
+        with self._lock:
+            entry = self._cache.peek(key)
+            if (entry[0] if entry else 0) == generation:
+                self._cache.set(key, (generation, payload))
+
+    def invalidate(self, keys):
+        with self._lock:
+            for key in keys:
+                self._cache.set(key, (_new_generation(), None))
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["misses"]
+            return {
+                **self._cache.stats(),
+                **self._stats,
+                "hit_rate": round(self._stats["hits"] / lookups, 4) if lookups else 0.0
+            }
+
+
+class SQLiteRecordStore:
+    """Record store in a SQLite file shared by every process on the host.
+
+    Put the file on a RAM-backed filesystem (/dev/shm) so reads never touch
+    disk. Reads do not write, so eviction past ``maxsize`` drops the entries
+    closest to expiry rather than the least recently used ones.
+
+    The file (and its WAL files) must belong to the current user with no
+    group or other permissions; otherwise the store raises PermissionError
+    rather than read pickles someone else could have written.
+    """
+
+    backend = 'sqlite'
+    PRUNE_EVERY = 200
+
+    def __init__(self, path, maxsize=20000, ttl=300.0):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._stats = {"hits": 0, "misses": 0, "errors": 0}
+        self._create_private(path)
+        with self._connection() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS records (
+                    key TEXT PRIMARY KEY,
+                    payload BLOB,
+                    generation INTEGER NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS records_expires_at ON records (expires_at)")
+
+    @staticmethod
+    def _create_private(path):
+        """Creates ``path`` as an empty 0600 file if missing, then checks it and its WAL files are private."""
+        try:
+            os.close(os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o600))
+        except FileExistsError:
+            pass
+        # SQLite creates the -wal and -shm files with the database file's owner and mode
+        for candidate in (path, f"{path}-wal", f"{path}-shm"):
+            if os.path.lexists(candidate):
+                _check_private(candidate)
+
+    def _connection(self):
+        # One connection per thread, reopened after a fork
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def get(self, key):
+        try:
+            row = self._connection().execute(
+                "SELECT payload, generation, expires_at FROM records WHERE key = ?", (key,)
+            ).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f"Record cache read failed: {e}")
+            self._count("errors")
+            return None, None
+        if row is None or row[2] <= time.time():
+            self._count("misses")
+            return None, 0 if row is None else row[1]
+        if row[0] is None:
+            self._count("misses")
+            return None, row[1]
+        self._count("hits")
+        return row[0], row[1]
+
+    def set(self, key, payload, generation):
+        try:
+            self._connection().execute("""
+                INSERT INTO records (key, payload, generation, expires_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT (key) DO UPDATE SET payload = excluded.payload, expires_at = excluded.expires_at
+                WHERE records.generation = excluded.generation
+            """, (key, payload, generation, time.time() + self.ttl))
+        except sqlite3.Error as e:
+            logger.warning(f"Record cache write failed: {e}")
+            self._count("errors")
+            return
+        with self._lock:
+            self._writes += 1
+            prune = self._writes % self.PRUNE_EVERY == 0
+        if prune:
+            self._prune()
+
+    def invalidate(self, keys):
+        expires_at = time.time() + self.ttl
+        rows = [(key, _new_generation(), expires_at) for key in keys]
+        # Failing to invalidate would serve stale records, so errors propagate to the writer
+        self._connection().executemany("""
+            INSERT INTO records (key, payload, generation, expires_at) VALUES (?, NULL, ?, ?)
+            ON CONFLICT (key) DO UPDATE SET payload = NULL, generation = excluded.generation,
+                                            expires_at = excluded.expires_at
+        """, rows)
+
+    def _prune(self):
+        try:
+            conn = self._connection()
+            conn.execute("DELETE FROM records WHERE expires_at <= ?", (time.time(),))
+            conn.execute("""
+                DELETE FROM records WHERE key IN (
+                    SELECT key FROM records ORDER BY expires_at DESC LIMIT -1 OFFSET ?
+                )
+            """, (self.maxsize,))
+        except sqlite3.Error as e:
+            logger.warning(f"Record cache prune failed: {e}")
+
+    def clear(self):
+        self._connection().execute("DELETE FROM records")
+
+    def stats(self):
+        try:
+            size = self._connection().execute("SELECT COUNT(*) FROM records WHERE payload IS NOT NULL").fetchone()[0]
+        except sqlite3.Error:
+            size = None
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["misses"]
+            return {
+                "size": size,
+                "max_size": self.maxsize,
+                "path": self.path,
+                **self._stats,
+                "hit_rate": round(self._stats["hits"] / lookups, 4) if lookups else 0.0
+            }
+
+
+class RedisRecordStore:
+    """Record store in Redis, shared by every host. Needs the ``redis`` package."""
+
+    backend = 'redis'
+
+    def __init__(self, url, ttl=300.0, prefix='medcare:record:'):
+        import redis
+        self._redis = redis.Redis.from_url(url)
+        self._watch_error = redis.WatchError
+        self.ttl = ttl
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "errors": 0}
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def get(self, key):
+        try:
+            raw = self._redis.get(self.prefix + key)
+        except Exception as e:
+            logger.warning(f"Record cache read failed: {e}")
+            self._count("errors")
+            return None, None
+        generation, payload = pickle.loads(raw) if raw else (0, None)
+        self._count("hits" if payload is not None else "misses")
+        return payload, generation
+
+    def set(self, key, payload, generation):
+        name = self.prefix + key
+        try:
+            with self._redis.pipeline() as pipe:
+                pipe.watch(name)
+                raw = pipe.get(name)
+                if (pickle.loads(raw)[0] if raw else 0) != generation:
+                    return
+                pipe.multi()
+                pipe.set(name, pickle.dumps((generation, payload)), ex=int(self.ttl))
+                pipe.execute()
+        except self._watch_error:
+            pass  # invalidated while we were writing; leave the tombstone
+        except Exception as e:
+            logger.warning(f"Record cache write failed: {e}")
+            self._count("errors")
+
+    def invalidate(self, keys):
+        with self._redis.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.set(self.prefix + key, pickle.dumps((_new_generation(), None)), ex=int(self.ttl))
+            pipe.execute()
+
+    def clear(self):
+        for name in self._redis.scan_iter(self.prefix + '*'):
+            self._redis.delete(name)
+
+    def stats(self):
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["misses"]
+            return {**self._stats, "hit_rate": round(self._stats["hits"] / lookups, 4) if lookups else 0.0}
+
+
+class RecordCache:
+    """Read-through cache of single records over one of the stores above."""
+
+    def __init__(self, store):
+        self.store = store
+
+    def lookup(self, key):
+        """Returns ``(value, generation)``; value is None on a miss. Pass the
+        generation to ``fill`` once the record has been loaded."""
+        payload, generation = self.store.get(str(key))
+        return (pickle.loads(payload) if payload is not None else None), generation
+
+    def fill(self, key, value, generation):
+        # Unknown patients are not cached, nor is anything while the store is unreachable
+        if value is not None and generation is not None:
+            self.store.set(str(key), pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), generation)
+
+    def get_or_load(self, key, loader):
+        value, generation = self.lookup(key)
+        if value is None:
+            value = loader()
+            self.fill(key, value, generation)
+        return value
+
+    def invalidate(self, keys):
+        keys = [str(key) for key in keys]
+        if keys:
+            self.store.invalidate(keys)
+
+    def stats(self):
+        return {"backend": self.store.backend, **self.store.stats()}
+
+
+def _check_private(path):
+    """Raises PermissionError unless ``path`` is a non-symlink owned by this user with no group/other access."""
+    info = os.lstat(path)
+    if stat.S_ISLNK(info.st_mode) or info.st_uid != os.geteuid() or info.st_mode & 0o077:
+        raise PermissionError(f"{path} must be owned by uid {os.geteuid()} with no group or other access "
+                              f"(found uid {info.st_uid}, mode {stat.filemode(info.st_mode)})")
+
+
+def _default_sqlite_path():
+    """The record cache file in a 0700 directory of this user's, on /dev/shm when the host has it."""
+    base = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    directory = os.path.join(base, f'medcare-{os.geteuid()}')
+    try:
+        os.mkdir(directory, 0o700)
+    except FileExistsError:
+        pass
+    _check_private(directory)
+    return os.path.join(directory, 'record_cache.sqlite3')
+
+
+def create_record_store():
+    """Builds the record store named by RECORD_CACHE_BACKEND (sqlite, memory or redis)."""
+    backend = os.getenv("RECORD_CACHE_BACKEND", "sqlite").lower()
+    ttl = float(os.getenv("RECORD_CACHE_TTL", 300))
+    maxsize = int(os.getenv("RECORD_CACHE_SIZE", 20000))
+
+    try:
+        if backend == 'redis':
+            return RedisRecordStore(os.getenv("RECORD_CACHE_REDIS_URL", "redis://localhost:6379/0"), ttl=ttl)
+        if backend == 'sqlite':
+            return SQLiteRecordStore(os.getenv("RECORD_CACHE_PATH") or _default_sqlite_path(), maxsize=maxsize, ttl=ttl)
+    except Exception as e:
+        logger.warning(f"Record cache backend '{backend}' unavailable ({e}); using an in-process cache")
+    return MemoryRecordStore(maxsize=maxsize, ttl=ttl)
@@ -0,0 +1,311 @@
+"""Intervention plan campaigns: a plan PDF emailed to every patient in a cohort.
+
+The cohort is chosen with the patient list filters (search, risk tier, age
+range) and flows through four stages joined by bounded queues:
+
+    fetch -> plan text (Gemini) -> PDF -> email outbox
+
+Each stage has its own thread count, and a full queue blocks the stage in
+front of it, so a slow Gemini or PDF stage holds back fetching rather than
+piling records up in memory. Plan text comes from ai_content_cache when the
+record is unchanged, and only fresh generations wait on the rate limiter.
+PDFs render in the interven process pool. The email stage only queues the
+message; the outbox senders (web workers or ``flask send-emails``) deliver it.
+
+Progress and the resume checkpoint live in job_runs. Patients finish out of
+order, so the checkpoint is the last id before which every fetched patient
+has finished, and the stored counts cover exactly the patients up to it: a
+resumed run redoes everything after the checkpoint and counts it once. It
+skips patients it already queued an email for.
+Patients without an email address are counted and skipped.
+
+Run from the CLI with ``flask campaign`` or start it from the API.
+"""
+import logging
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from ai_cache import has_content
+from data import execute_query, build_patient_filter_clause, PATIENT_DETAILS_COLUMNS, PATIENT_DETAILS_FROM
+from interven import (generate_intervention_plan, intervention_cache_key, intervention_pdf_filename,
+                      queue_intervention_email, submit_intervention_pdf, PDF_RENDER_WORKERS)
+from jobs import RateLimiter, job_lock, create_run, find_resumable_run, save_progress, get_run
+from outbox import get_delivery_counts
+
+logger = logging.getLogger(__name__)
+
+JOB_NAME = 'campaign'
+DEFAULT_PLAN_CONCURRENCY = int(os.getenv("CAMPAIGN_PLAN_CONCURRENCY", 4))
+DEFAULT_PDF_CONCURRENCY = int(os.getenv("CAMPAIGN_PDF_CONCURRENCY", PDF_RENDER_WORKERS))
+DEFAULT_EMAIL_CONCURRENCY = int(os.getenv("CAMPAIGN_EMAIL_CONCURRENCY", 2))
+DEFAULT_REQUESTS_PER_MINUTE = int(os.getenv("CAMPAIGN_RPM", 60))
+DEFAULT_PAGE_SIZE = 200
+# Items allowed to wait between two stages, per consuming thread
+QUEUE_DEPTH_PER_WORKER = 2
+SAVE_INTERVAL = 2.0
+
+_END = object()
+
+
+def _count_cohort(where, params):
+    return execute_query(f"SELECT COUNT(*) AS n {PATIENT_DETAILS_FROM} {where}", params)[0]['n']
+
+
+def _fetch_page(where, params, after, page_size):
+    """Next page of cohort records after ``after``, ordered by id, each with its email address."""
+    query = f"""
+        SELECT {PATIENT_DETAILS_COLUMNS}, p.email AS campaign_email
+        {PATIENT_DETAILS_FROM}
+        {where} AND pa.DESYNPUF_ID > %(campaign_after)s
+        ORDER BY pa.DESYNPUF_ID
+        LIMIT %(campaign_limit)s
+    """
+    return [dict(row) for row in execute_query(query, {**params, 'campaign_after': after or '', 'campaign_limit': page_size})]
+
+
+def _already_queued(run_id, patient_ids):
+    rows = execute_query("""
+        SELECT DISTINCT patient_id FROM email_outbox WHERE job_run_id = %s AND patient_id = ANY(%s)
+    """, (run_id, patient_ids))
+    return {row['patient_id'] for row in rows}
+
+
+class _Tracker:
+    """Advances the checkpoint past patients that have finished every stage and counts their outcomes.
+
+    An outcome is counted only once the checkpoint passes its patient, so the
+    saved progress always matches the saved checkpoint. Saves happen outside
+    the lock, one at a time, so pipeline threads never wait on the database.
+    """
+
+    def __init__(self, run_id, progress, checkpoint):
+        self.run_id = run_id
+        self.progress = progress
+        self.checkpoint = checkpoint
+        self._pending = OrderedDict()  # patient id -> outcome once finished (None until then), in fetch order
+        self._lock = threading.Lock()
+        self._saving = False
+        self._saved_at = time.monotonic()
+        self._started = time.monotonic()
+        self._processed_here = 0
+
+    def fetched(self, patient_id):
+        with self._lock:
+            self._pending[patient_id] = None
+
+    def finish(self, patient_id, outcome):
+        with self._lock:
+            self._pending[patient_id] = outcome
+            self._processed_here += 1
+            while self._pending and next(iter(self._pending.values())) is not None:
+                finished_id, finished_outcome = self._pending.popitem(last=False)
+                self.progress[finished_outcome] += 1
+                self.progress['processed'] += 1
+                self.checkpoint = {'desynpuf_id': finished_id}
+            due = not self._saving and time.monotonic() - self._saved_at >= SAVE_INTERVAL
+            if due:
+                self._saving = True
+                snapshot = self._snapshot()
+        if due:
+            try:
+                self._write(*snapshot)
+            finally:
+                with self._lock:
+                    self._saving = False
+
+    def save(self, status='running', error=None):
+        """Saves the progress now; the run's final save, once every stage has stopped."""
+        with self._lock:
+            snapshot = self._snapshot()
+        self._write(*snapshot, status=status, error=error)
+
+    def _snapshot(self):
+        self._saved_at = time.monotonic()
+        return dict(self.progress), self.checkpoint, self._processed_here
+
+    def _write(self, progress, checkpoint, processed_here, status='running', error=None):
+        save_progress(self.run_id, progress, checkpoint, status=status, error=error)
+        if status == 'running':
+            rate = processed_here / (time.monotonic() - self._started)
+            logger.info(f"Campaign run {self.run_id}: {progress['processed']}/{progress['total']} processed "
+                        f"({progress['queued']} queued, {rate:.1f}/sec)",
+                        extra={'run_id': self.run_id, 'progress': progress})
+
+
+def _start_stage(name, inbox, outbox, workers, handle, tracker, stop, failure):
+    """Starts ``workers`` threads applying ``handle`` to items from ``inbox``.
+
+    ``handle`` returns the item for the next stage, or ``(None, outcome)`` once
+    the patient is done. Exceptions finish the patient as ``<name>_failed``;
+    an error recording the outcome is stored in ``failure`` and stops the run.
+    """
+    def work():
+        while True:
+            item = inbox.get()
+            if item is _END:
+                inbox.put(_END)  # let the stage's other threads see it too
+                return
+            patient_id = item['patient']['desynpuf_id']
+            if stop.is_set():
+                continue  # draining after a failure elsewhere
+            try:
+                result, outcome = handle(item)
+            except Exception as e:
+                logger.warning(f"Campaign {name} stage: patient {patient_id} failed: {e}")
+                result, outcome = None, f'{name}_failed'
+            try:
+                if result is None:
+                    tracker.finish(patient_id, outcome)
+                else:
+                    outbox.put(result)
+            except Exception as e:
+                # Bookkeeping failed (e.g. the database is gone): stop the whole run
+                failure.setdefault('error', e)
+                stop.set()
+
+    threads = [threading.Thread(target=work, name=f'campaign-{name}-{number}', daemon=True)
+               for number in range(max(1, workers))]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def _finish_stage(threads, inbox, outbox=None):
+    """Signals the end of input to a stage, waits for it, then passes the end on."""
+    inbox.put(_END)
+    for thread in threads:
+        thread.join()
+    if outbox is not None:
+        outbox.put(_END)
+
+
+def run_campaign(search='', risk_tier='', age_range='', plan_concurrency=DEFAULT_PLAN_CONCURRENCY,
+                 pdf_concurrency=DEFAULT_PDF_CONCURRENCY, email_concurrency=DEFAULT_EMAIL_CONCURRENCY,
+                 requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE, page_size=DEFAULT_PAGE_SIZE,
+                 resume=True, on_start=None):
+    """Runs a campaign for the filtered cohort to completion and returns its job_runs row.
+
+    With ``resume`` an unfinished run for the same filters continues from its
+    checkpoint. ``on_start(run_id)`` is called once the run is registered.
+    Raises JobAlreadyRunning if another campaign is running.
+    """
+    params = {'search': search or '', 'risk_tier': str(risk_tier or ''), 'age_range': age_range or ''}
+    where, query_params = build_patient_filter_clause(**params)
+
+    with job_lock(JOB_NAME):
+        run = find_resumable_run(JOB_NAME, params) if resume else None
+        if run:
+            run_id, progress, checkpoint = run['id'], dict(run['progress']), run['checkpoint']
+            logger.info(f"Resuming campaign run {run_id} after {checkpoint}")
+        else:
+            progress = {'total': _count_cohort(where, query_params), 'processed': 0, 'queued': 0,
+                        'already_queued': 0, 'no_email': 0, 'plan_failed': 0, 'pdf_failed': 0, 'email_failed': 0}
+            run_id, checkpoint = create_run(JOB_NAME, params, progress), None
+        if on_start:
+            on_start(run_id)
+
+        tracker = _Tracker(run_id, progress, checkpoint)
+        limiter = RateLimiter(requests_per_minute)
+        stop = threading.Event()
+        failure = {}
+        plan_queue = queue.Queue(maxsize=max(1, plan_concurrency) * QUEUE_DEPTH_PER_WORKER)
+        pdf_queue = queue.Queue(maxsize=max(1, pdf_concurrency) * QUEUE_DEPTH_PER_WORKER)
+        email_queue = queue.Queue(maxsize=max(1, email_concurrency) * QUEUE_DEPTH_PER_WORKER)
+
+        def plan(item):
+            patient = item['patient']
+            if not has_content(intervention_cache_key(patient)):
+                limiter.acquire()
+            item['plan_text'] = generate_intervention_plan(patient)
+            return item, None
+
+        def render(item):
+            pdf_bytes, _ = submit_intervention_pdf(item['patient'], item['plan_text']).result()
+            if not pdf_bytes:
+                return None, 'pdf_failed'
+            item['pdf'] = pdf_bytes
+            return item, None
+
+        def send(item):
+            patient = item['patient']
+            queue_intervention_email(item['email'], item['pdf'], patient.get('name') or 'Patient',
+                                     intervention_pdf_filename(patient), patient_id=patient['desynpuf_id'],
+                                     job_run_id=run_id)
+            return None, 'queued'
+
+        stages = [
+            (_start_stage('plan', plan_queue, pdf_queue, plan_concurrency, plan, tracker, stop, failure), plan_queue, pdf_queue),
+            (_start_stage('pdf', pdf_queue, email_queue, pdf_concurrency, render, tracker, stop, failure), pdf_queue, email_queue),
+            (_start_stage('email', email_queue, None, email_concurrency, send, tracker, stop, failure), email_queue, None),
+        ]
+        error = None
+        try:
+            save_progress(run_id, progress)
+            after = checkpoint and checkpoint['desynpuf_id']
+            while not stop.is_set():
+                page = _fetch_page(where, query_params, after, page_size)
+                if not page:
+                    break
+                after = page[-1]['desynpuf_id']
+                queued_before = _already_queued(run_id, [patient['desynpuf_id'] for patient in page])
+                for patient in page:
+                    email = patient.pop('campaign_email')
+                    tracker.fetched(patient['desynpuf_id'])
+                    if patient['desynpuf_id'] in queued_before:
+                        tracker.finish(patient['desynpuf_id'], 'already_queued')
+                    elif not email:
+                        tracker.finish(patient['desynpuf_id'], 'no_email')
+                    else:
+                        plan_queue.put({'patient': patient, 'email': email})
+        except BaseException as e:
+            error = e
+            stop.set()
+        finally:
+            for threads, inbox, outbox in stages:
+                _finish_stage(threads, inbox, outbox)
+
+        error = error or failure.get('error')
+        if error is not None:
+            tracker.save(status='failed', error=str(error) or type(error).__name__)
+            raise error
+        tracker.save(status='completed')
+    return get_run(run_id)
+
+
+def start_campaign(**options):
+    """Starts run_campaign in a background thread and returns its run id.
+
+    Raises JobAlreadyRunning if a campaign is already running anywhere.
+    """
+    started = threading.Event()
+    outcome = {}
+
+    def on_start(run_id):
+        outcome['run_id'] = run_id
+        started.set()
+
+    def target():
+        try:
+            run_campaign(on_start=on_start, **options)
+        except Exception as e:
+            outcome.setdefault('error', e)
+            logger.exception("Campaign failed")
+        finally:
+            started.set()
+
+    threading.Thread(target=target, name='campaign', daemon=True).start()
+    started.wait()
+    if 'run_id' not in outcome:
+        raise outcome.get('error') or RuntimeError("Campaign did not start")
+    return outcome['run_id']
+
+
+def get_campaign(run_id):
+    """A campaign's job_runs row with the delivery status of the emails it queued, or None."""
+    run = get_run(run_id)
+    if not run or run['job'] != JOB_NAME:
+        return None
+    run['delivery'] = get_delivery_counts(run_id)
+    return run
@@ -0,0 +1,101 @@
+"""Chatbot history shared by every worker, in the chat_history table.
+
+Each (chat user, patient) conversation is one row holding its turns as
+``[{'role': 'user' | 'model', 'text': ...}]`` and a version bumped on every
+save. Workers keep live Gemini sessions only as a cache: before answering
+they compare versions and rebuild the session from the stored turns when
+another worker has replied since. A conversation idle for longer than
+CHAT_IDLE_TIMEOUT seconds starts over, and such rows are deleted
+periodically.
+"""
+import logging
+import os
+import threading
+from psycopg2.extras import Json
+from data import execute_query
+
+logger = logging.getLogger(__name__)
+
+IDLE_TIMEOUT = int(os.getenv("CHAT_IDLE_TIMEOUT", 1800))
+PRUNE_EVERY = 100
+
+_saves = 0
+_saves_lock = threading.Lock()
+
+
+def history_turns(history):
+    """Gemini chat history as the plain turns stored here."""
+    return [{'role': content.role, 'text': ''.join(part.text for part in content.parts)} for content in history]
+
+
+def gemini_history(turns):
+    """Stored turns as the history argument of ``start_chat``."""
+    return [{'role': turn['role'], 'parts': [turn['text']]} for turn in turns]
+
+
+def load_history(user_key, patient_id):
+    """Returns ``(turns, version)``; turns are empty for a new or idle conversation.
+
+    Returns None when the store is unreachable, so the caller can carry on
+    with the history it has.
+    """
+    try:
+        rows = execute_query("""
+            SELECT turns, version, updated_at > now() - make_interval(secs => %s) AS active
+            FROM chat_history WHERE user_key = %s AND patient_id = %s
+        """, (IDLE_TIMEOUT, str(user_key), str(patient_id)))
+    except Exception as e:
+        logger.warning(f"Chat history lookup failed: {e}")
+        return None
+    if not rows:
+        return [], 0
+    return (rows[0]['turns'] if rows[0]['active'] else []), rows[0]['version']
+
+
+def history_version(user_key, patient_id):
+    """The stored version of the conversation (0 if there is none), or None when the store is unreachable.
+
+    Cheaper than load_history: enough to tell whether a live session is current.
+    """
+    try:
+        rows = execute_query("SELECT version FROM chat_history WHERE user_key = %s AND patient_id = %s",
+                             (str(user_key), str(patient_id)), name='chat_history_version')
+    except Exception as e:
+        logger.warning(f"Chat history lookup failed: {e}")
+        return None
+    return rows[0]['version'] if rows else 0
+
+
+def save_history(user_key, patient_id, turns, version):
+    """Stores ``turns`` if the row is still at ``version``; returns the new version, or None.
+
+    None means another worker saved a reply first (or the store failed), and
+    the caller's session no longer matches the stored conversation.
+    """
+    global _saves
+    try:
+        rows = execute_query("""
+            INSERT INTO chat_history (user_key, patient_id, turns) VALUES (%s, %s, %s)
+            ON CONFLICT (user_key, patient_id) DO UPDATE SET turns = EXCLUDED.turns,
+                version = chat_history.version + 1, updated_at = now()
+            WHERE chat_history.version = %s
+            RETURNING version
+        """, (str(user_key), str(patient_id), Json(turns), version))
+    except Exception as e:
+        logger.warning(f"Chat history save failed: {e}")
+        return None
+    with _saves_lock:
+        _saves += 1
+        prune = _saves % PRUNE_EVERY == 0
+    if prune:
+        prune_history()
+    return rows[0]['version'] if rows else None
+
+
+def prune_history():
+    """Deletes conversations idle for longer than IDLE_TIMEOUT."""
+    try:
+        execute_query("DELETE FROM chat_history WHERE updated_at <= now() - make_interval(secs => %s)",
+                      (IDLE_TIMEOUT,), name='prune_chat_history')
+    except Exception as e:
+        logger.warning(f"Chat history prune failed: {e}")
@@ -1,6 +1,21 @@
 import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
 from psycopg2.extras import RealDictCursor
+from contextlib import contextmanager
+from collections import deque
+import base64
+import json
+import logging
 import os
+import sys
+import threading
+import time
+from search import build_search_clause, SEARCH_RANK_SQL
+from cache import TTLCache, RecordCache, create_record_store
+from metrics import observe_query
+
+logger = logging.getLogger(__name__)
 
 # Database configuration
 db_config = {
@@ -25,33 +40,461 @@ def get_db_connection():
         )
         return conn
     except Exception as e:
-        print(f"Error connecting to database: {e}")
+        logger.exception("Error connecting to database")
         raise
 
-def execute_query(query, params=None):
-    """Execute SQL query and return results as list of dictionaries"""
-    conn = None
+# Connection pool configuration
+pool_config = {
+    "minconn": int(os.getenv("DB_POOL_MIN", 1)),
+    "maxconn": int(os.getenv("DB_POOL_MAX", 10)),
+    "checkout_timeout": float(os.getenv("DB_POOL_TIMEOUT", 10)),
+    "max_idle": float(os.getenv("DB_POOL_MAX_IDLE", 300)),
+    "health_check_interval": float(os.getenv("DB_POOL_HEALTH_CHECK", 30))
+}
+
+
+class PoolTimeoutError(psycopg2.pool.PoolError):
+    """Raised when no connection becomes available within the checkout timeout."""
+
+
+class ConnectionPool:
+    """Thread-safe pool of reusable PostgreSQL connections.
+
+    Connections are handed out most-recently-used first so that surplus
+    connections age at the bottom of the idle stack and are closed once they
+    have been idle longer than ``max_idle`` (never dropping below ``minconn``).
+    A connection that has been idle longer than ``health_check_interval`` is
+    pinged before it is handed out, and broken connections are replaced.
+    """
+
+    def __init__(self, connect, minconn=1, maxconn=10, checkout_timeout=10.0,
+                 max_idle=300.0, health_check_interval=30.0):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError("Invalid pool size: need 0 <= minconn <= maxconn and maxconn >= 1")
+        self._connect = connect
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.checkout_timeout = checkout_timeout
+        self.max_idle = max_idle
+        self.health_check_interval = health_check_interval
+
+        self._cond = threading.Condition()
+        self._idle = deque()  # (connection, returned_at), most recent on the right
+        self._in_use = set()
+        self._opening = 0
+        self._closed = False
+        self._stats = {
+            "checkouts": 0,
+            "waits": 0,
+            "timeouts": 0,
+            "created": 0,
+            "discarded": 0,
+            "evicted": 0,
+            "checkout_time_total": 0.0,
+            "checkout_time_max": 0.0
+        }
+
+        for _ in range(minconn):
+            self._idle.append((self._new_connection(), time.monotonic()))
+
+    def _new_connection(self):
+        conn = self._connect()
+        with self._cond:
+            self._stats["created"] += 1
+        return conn
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _is_healthy(self, conn, idle_for):
+        if conn.closed:
+            return False
+        if idle_for < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _evict_idle(self, now):
+        """Close connections idle longer than max_idle. Caller holds the lock."""
+        evicted = []
+        while self._idle and len(self._idle) + len(self._in_use) > self.minconn:
+            conn, returned_at = self._idle[0]
+            if now - returned_at < self.max_idle:
+                break
+            self._idle.popleft()
+            evicted.append(conn)
+        self._stats["evicted"] += len(evicted)
+        return evicted
+
+    def getconn(self, timeout=None):
+        """Check out a connection, waiting up to ``timeout`` seconds for one to free up."""
+        timeout = self.checkout_timeout if timeout is None else timeout
+        started = time.monotonic()
+        deadline = started + timeout
+        waited = False
+
+        while True:
+            conn = None
+            idle_for = 0.0
+            open_new = False
+            with self._cond:
+                if self._closed:
+                    raise psycopg2.pool.PoolError("connection pool is closed")
+                now = time.monotonic()
+                evicted = self._evict_idle(now)
+                if self._idle:
+                    conn, returned_at = self._idle.pop()
+                    idle_for = now - returned_at
+                    self._in_use.add(conn)
+                elif len(self._in_use) + self._opening < self.maxconn:
+                    self._opening += 1
+                    open_new = True
+                else:
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        self._stats["timeouts"] += 1
+                        raise PoolTimeoutError(
+                            f"Timed out after {timeout:.1f}s waiting for a database connection "
+                            f"({len(self._in_use)}/{self.maxconn} in use)"
+                        )
+                    if not waited:
+                        waited = True
+                        self._stats["waits"] += 1
+                    self._cond.wait(remaining)
+                    continue
+
+            for stale in evicted:
+                self._close_quietly(stale)
+
+            if open_new:
+                try:
+                    conn = self._new_connection()
+                except Exception:
+                    with self._cond:
+                        self._opening -= 1
+                        self._cond.notify()
+                    raise
+                with self._cond:
+                    self._opening -= 1
+                    self._in_use.add(conn)
+            elif not self._is_healthy(conn, idle_for):
+                with self._cond:
+                    self._in_use.discard(conn)
+                    self._stats["discarded"] += 1
+                    self._cond.notify()
+                self._close_quietly(conn)
+                continue
+
+            elapsed = time.monotonic() - started
+            with self._cond:
+                self._stats["checkouts"] += 1
+                self._stats["checkout_time_total"] += elapsed
+                self._stats["checkout_time_max"] = max(self._stats["checkout_time_max"], elapsed)
+            return conn
+
+    def putconn(self, conn, discard=False):
+        """Return a connection to the pool, rolling back any open transaction."""
+        if not discard and not conn.closed:
+            try:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except Exception:
+                discard = True
+        discard = discard or bool(conn.closed)
+
+        with self._cond:
+            self._in_use.discard(conn)
+            if discard or self._closed:
+                self._stats["discarded"] += 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+                conn = None
+            self._cond.notify()
+        if conn is not None:
+            self._close_quietly(conn)
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """Context manager that checks a connection out and always returns it."""
+        conn = self.getconn(timeout)
+        discard = False
+        try:
+            yield conn
+        except (psycopg2.InterfaceError, psycopg2.OperationalError):
+            discard = True
+            raise
+        finally:
+            self.putconn(conn, discard=discard)
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            idle = [conn for conn, _ in self._idle]
+            self._idle.clear()
+            self._cond.notify_all()
+        for conn in idle:
+            self._close_quietly(conn)
+
+    def stats(self):
+        """Snapshot of pool usage counters; latencies are in milliseconds."""
+        with self._cond:
+            checkouts = self._stats["checkouts"]
+            return {
+                "min_size": self.minconn,
+                "max_size": self.maxconn,
+                "in_use": len(self._in_use),
+                "idle": len(self._idle),
+                "size": len(self._in_use) + len(self._idle),
+                "checkouts": checkouts,
+                "waits": self._stats["waits"],
+                "timeouts": self._stats["timeouts"],
+                "created": self._stats["created"],
+                "discarded": self._stats["discarded"],
+                "evicted": self._stats["evicted"],
+                "avg_checkout_ms": round(self._stats["checkout_time_total"] / checkouts * 1000, 3) if checkouts else 0.0,
+                "max_checkout_ms": round(self._stats["checkout_time_max"] * 1000, 3)
+            }
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """Return the process-wide connection pool, creating it on first use.
+
+    The pool is rebuilt after a fork so worker processes never share sockets
+    inherited from the parent.
+    """
+    global _pool, _pool_pid
+    pid = os.getpid()
+    if _pool is not None and _pool_pid == pid:
+        return _pool
+    with _pool_lock:
+        if _pool is None or _pool_pid != pid:
+            _pool = ConnectionPool(get_db_connection, **pool_config)
+            _pool_pid = pid
+        return _pool
+
+def db_connection():
+    """Check out a pooled connection: ``with db_connection() as conn: ...``"""
+    return get_pool().connection()
+
+def get_pool_stats():
+    """Current connection pool statistics."""
+    return get_pool().stats()
+
+# Rarely-changing lookups (filter options, list counts) shared by all requests in this process
+reference_cache = TTLCache(
+    maxsize=int(os.getenv("REFERENCE_CACHE_SIZE", 512)),
+    default_ttl=float(os.getenv("REFERENCE_CACHE_TTL", 300))
+)
+
+def invalidate_reference_data():
+    """Drop cached lookups derived from patient rows; call after any patient write."""
+    reference_cache.invalidate_namespace('patient_filters')
+    reference_cache.invalidate_namespace('patient_count')
+
+# Patient records behind get_patient_details; shared across workers unless RECORD_CACHE_BACKEND=memory
+record_cache = RecordCache(create_record_store())
+
+def invalidate_patient_records(patient_ids):
+    """Drop cached get_patient_details rows; call after writing or deleting those patients."""
+    record_cache.invalidate(patient_ids)
+
+def get_cache_stats():
+    """Hit/miss counters for the data-layer caches."""
+    return {"reference": reference_cache.stats(), "records": record_cache.stats()}
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+
+def apply_migrations(migrations_dir=MIGRATIONS_DIR):
+    """Apply pending ``migrations/*.sql`` files in filename order.
+
+    Each file runs in its own transaction and is recorded in schema_migrations.
+    An advisory lock keeps concurrently starting processes from racing.
+    Returns the list of newly applied migration names.
+    """
+    applied = []
+    with db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_lock(hashtext('medcare_schema_migrations'))")
+            try:
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS schema_migrations (
+                        version TEXT PRIMARY KEY,
+                        applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                    )
+                """)
+                conn.commit()
+                cursor.execute("SELECT version FROM schema_migrations")
+                done = {row[0] for row in cursor.fetchall()}
+
+                for filename in sorted(os.listdir(migrations_dir)):
+                    if not filename.endswith('.sql') or filename in done:
+                        continue
+                    with open(os.path.join(migrations_dir, filename)) as f:
+                        sql = f.read()
+                    try:
+                        cursor.execute(sql)
+                        cursor.execute("INSERT INTO schema_migrations (version) VALUES (%s)", (filename,))
+                        conn.commit()
+                    except Exception:
+                        conn.rollback()
+                        raise
+                    logger.info(f"Applied migration {filename}")
+                    applied.append(filename)
+            finally:
+                cursor.execute("SELECT pg_advisory_unlock(hashtext('medcare_schema_migrations'))")
+                conn.commit()
+    return applied
+
+def execute_query(query, params=None, name=None):
+    """Execute SQL query and return results as list of dictionaries
+
+    ``name`` labels the query's latency metric (the calling function's name if
+    omitted), so SQL text never ends up in metrics or logs.
+    """
+    name = name or sys._getframe(1).f_code.co_name
+    started = time.perf_counter()
     try:
-        conn = get_db_connection()
-        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute(query, params)
-            results = cursor.fetchall()
-            return results
+        with db_connection() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                cursor.execute(query, params)
+                results = cursor.fetchall() if cursor.description else []
+            conn.commit()
+        observe_query(name, time.perf_counter() - started)
+        return results
     except Exception as e:
-        print(f"Error executing query: {e}")
+        observe_query(name, time.perf_counter() - started, failed=True)
+        logger.error(f"Error executing query {name}: {e}", extra={'query': name})
         raise
-    finally:
-        if conn:
-            conn.close()
 
-def get_patient_list(search='', risk_tier='', age_range='', limit=10, offset=0):
-    """Get list of patients with optional filtering and pagination"""
-    base_query = """
+# Age range filter options mapped to their (inclusive) bounds
+AGE_RANGES = {
+    '18-30': (18, 30),
+    '31-50': (31, 50),
+    '51-70': (51, 70),
+    '70+': (70, None)
+}
+
+def age_range_condition(age_range, column="pa.age"):
+    """SQL condition for an AGE_RANGES key, or None for an unknown/empty range."""
+    if age_range not in AGE_RANGES:
+        return None
+    low, high = AGE_RANGES[age_range]
+    return f"{column} >= {low}" if high is None else f"{column} BETWEEN {low} AND {high}"
+
+# Patient list ordering; matches idx_patient_analysis_list_order (migrations/001)
+LIST_ORDER_COLUMNS = [
+    "COALESCE(pa.risk_tier, 0)",
+    "COALESCE(pa.hospitalization_30d_score, -1)",
+    "pa.DESYNPUF_ID"
+]
+
+COUNT_CACHE_TTL = int(os.getenv("PATIENT_COUNT_CACHE_TTL", 60))
+
+def build_patient_filter_clause(search='', risk_tier='', age_range=''):
+    """Builds the WHERE clause shared by the patient list queries.
+
+    Returns ``(where_sql, params)`` with named psycopg2 parameters. The clause
+    expects ``patient_analysis pa LEFT JOIN patients p``.
+    """
+    conditions = ["1=1"]
+    params = {}
+
+    search_condition, search_params = build_search_clause(search)
+    if search_condition:
+        conditions.append(search_condition)
+        params.update(search_params)
+
+    if risk_tier and risk_tier != '':
+        conditions.append("pa.risk_tier = %(risk_tier)s")
+        params['risk_tier'] = risk_tier
+
+    age_condition = age_range_condition(age_range)
+    if age_condition:
+        conditions.append(age_condition)
+
+    return "WHERE " + " AND ".join(conditions), params
+
+def encode_cursor(row, size):
+    """Opaque page cursor holding a row's ``sort_0..sort_<size-1>`` values."""
+    key = [str(row[f'sort_{i}']) for i in range(size)]
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor, size):
+    padded = cursor + '=' * (-len(cursor) % 4)
+    try:
+        key = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, TypeError) as e:
+        raise ValueError(f"Invalid page cursor: {cursor}") from e
+    if not isinstance(key, list) or len(key) != size:
+        raise ValueError(f"Page cursor does not match the current ordering: {cursor}")
+    return key
+
+def count_patients(search='', risk_tier='', age_range='', exact=False):
+    """Number of patients matching the filters, and whether that number is exact.
+
+    Results are cached for COUNT_CACHE_TTL seconds. On a cache miss the planner's
+    row estimate is used unless an exact count is requested.
+    """
+    cache_key = ('patient_count', search, str(risk_tier), age_range)
+    cached = reference_cache.get(cache_key)
+    if cached and (cached[1] or not exact):
+        return cached
+
+    where_sql, params = build_patient_filter_clause(search, risk_tier, age_range)
+    from_sql = f"FROM patient_analysis pa LEFT JOIN patients p ON pa.DESYNPUF_ID = p.DESYNPUF_ID {where_sql}"
+    if exact:
+        total = execute_query(f"SELECT COUNT(*) {from_sql}", params, name='count_patients_exact')[0]['count']
+    else:
+        plan = execute_query(f"EXPLAIN (FORMAT JSON) SELECT 1 {from_sql}", params,
+                             name='count_patients_estimate')[0]['QUERY PLAN']
+        total = int(plan[0]['Plan']['Plan Rows'])
+
+    reference_cache.set(cache_key, (total, exact), ttl=COUNT_CACHE_TTL)
+    return total, exact
+
+def get_patient_list(search='', risk_tier='', age_range='', limit=10, offset=0, after=None, before=None, exact_count=False):
+    """Get one page of patients with optional filtering.
+
+    Searches are ranked by relevance first, then by the usual risk ordering.
+    Pages are addressed by keyset cursors: pass the ``next_cursor`` of a page as
+    ``after`` or its ``prev_cursor`` as ``before``. ``offset`` is only used when
+    no cursor is given. Returns ``(patients, total_records, page_info)``.
+    """
+    where_sql, params = build_patient_filter_clause(search, risk_tier, age_range)
+    order_columns = ([SEARCH_RANK_SQL] if 'search_term' in params else []) + LIST_ORDER_COLUMNS
+
+    if after or before:
+        key = decode_cursor(after or before, len(order_columns))
+        placeholders = ", ".join(f"%(cursor_{i})s" for i in range(len(key)))
+        where_sql += f" AND ({', '.join(order_columns)}) {'<' if after else '>'} ({placeholders})"
+        params.update({f'cursor_{i}': value for i, value in enumerate(key)})
+        offset = 0
+
+    direction = "ASC" if before else "DESC"
+    order_by = ", ".join(f"sort_{i} {direction}" for i in range(len(order_columns)))
+    sort_select = ",\n        ".join(f"{column} as sort_{i}" for i, column in enumerate(order_columns))
+    params.update(limit=limit + 1, offset=offset)
+
+    query = f"""
     SELECT 
         pa.DESYNPUF_ID as id,
         COALESCE(p.name, 'Patient ' || SUBSTRING(pa.DESYNPUF_ID FROM 1 FOR 8)) as name,
         pa.age,
         pa.risk_tier,
+        {sort_select},
         CONCAT(
             CASE WHEN pa.SP_CHF = 1 THEN 'CHF, ' ELSE '' END,
             CASE WHEN pa.SP_DIABETES = 1 THEN 'Diabetes, ' ELSE '' END,
@@ -61,62 +504,18 @@ def get_patient_list(search='', risk_tier='', age_range='', limit=10, offset=0):
         ) as conditions
     FROM patient_analysis pa
     LEFT JOIN patients p ON pa.DESYNPUF_ID = p.DESYNPUF_ID
-    WHERE 1=1
-    """
-    
-    params = []
-    
-    if search:
-        base_query += " AND (pa.DESYNPUF_ID ILIKE %s OR CAST(pa.age AS TEXT) ILIKE %s OR p.name ILIKE %s)"
-        params.extend([f'%{search}%', f'%{search}%', f'%{search}%'])
-    
-    if risk_tier and risk_tier != '':
-        base_query += " AND pa.risk_tier = %s"
-        params.append(risk_tier)
-    
-    if age_range:
-        if age_range == '18-30':
-            base_query += " AND pa.age BETWEEN 18 AND 30"
-        elif age_range == '31-50':
-            base_query += " AND pa.age BETWEEN 31 AND 50"
-        elif age_range == '51-70':
-            base_query += " AND pa.age BETWEEN 51 AND 70"
-        elif age_range == '70+':
-            base_query += " AND pa.age >= 70"
-    
-    base_query += " ORDER BY pa.risk_tier DESC, pa.hospitalization_30d_score DESC LIMIT %s OFFSET %s"
-    params.extend([limit, offset])
-    
-    count_query = """
-    SELECT COUNT(*) 
-    FROM patient_analysis pa
-    LEFT JOIN patients p ON pa.DESYNPUF_ID = p.DESYNPUF_ID
-    WHERE 1=1
+    {where_sql}
+    ORDER BY {order_by}
+    LIMIT %(limit)s OFFSET %(offset)s
     """
     
-    count_params = []
-    if search:
-        count_query += " AND (pa.DESYNPUF_ID ILIKE %s OR CAST(pa.age AS TEXT) ILIKE %s OR p.name ILIKE %s)"
-        count_params.extend([f'%{search}%', f'%{search}%', f'%{search}%'])
-    
-    if risk_tier and risk_tier != '':
-        count_query += " AND pa.risk_tier = %s"
-        count_params.append(risk_tier)
-    
-    if age_range:
-        if age_range == '18-30':
-            count_query += " AND pa.age BETWEEN 18 AND 30"
-        elif age_range == '31-50':
-            count_query += " AND pa.age BETWEEN 31 AND 50"
-        elif age_range == '51-70':
-            count_query += " AND pa.age BETWEEN 51 AND 70"
-        elif age_range == '70+':
-            count_query += " AND pa.age >= 70"
-    
-    total_count = execute_query(count_query, count_params)
-    total_records = total_count[0]['count'] if total_count else 0
-    
-    results = execute_query(base_query, params)
+    results = execute_query(query, params)
+    has_more = len(results) > limit
+    results = results[:limit]
+    if before:
+        results.reverse()
+
+    total_records, count_is_exact = count_patients(search, risk_tier, age_range, exact=exact_count)
     
     formatted_results = []
     for row in results:
@@ -132,11 +531,55 @@ def get_patient_list(search='', risk_tier='', age_range='', limit=10, offset=0):
             "risk_tier_display": f"Tier {risk_tier_str}",
             "conditions": row['conditions'].rstrip(', ') if row['conditions'] else 'No conditions'
         })
+
+    # Going forward there is a next page if we over-fetched; going back there always is one
+    has_next = has_more if not before else True
+    has_prev = bool(after or offset) or (has_more if before else False)
+    page_info = {
+        "next_cursor": encode_cursor(results[-1], len(order_columns)) if results and has_next else None,
+        "prev_cursor": encode_cursor(results[0], len(order_columns)) if results and has_prev else None,
+        "count_is_exact": count_is_exact
+    }
     
-    return formatted_results, total_records
+    return formatted_results, total_records, page_info
+
+EXPORT_BATCH_SIZE = 2000
+
+def iter_patient_export(search='', risk_tier='', age_range='', batch_size=EXPORT_BATCH_SIZE):
+    """Yields ``(columns, rows)`` batches of every patient matching the list filters, in list order.
+
+    Rows stream from a server-side cursor on a dedicated connection, so memory
+    holds one batch however many patients match. Closing the generator closes
+    the connection.
+    """
+    where_sql, params = build_patient_filter_clause(search, risk_tier, age_range)
+    order_by = ", ".join(f"{column} DESC" for column in LIST_ORDER_COLUMNS)
+    conn = get_db_connection()
+    try:
+        with conn.cursor(name='patient_export') as cursor:
+            cursor.itersize = batch_size
+            cursor.execute(f"""
+                SELECT pa.*, p.name
+                FROM patient_analysis pa
+                LEFT JOIN patients p ON pa.DESYNPUF_ID = p.DESYNPUF_ID
+                {where_sql}
+                ORDER BY {order_by}
+            """, params)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    return
+                yield [column[0] for column in cursor.description], rows
+    finally:
+        conn.close()
+
+FILTERS_CACHE_TTL = int(os.getenv("PATIENT_FILTERS_CACHE_TTL", 3600))
 
 def get_patient_filters():
-    """Get available filter options for patients"""
+    """Get available filter options for patients (cached for FILTERS_CACHE_TTL seconds)"""
+    return reference_cache.get_or_load(('patient_filters',), _load_patient_filters, ttl=FILTERS_CACHE_TTL)
+
+def _load_patient_filters():
     risk_tiers_query = "SELECT DISTINCT risk_tier FROM patient_analysis WHERE risk_tier IS NOT NULL ORDER BY risk_tier"
     risk_tiers = execute_query(risk_tiers_query)
     
@@ -148,34 +591,73 @@ def get_patient_filters():
     
     return {
         "risk_tiers": sorted(numeric_tiers),
-        "age_ranges": ['18-30', '31-50', '51-70', '70+']
+        "age_ranges": list(AGE_RANGES)
+    }
+
+def get_dashboard_data(risk_tier='', age_range=''):
+    """Aggregates for the dashboard charts, read from the dashboard_rollup table.
+
+    One query sums the rollup rows per tier for the age filter; the tier filter
+    is then applied in Python, since the tier distribution ignores it.
+    """
+    age_condition = age_range_condition(age_range, column="age")
+    query = f"""
+    SELECT risk_tier, SUM(patient_count) as count,
+        SUM(sum_30d) as sum_30d, SUM(n_30d) as n_30d,
+        SUM(sum_60d) as sum_60d, SUM(n_60d) as n_60d,
+        SUM(sum_90d) as sum_90d, SUM(n_90d) as n_90d,
+        SUM(total_costs) as total_costs, SUM(total_savings) as total_savings
+    FROM dashboard_rollup
+    WHERE patient_count > 0 {'AND ' + age_condition if age_condition else ''}
+    GROUP BY risk_tier
+    ORDER BY risk_tier
+    """
+    rows = execute_query(query)
+
+    # Tier 0 holds patients without a tier: counted in the averages, not in the distribution
+    selected = [row for row in rows if not risk_tier or row['risk_tier'] == int(risk_tier)]
+
+    def average(horizon):
+        total = sum(row[f'n_{horizon}'] for row in selected)
+        return float(sum(row[f'sum_{horizon}'] for row in selected) / total) if total else 0
+
+    return {
+        'risk_scores': {
+            'avg_30d': average('30d'),
+            'avg_60d': average('60d'),
+            'avg_90d': average('90d')
+        },
+        'risk_tier_distribution': [
+            {'risk_tier': row['risk_tier'], 'count': int(row['count'])}
+            for row in rows if row['risk_tier'] != 0
+        ],
+        'intervention_roi': {
+            'total_costs': float(sum(row['total_costs'] for row in selected)),
+            'total_savings': float(sum(row['total_savings'] for row in selected))
+        }
     }
 
 def delete_patient(patient_id):
     """Delete a patient from both tables"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        delete_query_analysis = "DELETE FROM patient_analysis WHERE DESYNPUF_ID = %s"
-        cursor.execute(delete_query_analysis, (patient_id,))
-        
-        delete_query_patients = "DELETE FROM patients WHERE DESYNPUF_ID = %s"
-        cursor.execute(delete_query_patients, (patient_id,))
-        
-        conn.commit()
-        cursor.close()
-        conn.close()
+        with db_connection() as conn:
+            with conn.cursor() as cursor:
+                delete_query_analysis = "DELETE FROM patient_analysis WHERE DESYNPUF_ID = %s"
+                cursor.execute(delete_query_analysis, (patient_id,))
+                
+                delete_query_patients = "DELETE FROM patients WHERE DESYNPUF_ID = %s"
+                cursor.execute(delete_query_patients, (patient_id,))
+            
+            conn.commit()
         
+        invalidate_patient_records([patient_id])
+        invalidate_reference_data()
         return True
     except Exception as e:
-        print(f"Error deleting patient: {e}")
+        logger.exception("Error deleting patient")
         return False
     
-def get_patient_details(patient_id):
-    """Get detailed information for a specific patient by joining tables."""
-    query = """
-    SELECT 
+PATIENT_DETAILS_COLUMNS = """
         pa.*,
         p.name,
         CASE WHEN pa.gender_male = 1 THEN 'Male' ELSE 'Female' END as gender,
@@ -183,11 +665,24 @@ def get_patient_details(patient_id):
             WHEN pa.race_white = 1 THEN 'White' 
             WHEN pa.race_black = 1 THEN 'Black'
             ELSE 'Other' 
-        END as race
+        END as race"""
+
+PATIENT_DETAILS_FROM = """
     FROM patient_analysis pa
     LEFT JOIN patients p ON pa.DESYNPUF_ID = p.DESYNPUF_ID
-    WHERE pa.DESYNPUF_ID = %s
     """
-    
-    result = execute_query(query, (patient_id,))
-    return result[0] if result else None
\ No newline at end of file
+
+PATIENT_DETAILS_SELECT = "\n    SELECT " + PATIENT_DETAILS_COLUMNS + PATIENT_DETAILS_FROM
+
+PATIENT_DETAILS_QUERY = PATIENT_DETAILS_SELECT + "WHERE pa.DESYNPUF_ID = %s"
+
+def get_patient_details(patient_id):
+    """Get detailed information for a specific patient by joining tables.
+
+    Served from ``record_cache``; writers call invalidate_patient_records.
+    """
+    return record_cache.get_or_load(patient_id, lambda: _load_patient_details(patient_id))
+
+def _load_patient_details(patient_id):
+    result = execute_query(PATIENT_DETAILS_QUERY, (patient_id,))
+    return dict(result[0]) if result else None
@@ -0,0 +1,51 @@
+"""gunicorn settings: ``gunicorn app:app`` (or ``-k uvicorn.workers.UvicornWorker asgi:application``).
+
+The app is imported once in the master (preload_app), so the models are
+loaded a single time and every worker shares those pages copy-on-write.
+Each worker reports its resident memory once it is ready and starts its
+own watcher for newly activated model versions and its email outbox
+senders.
+
+Metrics run in prometheus_client's multiprocess mode: PROMETHEUS_MULTIPROC_DIR
+is set (and emptied) here, before the app imports prometheus_client, and a
+worker's files are marked dead when it exits.
+"""
+import gc
+import os
+import shutil
+import tempfile
+
+if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = os.path.join(tempfile.gettempdir(), "medcare-metrics")
+    # Values left by a previous server would otherwise be added to this one's
+    shutil.rmtree(os.environ["PROMETHEUS_MULTIPROC_DIR"], ignore_errors=True)
+os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+
+from logs import configure_logging
+from memory import report_memory
+
+configure_logging()
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:5000")
+workers = int(os.getenv("WEB_CONCURRENCY", 4))
+threads = int(os.getenv("GUNICORN_THREADS", 4))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 120))
+preload_app = True
+
+
+def when_ready(server):
+    # Move everything loaded so far out of the collector's reach; otherwise the
+    # first GC pass in each worker writes to every object header and un-shares the pages
+    gc.freeze()
+    report_memory("gunicorn master")
+
+
+def post_worker_init(worker):
+    from app import start_background_threads
+    start_background_threads()
+    report_memory(f"gunicorn worker {worker.age}")
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
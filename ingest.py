@@ -0,0 +1,238 @@
+import io
+import logging
+import os
+import time
+import pandas as pd
+from data import db_connection, invalidate_reference_data, invalidate_patient_records
+from predictor import predictor, score_frame, CONDITION_FIELDS, HIGH_IMPACT_CONDITIONS, ANALYSIS_COLUMNS
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 5000
+MAX_REPORTED_ERRORS = 100
+
+# Values accepted as "condition present" in SP_* columns of an uploaded file
+TRUTHY_VALUES = ['1', '1.0', 'true', 't', 'yes', 'y', 'on']
+
+# Raw numeric inputs besides the model feature columns
+INPUT_COLUMNS = ['age', 'gender_male', 'race_white', 'race_black', 'chronic_condition_count',
+                 'inpatient_admissions', 'inpatient_days', 'outpatient_visits', 'total_medicare_costs']
+
+# Recomputed server-side, so whatever the file contains is ignored
+DERIVED_COLUMNS = ['age_65_74', 'age_75_84', 'age_85_plus', 'high_impact_conditions',
+                   'prior_hospitalization', 'frequent_ed_user', 'high_cost_patient']
+
+
+def read_upload_chunks(stream, filename, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yields DataFrames of at most chunk_size rows from an uploaded CSV or Parquet file."""
+    extension = os.path.splitext(filename or '')[1].lower()
+    if extension == '.csv':
+        for chunk in pd.read_csv(stream, chunksize=chunk_size, dtype=str, skipinitialspace=True):
+            yield chunk
+    elif extension in ('.parquet', '.pq'):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ValueError("Parquet uploads require the pyarrow package to be installed")
+        for batch in pq.ParquetFile(stream).iter_batches(batch_size=chunk_size):
+            yield batch.to_pandas()
+    else:
+        raise ValueError(f"Unsupported file type '{extension or filename}'. Upload a .csv or .parquet file.")
+
+
+def derive_features_frame(chunk, row_offset=0):
+    """Column-wise equivalent of the feature derivation in process_uploaded_data.
+
+    Returns ``(frame, errors)``: the valid rows with lowercase column names, and a
+    list of ``{'row', 'id', 'error'}`` dicts for rows that were dropped. Row numbers
+    are 1-based data rows of the uploaded file.
+    """
+    frame = chunk.rename(columns=lambda c: str(c).strip().lower())
+    frame = frame.loc[:, ~frame.columns.duplicated(keep='last')].copy()
+    frame.index = pd.RangeIndex(row_offset + 1, row_offset + 1 + len(frame))
+
+    if 'desynpuf_id' not in frame.columns:
+        raise ValueError("Uploaded file is missing the DESYNPUF_ID column")
+
+    ids = frame['desynpuf_id']
+    frame['desynpuf_id'] = ids.where(ids.notna(), '').astype(str).str.strip()
+
+    problems = pd.Series('', index=frame.index)
+    problems[frame['desynpuf_id'] == ''] = 'missing DESYNPUF_ID; '
+
+    condition_columns = [field.lower() for field in CONDITION_FIELDS]
+    numeric_columns = set(INPUT_COLUMNS) | {c.lower() for c in predictor.feature_columns}
+    numeric_columns -= set(condition_columns) | set(DERIVED_COLUMNS)
+
+    for column in sorted(numeric_columns & set(frame.columns)):
+        raw = frame[column]
+        values = pd.to_numeric(raw, errors='coerce')
+        blank = raw.isna() | (raw.astype(str).str.strip() == '')
+        invalid = values.isna() & ~blank
+        problems[invalid] += f"non-numeric {column}; "
+        frame[column] = values.fillna(0)
+
+    errors = [
+        {'row': int(row), 'id': frame.at[row, 'desynpuf_id'] or None, 'error': message.rstrip('; ')}
+        for row, message in problems[problems != ''].items()
+    ]
+    frame = frame[problems == ''].drop_duplicates('desynpuf_id', keep='last')
+
+    for column in condition_columns:
+        if column in frame.columns:
+            frame[column] = frame[column].astype(str).str.strip().str.lower().isin(TRUTHY_VALUES).astype(int)
+        else:
+            frame[column] = 0
+
+    def column_or_zero(name):
+        return frame[name] if name in frame.columns else pd.Series(0, index=frame.index)
+
+    age = column_or_zero('age')
+    frame['age_65_74'] = ((age >= 65) & (age < 75)).astype(int)
+    frame['age_75_84'] = ((age >= 75) & (age < 85)).astype(int)
+    frame['age_85_plus'] = (age >= 85).astype(int)
+
+    frame['high_impact_conditions'] = frame[[c.lower() for c in HIGH_IMPACT_CONDITIONS]].sum(axis=1)
+    frame['prior_hospitalization'] = (column_or_zero('inpatient_admissions') > 0).astype(int)
+    frame['frequent_ed_user'] = (column_or_zero('outpatient_visits') > 10).astype(int)
+    frame['high_cost_patient'] = (column_or_zero('total_medicare_costs') > 20000).astype(int)
+
+    # The upload form fills these in the browser; mirror it when a file leaves them out
+    if 'race_other' not in frame.columns:
+        frame['race_other'] = ((column_or_zero('race_white') == 0) & (column_or_zero('race_black') == 0)).astype(int)
+    total_costs = column_or_zero('total_medicare_costs')
+    if 'medreimb_ip' not in frame.columns:
+        frame['medreimb_ip'] = column_or_zero('inpatient_days') * 1000
+    if 'medreimb_op' not in frame.columns:
+        frame['medreimb_op'] = total_costs * 0.4
+    if 'medreimb_car' not in frame.columns:
+        frame['medreimb_car'] = total_costs * 0.3
+
+    return frame, errors
+
+
+def _copy_frame(cursor, table, frame, columns):
+    """Streams ``frame[columns]`` into ``table`` with COPY ... FROM STDIN."""
+    out = frame.reindex(columns=columns)
+    for column in columns:
+        values = out[column]
+        # Whole-number floats go out as integers so COPY accepts them for integer columns
+        if pd.api.types.is_float_dtype(values) and (values.dropna() % 1 == 0).all():
+            out[column] = values.astype('Int64')
+
+    buffer = io.StringIO()
+    out.to_csv(buffer, header=False, index=False)
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+
+def upsert_analysis_frame(conn, frame, columns=ANALYSIS_COLUMNS, insert_missing=True, skip_unchanged=False):
+    """Upserts scored rows into patients and patient_analysis in one set-based pass.
+
+    Rows are COPYed into temporary staging tables shaped like the targets, then
+    merged with one UPDATE ... FROM and one INSERT ... WHERE NOT EXISTS per table.
+    Without ``insert_missing`` only existing patient_analysis rows are updated;
+    with ``skip_unchanged`` rows whose values are all equal are left alone, so
+    their triggers do not fire. The caller owns the transaction. Returns
+    ``(inserted, updated)`` for patient_analysis.
+    """
+    column_list = ', '.join(columns)
+    update_cols = [col for col in columns if col != 'desynpuf_id']
+
+    with conn.cursor() as cursor:
+        if 'name' in frame.columns:
+            names = frame.loc[frame['name'].notna() & (frame['name'].astype(str).str.strip() != ''), ['desynpuf_id', 'name']]
+            if not names.empty:
+                cursor.execute("""
+                    CREATE TEMP TABLE staging_patients ON COMMIT DROP
+                    AS SELECT desynpuf_id, name FROM patients WITH NO DATA
+                """)
+                _copy_frame(cursor, 'staging_patients', names, ['desynpuf_id', 'name'])
+                cursor.execute("""
+                    UPDATE patients p SET name = s.name
+                    FROM staging_patients s WHERE p.desynpuf_id = s.desynpuf_id
+                """)
+                cursor.execute("""
+                    INSERT INTO patients (desynpuf_id, name)
+                    SELECT s.desynpuf_id, s.name FROM staging_patients s
+                    WHERE NOT EXISTS (SELECT 1 FROM patients p WHERE p.desynpuf_id = s.desynpuf_id)
+                """)
+
+        cursor.execute(f"""
+            CREATE TEMP TABLE staging_patient_analysis ON COMMIT DROP
+            AS SELECT {column_list} FROM patient_analysis WITH NO DATA
+        """)
+        _copy_frame(cursor, 'staging_patient_analysis', frame, columns)
+
+        set_clause = ", ".join(f"{col} = s.{col}" for col in update_cols)
+        changed = ""
+        if skip_unchanged:
+            changed = (f" AND ({', '.join('pa.' + col for col in update_cols)})"
+                       f" IS DISTINCT FROM ({', '.join('s.' + col for col in update_cols)})")
+        cursor.execute(f"""
+            UPDATE patient_analysis pa SET {set_clause}
+            FROM staging_patient_analysis s WHERE pa.desynpuf_id = s.desynpuf_id{changed}
+        """)
+        updated = cursor.rowcount
+        inserted = 0
+        if insert_missing:
+            cursor.execute(f"""
+                INSERT INTO patient_analysis ({column_list})
+                SELECT {', '.join('s.' + col for col in columns)} FROM staging_patient_analysis s
+                WHERE NOT EXISTS (SELECT 1 FROM patient_analysis pa WHERE pa.desynpuf_id = s.desynpuf_id)
+            """)
+            inserted = cursor.rowcount
+
+    return inserted, updated
+
+
+def ingest_upload(stream, filename, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Scores and stores every row of an uploaded file, one chunk per transaction.
+
+    Returns a report with row counts, throughput and (up to MAX_REPORTED_ERRORS)
+    row-level errors. A chunk that fails to store is reported as a whole and
+    ingestion continues with the next one.
+    """
+    started = time.perf_counter()
+    report = {'rows_read': 0, 'rows_stored': 0, 'inserted': 0, 'updated': 0,
+              'rows_failed': 0, 'chunks': 0, 'errors': []}
+
+    def add_errors(errors):
+        room = MAX_REPORTED_ERRORS - len(report['errors'])
+        if room > 0:
+            report['errors'].extend(errors[:room])
+
+    for chunk in read_upload_chunks(stream, filename, chunk_size):
+        row_offset = report['rows_read']
+        report['rows_read'] += len(chunk)
+        report['chunks'] += 1
+
+        frame, errors = derive_features_frame(chunk, row_offset)
+        report['rows_failed'] += len(errors)
+        add_errors(errors)
+        if frame.empty:
+            continue
+
+        try:
+            score_frame(frame)
+            with db_connection() as conn:
+                inserted, updated = upsert_analysis_frame(conn, frame)
+                conn.commit()
+            invalidate_patient_records(frame['desynpuf_id'])
+            invalidate_reference_data()
+            report['rows_stored'] += len(frame)
+            report['inserted'] += inserted
+            report['updated'] += updated
+        except Exception as e:
+            logger.exception(f"Error storing upload chunk {report['chunks']}")
+            report['rows_failed'] += len(frame)
+            add_errors([{'rows': f"{row_offset + 1}-{report['rows_read']}", 'error': str(e)}])
+
+    elapsed = time.perf_counter() - started
+    report['elapsed_seconds'] = round(elapsed, 3)
+    report['rows_per_sec'] = round(report['rows_read'] / elapsed, 1) if elapsed > 0 else 0.0
+    logger.info(f"Bulk upload {filename}: {report['rows_stored']}/{report['rows_read']} rows stored "
+                f"in {elapsed:.2f}s ({report['rows_per_sec']} rows/sec)",
+                extra={'upload': filename, 'rows_read': report['rows_read'], 'rows_stored': report['rows_stored'],
+                       'seconds': round(elapsed, 3)})
+    return report
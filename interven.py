@@ -1,13 +1,24 @@
+import asyncio
+import logging
 import os
-import smtplib
-import ssl
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from email.mime.base import MIMEBase
-from email import encoders
+from email.mime.application import MIMEApplication
 import google.generativeai as genai
 from dotenv import load_dotenv
 from fpdf import FPDF
+from ai_cache import content_key, get_cached_content, store_content
+from chat_history import (IDLE_TIMEOUT as CHAT_IDLE_TIMEOUT, gemini_history, history_turns, history_version,
+                          load_history, save_history)
+from outbox import enqueue_email
+from patient_context import build_patient_context, estimate_tokens
+from metrics import LLM_REQUEST_SECONDS, LLM_STREAM_CANCELS, PDF_RENDER_SECONDS, observe_llm_usage, timed_llm_call
+
+logger = logging.getLogger(__name__)
 
 # --- Configuration ---
 # Load environment variables from a .env file (e.g., GOOGLE_API_KEY, SENDER_EMAIL)
@@ -20,9 +31,11 @@ try:
         raise ValueError("GOOGLE_API_KEY not found in environment variables.")
     genai.configure(api_key=api_key)
 except ValueError as e:
-    print(f"AI Initialization Error: {e}")
+    logger.warning(f"AI initialization error: {e}")
     # The app will run, but any AI-dependent features will fail.
 
+MODEL_NAME = "gemini-2.5-flash"
+
 # --- System Instructions for AI Models ---
 CHATBOT_SYSTEM_INSTRUCTION = """You are an AI assistant specialized in patient risk analysis and intervention planning. Your task is to analyze patient medical history, risk factors, and current conditions to provide accurate intervention recommendations.
 
@@ -60,63 +73,342 @@ The plan must include these sections:
 
 # --- Helper function ---
 def _format_patient_context(patient_data):
-    """Formats the patient data dictionary into a readable string for the AI prompt."""
-    if not patient_data:
-        return "No patient data available."
-    
-    details = ["**Patient Record:**"]
-    # Using a comprehensive list of fields for full context
-    for key, value in patient_data.items():
-        clean_key = key.replace('_', ' ').title()
-        
-        # Custom formatting for better readability
-        if 'risk' in key and isinstance(value, float):
-            display_value = f"{value:.1%}"
-        elif key.startswith('sp_') and value in [0, 1]:
-             display_value = 'Yes' if value == 1 else 'No'
-        else:
-            display_value = value if value is not None else "N/A"
-        
-        details.append(f"- **{clean_key}:** {display_value}")
-            
-    return "\n".join(details)
+    """Formats the patient data dictionary into a compact, token-budgeted string for the AI prompt."""
+    return build_patient_context(patient_data)
+
+SUMMARY_PROMPT = "Generate the summary for this patient:"
+INTERVENTION_PROMPT = "Generate the intervention plan for the following patient:"
+
+def _prompt_and_cache_key(instruction, prompt_prefix, patient_data):
+    prompt = f"{prompt_prefix}\n{_format_patient_context(patient_data)}"
+    return prompt, content_key(MODEL_NAME, instruction, prompt)
+
+def summary_cache_key(patient_data):
+    """The ai_content_cache key get_ai_summary uses for this patient record."""
+    return _prompt_and_cache_key(SUMMARY_SYSTEM_INSTRUCTION, SUMMARY_PROMPT, patient_data)[1]
+
+def intervention_cache_key(patient_data):
+    """The ai_content_cache key generate_intervention_plan uses for this patient record."""
+    return _prompt_and_cache_key(INTERVENTION_PLAN_INSTRUCTION, INTERVENTION_PROMPT, patient_data)[1]
+
+def _generate_cached(kind, patient_data, instruction, prompt_prefix):
+    """Returns generated text for the patient, from ai_content_cache when the same
+    model, instruction and patient context were seen before. Only successful
+    generations are cached; errors propagate to the caller."""
+    prompt, cache_key = _prompt_and_cache_key(instruction, prompt_prefix, patient_data)
+    cached = get_cached_content(cache_key)
+    if cached is not None:
+        return cached
+
+    model = genai.GenerativeModel(model_name=MODEL_NAME, system_instruction=instruction)
+    with timed_llm_call(kind):
+        response = model.generate_content(prompt)
+        text = response.text
+    observe_llm_usage(kind, response)
+    if text and patient_data:
+        store_content(cache_key, patient_data.get('desynpuf_id'), kind, MODEL_NAME, text)
+    return text
 
 # --- Chatbot Functions ---
-def initialize_chat(patient_data=None):
-    """Initializes the GenerativeModel for the chatbot with full patient context."""
+CHAT_MAX_SESSIONS = int(os.getenv("CHAT_MAX_SESSIONS", 500))
+# Gemini only caches content above a minimum size (1024 tokens for gemini-2.5-flash)
+CONTEXT_CACHE_MIN_TOKENS = int(os.getenv("CHAT_CONTEXT_CACHE_MIN_TOKENS", 1024))
+CONTEXT_CACHE_ENABLED = os.getenv("CHAT_CONTEXT_CACHING", "1") not in ("0", "false", "no")
+
+def chat_system_instruction(patient_data):
+    """The chatbot's system instruction for a patient: the standing instruction plus the patient context."""
+    return CHATBOT_SYSTEM_INSTRUCTION + "\n\n" + _format_patient_context(patient_data)
+
+def _turn_tokens(turns):
+    return sum(estimate_tokens(turn['text']) for turn in turns)
+
+def _create_context_cache(system_instruction, turns, ttl):
+    """Uploads the chat's system instruction and the conversation ``turns`` so far as Gemini
+    cached content, or returns None when together they are too small to cache or the API refuses."""
+    if not CONTEXT_CACHE_ENABLED or estimate_tokens(system_instruction) + _turn_tokens(turns) < CONTEXT_CACHE_MIN_TOKENS:
+        return None
     try:
-        patient_context = _format_patient_context(patient_data)
-        model = genai.GenerativeModel(
-            model_name="gemini-2.5-flash",
-            system_instruction=CHATBOT_SYSTEM_INSTRUCTION + "\n\n" + patient_context
+        return genai.caching.CachedContent.create(
+            model=MODEL_NAME, system_instruction=system_instruction, contents=gemini_history(turns) or None, ttl=ttl
         )
-        chat = model.start_chat(history=[])
+    except Exception as e:
+        logger.warning(f"Context caching unavailable, sending patient context inline: {e}")
+        return None
+
+def initialize_chat(system_instruction, history=None, context_cache=None):
+    """Starts a Gemini chat with the chatbot's system instruction and ``history``.
+
+    With ``context_cache`` the instruction (and the turns cached with it) come
+    from Gemini cached content instead of being sent with every message, and
+    ``history`` holds only the turns after them.
+    """
+    try:
+        if context_cache is not None:
+            model = genai.GenerativeModel.from_cached_content(context_cache)
+        else:
+            model = genai.GenerativeModel(model_name=MODEL_NAME, system_instruction=system_instruction)
+        chat = model.start_chat(history=history or [])
         return chat
     except Exception as e:
-        print(f"An error occurred during model initialization: {e}")
+        logger.exception("An error occurred during model initialization")
         return None
 
+class ChatSession:
+    """One user's conversation about one patient, as of chat_history ``version``.
+
+    ``cached_turns`` went to Gemini with the system instruction in
+    ``context_cache``; ``chat.history`` holds the turns after them.
+    """
+
+    def __init__(self, key, chat, patient_data, system_instruction, context_cache, cached_turns, expires_at, version):
+        self.key = key
+        self.chat = chat
+        self.patient_data = dict(patient_data)
+        self.system_instruction = system_instruction
+        self.context_cache = context_cache
+        self.cached_turns = cached_turns
+        self.expires_at = expires_at
+        self.version = version
+        self.saved_turns = len(self.turns())
+        self.last_used = time.monotonic()
+        # ChatSession objects are not thread-safe; hold this while sending
+        self.lock = threading.Lock()
+
+    def turns(self):
+        """The whole conversation as stored in chat_history."""
+        return self.cached_turns + history_turns(self.chat.history)
+
+class ChatSessionManager:
+    """Live chat sessions keyed by (user, patient id), backed by the shared chat_history table.
+
+    The conversation itself lives in chat_history, so a follow-up message
+    continues it on whichever worker receives it. Each message costs one
+    lookup of the stored version; a live session is reused while that version
+    and the patient record match, and otherwise rebuilt from the stored turns,
+    as it is when its cached context expires. Callers pass the session to
+    ``save`` after a completed reply.
+
+    Gemini bills every token of a message's request, which includes the
+    system instruction and the history, except what comes from cached
+    content. The patient context alone is too small to cache, so it is sent
+    with the first messages; once the instruction and the turns not yet
+    cached reach CONTEXT_CACHE_MIN_TOKENS, the conversation so far is cached
+    and later messages send only the turns after it.
+
+    Bounded by ``max_sessions`` (least recently used evicted first) and
+    ``idle_timeout`` seconds without a message.
+    """
+
+    def __init__(self, max_sessions=CHAT_MAX_SESSIONS, idle_timeout=CHAT_IDLE_TIMEOUT):
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"created": 0, "reused": 0, "rebuilt": 0, "synced": 0, "evicted": 0, "cached": 0,
+                       "save_conflicts": 0}
+
+    def get(self, user_key, patient_data):
+        """Returns the ChatSession for this user and patient, up to date with chat_history, or None."""
+        key = (str(user_key), str(patient_data.get('desynpuf_id')))
+        stored_version = history_version(*key)
+        now = time.monotonic()
+
+        with self._lock:
+            stale = self._pop_idle(now)
+            session = self._sessions.get(key)
+            current = session is not None and (stored_version is None or session.version == stored_version)
+            reuse = current and session.patient_data == patient_data and session.expires_at > now
+            if reuse:
+                session.last_used = now
+                self._sessions.move_to_end(key)
+                self._stats["reused"] += 1
+        if reuse:
+            self._release(stale)
+            return session
+
+        if current:
+            # Only the patient record or the cached context changed; this worker has the conversation
+            turns, version = session.turns(), session.version
+        else:
+            # Another worker may have replied since this one last did; the stored turns are the conversation
+            stored = load_history(*key) if stored_version else ([], 0)
+            if stored is None:
+                # The store is unreachable: carry on with what this worker has
+                stored = (session.turns(), session.version) if session is not None else ([], 0)
+            turns, version = stored
+        system_instruction = chat_system_instruction(patient_data)
+        context_cache = _create_context_cache(system_instruction, turns, self.idle_timeout)
+        cached_turns = turns if context_cache is not None else []
+        chat = initialize_chat(system_instruction, history=gemini_history(turns[len(cached_turns):]),
+                               context_cache=context_cache)
+        if chat is None:
+            self._release(stale + ([context_cache] if context_cache else []))
+            return None
+        # Rebuild before the cached context expires server-side
+        expires_at = now + self.idle_timeout if context_cache is not None else float('inf')
+        new_session = ChatSession(key, chat, patient_data, system_instruction, context_cache, cached_turns,
+                                  expires_at, version)
+
+        with self._lock:
+            replaced = self._sessions.pop(key, None)
+            if replaced is not None:
+                stale.append(replaced.context_cache)
+                self._stats["rebuilt" if current else "synced"] += 1
+            else:
+                self._stats["created"] += 1
+            self._sessions[key] = new_session
+            while len(self._sessions) > self.max_sessions:
+                _, evicted = self._sessions.popitem(last=False)
+                stale.append(evicted.context_cache)
+                self._stats["evicted"] += 1
+        self._release(stale)
+        return new_session
+
+    def save(self, session):
+        """Stores the session's history after a completed reply; call while holding ``session.lock``.
+
+        A reply that failed adds no turns and saves nothing. If another worker
+        saved a reply to the same conversation first, this one is dropped and
+        the session discarded, so the next message starts from the stored turns.
+        """
+        turns = session.turns()
+        if len(turns) <= session.saved_turns or turns[-1]['role'] != 'model':
+            return
+        version = save_history(*session.key, turns, session.version)
+        if version is None:
+            with self._lock:
+                self._stats["save_conflicts"] += 1
+            self.discard(*session.key)
+            return
+        session.version = version
+        session.saved_turns = len(turns)
+        self._cache_turns(session, turns)
+
+    def _cache_turns(self, session, turns):
+        """Moves what every message resends into new cached content once there is enough of it to cache."""
+        resent = _turn_tokens(turns[len(session.cached_turns):])
+        if session.context_cache is None:
+            resent += estimate_tokens(session.system_instruction)
+        if resent < CONTEXT_CACHE_MIN_TOKENS:
+            return
+        context_cache = _create_context_cache(session.system_instruction, turns, self.idle_timeout)
+        if context_cache is None:
+            return
+        chat = initialize_chat(session.system_instruction, context_cache=context_cache)
+        if chat is None:
+            self._release([context_cache])
+            return
+        replaced = session.context_cache
+        session.chat, session.context_cache, session.cached_turns = chat, context_cache, turns
+        session.expires_at = time.monotonic() + self.idle_timeout
+        with self._lock:
+            self._stats["cached"] += 1
+        self._release([replaced])
+
+    def discard(self, user_key, patient_id):
+        with self._lock:
+            session = self._sessions.pop((str(user_key), str(patient_id)), None)
+        if session is not None:
+            self._release([session.context_cache])
+
+    def _pop_idle(self, now):
+        idle = [key for key, s in self._sessions.items() if now - s.last_used > self.idle_timeout]
+        self._stats["evicted"] += len(idle)
+        return [self._sessions.pop(key).context_cache for key in idle]
+
+    @staticmethod
+    def _release(context_caches):
+        # Cached contents also expire on their own; deleting early just stops the storage billing
+        for context_cache in context_caches:
+            if context_cache is None:
+                continue
+            try:
+                context_cache.delete()
+            except Exception as e:
+                logger.warning(f"Could not delete cached chat context: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {"sessions": len(self._sessions), "max_sessions": self.max_sessions, **self._stats}
+
 def get_ai_response(chat_session, user_input):
     """Sends the user's message to the AI chatbot and gets a response."""
     try:
-        response = chat_session.send_message(user_input)
-        return response.text
+        with timed_llm_call('chat'):
+            response = chat_session.send_message(user_input)
+            text = response.text
+        observe_llm_usage('chat', response)
+        return text
     except Exception as e:
         return f"Error getting AI response: {str(e)}"
 
+def _cancel_stream(response, kind):
+    """Stops generation (and billing) of a stream the client abandoned.
+
+    The SDK has no public cancel: this closes the gRPC call the response
+    iterates over, which google-generativeai 0.8.5 (pinned in requirements.txt)
+    keeps in ``response._iterator``. If an upgrade moves it, the failure is
+    logged and counted in LLM_STREAM_CANCELS instead of passing silently.
+    """
+    cancel = getattr(getattr(response, '_iterator', None), 'cancel', None)
+    if cancel is None:
+        logger.error(f"Cannot cancel abandoned {kind} AI stream: the response has no _iterator.cancel; "
+                     "generation continues until Gemini finishes")
+        LLM_STREAM_CANCELS.labels(kind, 'not_cancellable').inc()
+        return
+    try:
+        cancel()
+    except Exception as e:
+        logger.warning(f"Could not cancel AI stream: {e}")
+        LLM_STREAM_CANCELS.labels(kind, 'failed').inc()
+        return
+    LLM_STREAM_CANCELS.labels(kind, 'cancelled').inc()
+
+def _open_stream(kind, start):
+    """Calls ``start()`` to open a streamed Gemini call, timing it as an error if that raises."""
+    started = time.perf_counter()
+    try:
+        return start(), started
+    except Exception:
+        LLM_REQUEST_SECONDS.labels(kind, 'error').observe(time.perf_counter() - started)
+        raise
+
+def _stream_text(response, kind, started):
+    """Yields the text of each chunk of a streamed response, cancelling it if the consumer stops early.
+
+    The call's latency is recorded once the stream ends, counted from ``started``.
+    """
+    outcome = 'error'
+    try:
+        for chunk in response:
+            text = getattr(chunk, 'text', '')
+            if text:
+                yield text
+        outcome = 'ok'
+        observe_llm_usage(kind, response)
+    except GeneratorExit:
+        outcome = 'cancelled'
+        _cancel_stream(response, kind)
+        raise
+    finally:
+        LLM_REQUEST_SECONDS.labels(kind, outcome).observe(time.perf_counter() - started)
+
+def stream_ai_response(chat_session, user_input):
+    """Like get_ai_response, but yields the reply in chunks as Gemini produces them.
+
+    If the consumer closes the generator early the chat history ends with an
+    incomplete turn, so the caller must discard the session instead of saving it.
+    """
+    response, started = _open_stream('chat', lambda: chat_session.send_message(user_input, stream=True))
+    return _stream_text(response, 'chat', started)
+
 # --- AI Summary Function ---
 def get_ai_summary(patient_data):
     """Generates a clinical summary for a patient using the AI."""
     try:
-        patient_context = _format_patient_context(patient_data)
-        model = genai.GenerativeModel(
-            model_name="gemini-2.5-flash",
-            system_instruction=SUMMARY_SYSTEM_INSTRUCTION
-        )
-        response = model.generate_content(f"Generate the summary for this patient:\n{patient_context}")
-        return response.text
+        return _generate_cached('summary', patient_data, SUMMARY_SYSTEM_INSTRUCTION, SUMMARY_PROMPT)
     except Exception as e:
-        print(f"Error generating AI summary: {e}")
+        logger.exception("Error generating AI summary")
         return "Could not generate AI summary due to a server error."
 
 # --- PDF and Email Functions ---
@@ -145,23 +437,130 @@ class PDF(FPDF):
         self.multi_cell(0, 10, body_encoded)
         self.ln()
 
+def generate_intervention_plan(patient_data):
+    """Generates the intervention plan text; errors propagate to the caller."""
+    return _generate_cached('intervention', patient_data, INTERVENTION_PLAN_INSTRUCTION, INTERVENTION_PROMPT)
+
 def generate_intervention_text(patient_data):
     """Generates just the intervention plan text using the AI model."""
     try:
-        patient_context = _format_patient_context(patient_data)
-        model = genai.GenerativeModel(
-            model_name="gemini-2.5-flash",
-            system_instruction=INTERVENTION_PLAN_INSTRUCTION
-        )
-        prompt = f"Generate the intervention plan for the following patient:\n{patient_context}"
-        plan_text = model.generate_content(prompt).text
-        return plan_text
+        return generate_intervention_plan(patient_data)
+    except Exception as e:
+        logger.exception("Error generating intervention text")
+        return "Failed to generate intervention plan. Please check the server logs."
+
+def stream_intervention_text(patient_data):
+    """Yields the intervention plan in chunks as it is generated.
+
+    A cached plan is yielded whole. A fresh one is cached only if the stream
+    runs to completion; closing the generator early cancels the generation.
+    """
+    prompt, cache_key = _prompt_and_cache_key(INTERVENTION_PLAN_INSTRUCTION, INTERVENTION_PROMPT, patient_data)
+    cached = get_cached_content(cache_key)
+    if cached is not None:
+        yield cached
+        return
+
+    model = genai.GenerativeModel(model_name=MODEL_NAME, system_instruction=INTERVENTION_PLAN_INSTRUCTION)
+    response, started = _open_stream('intervention', lambda: model.generate_content(prompt, stream=True))
+    parts = []
+    for text in _stream_text(response, 'intervention', started):
+        parts.append(text)
+        yield text
+    if parts and patient_data:
+        store_content(cache_key, patient_data.get('desynpuf_id'), 'intervention', MODEL_NAME, ''.join(parts))
+
+# --- Async variants for the ASGI entry point (asgi.py) ---
+# Same behaviour and return values as the functions above; Gemini is awaited
+# and the (short) AI cache queries run in a worker thread.
+
+async def _generate_cached_async(kind, patient_data, instruction, prompt_prefix):
+    prompt, cache_key = _prompt_and_cache_key(instruction, prompt_prefix, patient_data)
+    cached = await asyncio.to_thread(get_cached_content, cache_key)
+    if cached is not None:
+        return cached
+
+    model = genai.GenerativeModel(model_name=MODEL_NAME, system_instruction=instruction)
+    with timed_llm_call(kind):
+        response = await model.generate_content_async(prompt)
+        text = response.text
+    observe_llm_usage(kind, response)
+    if text and patient_data:
+        await asyncio.to_thread(store_content, cache_key, patient_data.get('desynpuf_id'), kind, MODEL_NAME, text)
+    return text
+
+async def get_ai_summary_async(patient_data):
+    try:
+        return await _generate_cached_async('summary', patient_data, SUMMARY_SYSTEM_INSTRUCTION, SUMMARY_PROMPT)
+    except Exception as e:
+        logger.exception("Error generating AI summary")
+        return "Could not generate AI summary due to a server error."
+
+async def generate_intervention_text_async(patient_data):
+    try:
+        return await _generate_cached_async('intervention', patient_data, INTERVENTION_PLAN_INSTRUCTION, INTERVENTION_PROMPT)
     except Exception as e:
-        print(f"Error generating intervention text: {e}")
+        logger.exception("Error generating intervention text")
         return "Failed to generate intervention plan. Please check the server logs."
 
+async def get_ai_response_async(chat_session, user_input):
+    try:
+        with timed_llm_call('chat'):
+            response = await chat_session.send_message_async(user_input)
+            text = response.text
+        observe_llm_usage('chat', response)
+        return text
+    except Exception as e:
+        return f"Error getting AI response: {str(e)}"
+
+async def _open_stream_async(kind, start):
+    started = time.perf_counter()
+    try:
+        return await start(), started
+    except Exception:
+        LLM_REQUEST_SECONDS.labels(kind, 'error').observe(time.perf_counter() - started)
+        raise
+
+async def _stream_text_async(response, kind, started):
+    outcome = 'error'
+    try:
+        async for chunk in response:
+            text = getattr(chunk, 'text', '')
+            if text:
+                yield text
+        outcome = 'ok'
+        observe_llm_usage(kind, response)
+    except (GeneratorExit, asyncio.CancelledError):
+        outcome = 'cancelled'
+        _cancel_stream(response, kind)
+        raise
+    finally:
+        LLM_REQUEST_SECONDS.labels(kind, outcome).observe(time.perf_counter() - started)
+
+async def stream_ai_response_async(chat_session, user_input):
+    response, started = await _open_stream_async('chat', lambda: chat_session.send_message_async(user_input, stream=True))
+    async for text in _stream_text_async(response, 'chat', started):
+        yield text
+
+async def stream_intervention_text_async(patient_data):
+    prompt, cache_key = _prompt_and_cache_key(INTERVENTION_PLAN_INSTRUCTION, INTERVENTION_PROMPT, patient_data)
+    cached = await asyncio.to_thread(get_cached_content, cache_key)
+    if cached is not None:
+        yield cached
+        return
+
+    model = genai.GenerativeModel(model_name=MODEL_NAME, system_instruction=INTERVENTION_PLAN_INSTRUCTION)
+    response, started = await _open_stream_async('intervention', lambda: model.generate_content_async(prompt, stream=True))
+    parts = []
+    async for text in _stream_text_async(response, 'intervention', started):
+        parts.append(text)
+        yield text
+    if parts and patient_data:
+        await asyncio.to_thread(store_content, cache_key, patient_data.get('desynpuf_id'), 'intervention',
+                                MODEL_NAME, ''.join(parts))
+
 def generate_intervention_pdf_from_text(patient_data, plan_text):
-    """Generates an intervention plan PDF from provided text."""
+    """Renders an intervention plan PDF from provided text and returns it as bytes (None on failure)."""
     try:
         # 1. Create the PDF document
         pdf = PDF()
@@ -185,56 +584,80 @@ def generate_intervention_pdf_from_text(patient_data, plan_text):
             elif line:
                 pdf.chapter_body(line)
         
-        # 3. Save the PDF to a temporary file
-        output_filename = f"intervention_plan_{patient_data.get('desynpuf_id')}.pdf"
-        pdf.output(output_filename)
-        return output_filename
+        # 3. Render into memory; FPDF 1.7 returns a latin-1 str here
+        document = pdf.output(dest='S')
+        return document.encode('latin-1') if isinstance(document, str) else bytes(document)
         
     except Exception as e:
-        print(f"Error generating PDF from text: {e}")
+        logger.exception("Error generating PDF from text")
         return None
 
-def send_intervention_email(receiver_email, attachment_path, patient_name):
-    """Sends the intervention plan PDF via email."""
+def intervention_pdf_filename(patient_data):
+    return f"intervention_plan_{patient_data.get('desynpuf_id')}.pdf"
+
+# --- Parallel PDF rendering for campaign sends ---
+PDF_RENDER_WORKERS = int(os.getenv("PDF_RENDER_WORKERS", os.cpu_count() or 1))
+_pdf_pool = None
+_pdf_pool_pid = None
+_pdf_pool_lock = threading.Lock()
+
+def _render_timed(job):
+    patient_data, plan_text = job
+    started = time.perf_counter()
+    pdf_bytes = generate_intervention_pdf_from_text(patient_data, plan_text)
+    return pdf_bytes, time.perf_counter() - started
+
+def _observe_render(future):
+    # Runs in this process: an observation made inside the pool process would
+    # not reach /metrics unless PROMETHEUS_MULTIPROC_DIR is set
+    if future.cancelled() or future.exception() is not None:
+        return
+    pdf_bytes, seconds = future.result()
+    PDF_RENDER_SECONDS.labels('ok' if pdf_bytes else 'failed').observe(seconds)
+
+def _get_pdf_pool():
+    """The process pool behind submit_intervention_pdf, created once per process."""
+    global _pdf_pool, _pdf_pool_pid
+    with _pdf_pool_lock:
+        if _pdf_pool is None or _pdf_pool_pid != os.getpid():
+            _pdf_pool = ProcessPoolExecutor(max_workers=max(1, PDF_RENDER_WORKERS))
+            _pdf_pool_pid = os.getpid()
+        return _pdf_pool
+
+def submit_intervention_pdf(patient_data, plan_text):
+    """Renders one plan in the PDF process pool; the future resolves to ``(pdf_bytes or None, seconds)``.
+
+    ``seconds`` is the render time inside the pool process, which is also
+    recorded in PDF_RENDER_SECONDS.
+    """
+    future = _get_pdf_pool().submit(_render_timed, (patient_data, plan_text))
+    future.add_done_callback(_observe_render)
+    return future
+
+def build_intervention_email(receiver_email, pdf_bytes, patient_name, filename='intervention_plan.pdf'):
+    """Builds the email carrying the intervention plan PDF. Raises ValueError if SENDER_EMAIL is not set."""
     sender_email = os.getenv("SENDER_EMAIL")
-    sender_password = os.getenv("SENDER_PASSWORD")
-    smtp_server = os.getenv("SMTP_SERVER", "smtp.gmail.com")  # Correct default
-    smtp_port = int(os.getenv("SMTP_PORT", 587))
+    if not sender_email:
+        raise ValueError("SENDER_EMAIL is not set in the .env file.")
+
+    message = MIMEMultipart()
+    message['From'] = sender_email
+    message['To'] = receiver_email
+    message['Subject'] = f"Your Personalized Intervention Plan for {patient_name}"
     
-    if not all([sender_email, sender_password]):
-        print("Error: Email credentials (SENDER_EMAIL, SENDER_PASSWORD) are not set in the .env file.")
-        return False
+    body = f"Dear {patient_name},\n\nPlease find your personalized intervention plan attached to this email.\n\nWe encourage you to review it and discuss it with us during your next appointment.\n\nSincerely,\nYour Healthcare Team"
+    message.attach(MIMEText(body, 'plain'))
 
-    try:
-        message = MIMEMultipart()
-        message['From'] = sender_email
-        message['To'] = receiver_email
-        message['Subject'] = f"Your Personalized Intervention Plan for {patient_name}"
-        
-        body = f"Dear {patient_name},\n\nPlease find your personalized intervention plan attached to this email.\n\nWe encourage you to review it and discuss it with us during your next appointment.\n\nSincerely,\nYour Healthcare Team"
-        message.attach(MIMEText(body, 'plain'))
+    # Attach the PDF straight from memory
+    part = MIMEApplication(pdf_bytes, _subtype='pdf')
+    part.add_header('Content-Disposition', 'attachment', filename=filename)
+    message.attach(part)
+    return message
 
-        # Attach the PDF file
-        with open(attachment_path, 'rb') as attachment:
-            part = MIMEBase('application', 'octet-stream')
-            part.set_payload(attachment.read())
-        
-        encoders.encode_base64(part)
-        part.add_header(
-            'Content-Disposition',
-            f"attachment; filename= {os.path.basename(attachment_path)}",
-        )
-        message.attach(part)
-
-        # Send the email
-        context = ssl.create_default_context()
-        with smtplib.SMTP(smtp_server, smtp_port) as server:
-            server.starttls(context=context)
-            server.login(sender_email, sender_password)
-            server.sendmail(sender_email, receiver_email, message.as_string())
-        
-        print(f"Intervention plan successfully sent to {receiver_email}")
-        return True
-    except Exception as e:
-        print(f"Error sending email: {e}")
-        return False
\ No newline at end of file
+def queue_intervention_email(receiver_email, pdf_bytes, patient_name, filename='intervention_plan.pdf',
+                             patient_id=None, job_run_id=None):
+    """Queues the intervention plan email for background delivery and returns its outbox id."""
+    message = build_intervention_email(receiver_email, pdf_bytes, patient_name, filename)
+    email_id = enqueue_email(message, patient_id=patient_id, job_run_id=job_run_id)
+    logger.info(f"Intervention plan for {receiver_email} queued as email {email_id}")
+    return email_id
@@ -0,0 +1,106 @@
+"""Bookkeeping shared by long-running background jobs.
+
+A job records each run in the job_runs table (migrations/005_job_runs.sql)
+with its parameters, progress counters and a resume checkpoint. A
+PostgreSQL advisory lock keeps two processes from running the same job at
+once, so a run left 'running' or 'failed' without a lock holder can safely
+be resumed.
+"""
+import json
+import threading
+import time
+from contextlib import contextmanager
+from psycopg2.extras import Json
+from data import execute_query, get_db_connection
+
+
+class JobAlreadyRunning(Exception):
+    pass
+
+
+@contextmanager
+def job_lock(job):
+    """Holds the job's advisory lock for the duration of the block, or raises JobAlreadyRunning.
+
+    Uses its own connection so a long run does not pin a pooled one.
+    """
+    conn = get_db_connection()
+    try:
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT pg_try_advisory_lock(hashtext(%s))", (f"job:{job}",))
+            if not cursor.fetchone()[0]:
+                raise JobAlreadyRunning(f"Job '{job}' is already running")
+        yield
+    finally:
+        conn.close()  # releases the session-level lock
+
+
+def create_run(job, params, progress):
+    rows = execute_query(
+        "INSERT INTO job_runs (job, params, progress) VALUES (%s, %s, %s) RETURNING id",
+        (job, Json(params), Json(progress))
+    )
+    return rows[0]['id']
+
+
+def find_resumable_run(job, params):
+    """Latest unfinished run of ``job`` with the same parameters, or None. Call while holding job_lock."""
+    rows = execute_query("""
+        SELECT * FROM job_runs
+        WHERE job = %s AND params = %s AND status IN ('running', 'failed')
+        ORDER BY id DESC LIMIT 1
+    """, (job, Json(params)))
+    return rows[0] if rows else None
+
+
+def save_progress(run_id, progress, checkpoint=None, status='running', error=None):
+    execute_query("""
+        UPDATE job_runs SET progress = %s, checkpoint = COALESCE(%s, checkpoint), status = %s, error = %s,
+            updated_at = now(), finished_at = CASE WHEN %s = 'running' THEN NULL ELSE now() END
+        WHERE id = %s
+    """, (Json(progress), Json(checkpoint) if checkpoint is not None else None, status, error, status, run_id))
+
+
+def get_run(run_id):
+    rows = execute_query("SELECT * FROM job_runs WHERE id = %s", (run_id,))
+    return _serialize(rows[0]) if rows else None
+
+
+def get_latest_run(job):
+    rows = execute_query("SELECT * FROM job_runs WHERE job = %s ORDER BY id DESC LIMIT 1", (job,))
+    return _serialize(rows[0]) if rows else None
+
+
+def _serialize(row):
+    run = dict(row)
+    for key in ('started_at', 'updated_at', 'finished_at'):
+        if run.get(key) is not None:
+            run[key] = run[key].isoformat()
+    return json.loads(json.dumps(run, default=str))
+
+
+class RateLimiter:
+    """Token bucket allowing ``rate`` acquisitions per ``per`` seconds, shared across threads."""
+
+    def __init__(self, rate, per=60.0):
+        self.rate = float(rate)
+        self.per = float(per)
+        self._tokens = 1.0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a call is allowed."""
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(1.0, self._tokens + (now - self._updated) * self.rate / self.per)
+                self._updated = now
+                if self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    return
+                wait = (1.0 - self._tokens) * self.per / self.rate
+            time.sleep(wait)
@@ -0,0 +1,43 @@
+"""Resident memory of the current process, for sizing worker pods.
+
+On Linux the numbers come from /proc/self/smaps_rollup, which splits
+resident memory into pages shared with other processes (the models
+loaded before the fork) and pages private to this one. PSS
+charges each shared page to the processes sharing it, so summing PSS over
+all workers gives the real footprint. Elsewhere only peak RSS is known.
+"""
+import logging
+import os
+import resource
+import sys
+
+logger = logging.getLogger(__name__)
+
+
+def memory_usage():
+    """Memory of this process in MB: ``rss`` and, where available, ``pss``, ``shared`` and ``private``."""
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            fields = {}
+            for line in f:
+                parts = line.split()
+                if len(parts) == 3 and parts[2] == 'kB':
+                    fields[parts[0].rstrip(':')] = int(parts[1]) / 1024
+        return {
+            'rss': round(fields['Rss'], 1),
+            'pss': round(fields['Pss'], 1),
+            'shared': round(fields.get('Shared_Clean', 0) + fields.get('Shared_Dirty', 0), 1),
+            'private': round(fields.get('Private_Clean', 0) + fields.get('Private_Dirty', 0), 1),
+        }
+    except (OSError, KeyError, ValueError):
+        pass
+    # ru_maxrss is peak, not current, and in bytes on macOS but kB elsewhere
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {'rss': round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)}
+
+
+def report_memory(label):
+    usage = memory_usage()
+    details = ', '.join(f"{name} {value} MB" for name, value in usage.items())
+    logger.info(f"{label} (pid {os.getpid()}): {details}")
+    return usage
@@ -0,0 +1,111 @@
+"""Prometheus metrics, served at /metrics.
+
+Covers HTTP request latency per route, every execute_query call (labeled
+with the query's name, never its SQL), model scoring, Gemini calls with
+their token usage, intervention PDF rendering, and SMTP delivery. Recording
+is a histogram observe or a counter increment, so it stays cheap on the hot
+paths.
+
+Under gunicorn every worker keeps its own numbers. gunicorn.conf.py points
+PROMETHEUS_MULTIPROC_DIR at a shared directory before anything imports
+prometheus_client, the workers write their values there, and whichever
+worker answers /metrics reports the totals across all of them.
+"""
+import os
+import time
+from contextlib import contextmanager
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess
+
+QUERY_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+PREDICT_BUCKETS = (.00005, .0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, 1)
+PDF_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+SLOW_BUCKETS = (.05, .1, .25, .5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+HTTP_REQUEST_SECONDS = Histogram(
+    'medcare_http_request_duration_seconds', 'Time to produce an HTTP response (to the first chunk when streamed)',
+    ['method', 'route', 'status'])
+DB_QUERY_SECONDS = Histogram(
+    'medcare_db_query_duration_seconds', 'execute_query latency by query name', ['query'], buckets=QUERY_BUCKETS)
+DB_QUERY_ERRORS = Counter(
+    'medcare_db_query_errors_total', 'execute_query calls that raised, by query name', ['query'])
+PREDICT_SECONDS = Histogram(
+    'medcare_predict_duration_seconds', 'Risk model scoring latency by path (fast, slow or batch)', ['path'],
+    buckets=PREDICT_BUCKETS)
+PREDICT_RECORDS = Counter(
+    'medcare_predict_records_total', 'Records scored by predict_batch calls (path batch)', ['path'])
+LLM_REQUEST_SECONDS = Histogram(
+    'medcare_llm_request_duration_seconds', 'Gemini call latency (whole stream for streamed calls)',
+    ['kind', 'outcome'], buckets=SLOW_BUCKETS)
+LLM_STREAM_CANCELS = Counter(
+    'medcare_llm_stream_cancels_total',
+    'Gemini streams abandoned by the client, by whether the call was cancelled (cancelled, not_cancellable or failed)',
+    ['kind', 'outcome'])
+LLM_TOKENS = Counter(
+    'medcare_llm_tokens_total', 'Gemini tokens reported in usage metadata', ['kind', 'type'])
+PDF_RENDER_SECONDS = Histogram(
+    'medcare_pdf_render_duration_seconds', 'Time to render one intervention plan PDF, by outcome (ok or failed)',
+    ['outcome'], buckets=PDF_BUCKETS)
+SMTP_SEND_SECONDS = Histogram(
+    'medcare_smtp_send_duration_seconds', 'Time to hand one message to the mail server', ['outcome'],
+    buckets=SLOW_BUCKETS)
+EMAILS = Counter(
+    'medcare_emails_total', 'Outbox delivery attempts by outcome (sent, retry or failed)', ['outcome'])
+
+
+def observe_query(name, seconds, failed=False):
+    DB_QUERY_SECONDS.labels(name).observe(seconds)
+    if failed:
+        DB_QUERY_ERRORS.labels(name).inc()
+
+
+def observe_llm_usage(kind, response):
+    """Counts the prompt and completion tokens in a Gemini response's usage metadata, if it has any."""
+    usage = getattr(response, 'usage_metadata', None)
+    if usage is None:
+        return
+    prompt_tokens = getattr(usage, 'prompt_token_count', 0) or 0
+    completion_tokens = getattr(usage, 'candidates_token_count', 0) or 0
+    if prompt_tokens:
+        LLM_TOKENS.labels(kind, 'prompt').inc(prompt_tokens)
+    if completion_tokens:
+        LLM_TOKENS.labels(kind, 'completion').inc(completion_tokens)
+
+
+@contextmanager
+def timed_llm_call(kind):
+    """Times the block as one Gemini call of ``kind``; the outcome label is 'error' if it raises."""
+    started = time.perf_counter()
+    outcome = 'error'
+    try:
+        yield
+        outcome = 'ok'
+    finally:
+        LLM_REQUEST_SECONDS.labels(kind, outcome).observe(time.perf_counter() - started)
+
+
+def metrics_response():
+    """``(body, content_type)`` for a scrape of this process, or of every worker in multiprocess mode."""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def init_app(app):
+    """Records the latency of every request to ``app`` by route and status."""
+    from flask import g, request
+
+    @app.before_request
+    def start_timer():
+        g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        started = g.pop('metrics_started', None)
+        if started is not None:
+            route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+            HTTP_REQUEST_SECONDS.labels(request.method, route, response.status_code).observe(
+                time.perf_counter() - started)
+        return response
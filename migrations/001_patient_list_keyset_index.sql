@@ -0,0 +1,5 @@
+-- Composite index behind the admin patient list ordering and its keyset
+-- pagination (data.LIST_ORDER_COLUMNS). The list is read highest risk first,
+-- which PostgreSQL serves with a backward scan of this index.
+CREATE INDEX IF NOT EXISTS idx_patient_analysis_list_order
+    ON patient_analysis ((COALESCE(risk_tier, 0)), (COALESCE(hospitalization_30d_score, -1)), desynpuf_id);
@@ -0,0 +1,19 @@
+-- Indexes behind search.build_search_clause. pg_trgm must be allow-listed
+-- on Azure Database for PostgreSQL (azure.extensions) before this runs.
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+-- Member ID: prefix (short terms) and substring matches
+CREATE INDEX IF NOT EXISTS idx_patient_analysis_id_prefix
+    ON patient_analysis (lower(desynpuf_id) text_pattern_ops);
+CREATE INDEX IF NOT EXISTS idx_patient_analysis_id_trgm
+    ON patient_analysis USING gin (lower(desynpuf_id) gin_trgm_ops);
+
+-- Name: prefix (short terms), substring and fuzzy (similarity) matches
+CREATE INDEX IF NOT EXISTS idx_patients_name_prefix
+    ON patients (lower(name) text_pattern_ops);
+CREATE INDEX IF NOT EXISTS idx_patients_name_trgm
+    ON patients USING gin (lower(name) gin_trgm_ops);
+
+-- Age: exact numeric matches
+CREATE INDEX IF NOT EXISTS idx_patient_analysis_age
+    ON patient_analysis (age);
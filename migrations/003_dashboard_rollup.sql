@@ -0,0 +1,100 @@
+-- Pre-aggregated patient_analysis totals behind /api/dashboard_data.
+-- One row per (risk tier, exact age); the dashboard's tier and age-range
+-- filters are answered by summing a few hundred rows at most, whatever the
+-- population size. A NULL tier is stored as 0 and a NULL age as -1.
+CREATE TABLE IF NOT EXISTS dashboard_rollup (
+    risk_tier INTEGER NOT NULL,
+    age NUMERIC NOT NULL,
+    patient_count BIGINT NOT NULL DEFAULT 0,
+    sum_30d NUMERIC NOT NULL DEFAULT 0,
+    n_30d BIGINT NOT NULL DEFAULT 0,
+    sum_60d NUMERIC NOT NULL DEFAULT 0,
+    n_60d BIGINT NOT NULL DEFAULT 0,
+    sum_90d NUMERIC NOT NULL DEFAULT 0,
+    n_90d BIGINT NOT NULL DEFAULT 0,
+    total_costs NUMERIC NOT NULL DEFAULT 0,
+    total_savings NUMERIC NOT NULL DEFAULT 0,
+    PRIMARY KEY (risk_tier, age)
+);
+
+-- Full rebuild; the incremental triggers below keep it current afterwards.
+CREATE OR REPLACE FUNCTION dashboard_rollup_rebuild() RETURNS void AS $$
+BEGIN
+    LOCK TABLE patient_analysis IN SHARE MODE;
+    DELETE FROM dashboard_rollup;
+    INSERT INTO dashboard_rollup
+    SELECT COALESCE(risk_tier::integer, 0), COALESCE(age::numeric, -1), COUNT(*),
+           COALESCE(SUM(risk_30d_hospitalization::numeric), 0), COUNT(risk_30d_hospitalization),
+           COALESCE(SUM(risk_60d_hospitalization::numeric), 0), COUNT(risk_60d_hospitalization),
+           COALESCE(SUM(risk_90d_hospitalization::numeric), 0), COUNT(risk_90d_hospitalization),
+           COALESCE(SUM(annual_intervention_cost::numeric), 0), COALESCE(SUM(cost_savings::numeric), 0)
+    FROM patient_analysis
+    GROUP BY 1, 2;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Applies the signed per-group deltas of one statement's changed rows.
+-- Statement-level triggers with transition tables keep bulk merges to one
+-- upsert per affected (tier, age) group instead of one per row.
+CREATE OR REPLACE FUNCTION dashboard_rollup_apply_changes() RETURNS trigger AS $$
+DECLARE
+    changes TEXT;
+BEGIN
+    changes := CASE TG_OP
+        WHEN 'INSERT' THEN 'SELECT 1 AS sign, * FROM new_rows'
+        WHEN 'DELETE' THEN 'SELECT -1 AS sign, * FROM old_rows'
+        ELSE 'SELECT -1 AS sign, * FROM old_rows UNION ALL SELECT 1, * FROM new_rows'
+    END;
+
+    EXECUTE format($sql$
+        INSERT INTO dashboard_rollup AS d
+        SELECT COALESCE(risk_tier::integer, 0), COALESCE(age::numeric, -1), SUM(sign),
+               COALESCE(SUM(sign * risk_30d_hospitalization::numeric), 0), SUM(sign * (risk_30d_hospitalization IS NOT NULL)::integer),
+               COALESCE(SUM(sign * risk_60d_hospitalization::numeric), 0), SUM(sign * (risk_60d_hospitalization IS NOT NULL)::integer),
+               COALESCE(SUM(sign * risk_90d_hospitalization::numeric), 0), SUM(sign * (risk_90d_hospitalization IS NOT NULL)::integer),
+               COALESCE(SUM(sign * annual_intervention_cost::numeric), 0), COALESCE(SUM(sign * cost_savings::numeric), 0)
+        FROM (%s) changes
+        GROUP BY 1, 2
+        ON CONFLICT (risk_tier, age) DO UPDATE SET
+            patient_count = d.patient_count + EXCLUDED.patient_count,
+            sum_30d = d.sum_30d + EXCLUDED.sum_30d,
+            n_30d = d.n_30d + EXCLUDED.n_30d,
+            sum_60d = d.sum_60d + EXCLUDED.sum_60d,
+            n_60d = d.n_60d + EXCLUDED.n_60d,
+            sum_90d = d.sum_90d + EXCLUDED.sum_90d,
+            n_90d = d.n_90d + EXCLUDED.n_90d,
+            total_costs = d.total_costs + EXCLUDED.total_costs,
+            total_savings = d.total_savings + EXCLUDED.total_savings
+    $sql$, changes);
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION dashboard_rollup_truncate() RETURNS trigger AS $$
+BEGIN
+    DELETE FROM dashboard_rollup;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_dashboard_rollup_insert ON patient_analysis;
+CREATE TRIGGER trg_dashboard_rollup_insert AFTER INSERT ON patient_analysis
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION dashboard_rollup_apply_changes();
+
+DROP TRIGGER IF EXISTS trg_dashboard_rollup_update ON patient_analysis;
+CREATE TRIGGER trg_dashboard_rollup_update AFTER UPDATE ON patient_analysis
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION dashboard_rollup_apply_changes();
+
+DROP TRIGGER IF EXISTS trg_dashboard_rollup_delete ON patient_analysis;
+CREATE TRIGGER trg_dashboard_rollup_delete AFTER DELETE ON patient_analysis
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION dashboard_rollup_apply_changes();
+
+DROP TRIGGER IF EXISTS trg_dashboard_rollup_truncate ON patient_analysis;
+CREATE TRIGGER trg_dashboard_rollup_truncate AFTER TRUNCATE ON patient_analysis
+    FOR EACH STATEMENT EXECUTE FUNCTION dashboard_rollup_truncate();
+
+SELECT dashboard_rollup_rebuild();
@@ -0,0 +1,43 @@
+-- Generated AI text (summaries, intervention plans) keyed by a SHA-256 of the
+-- model, system instruction and formatted patient context; see ai_cache.py.
+-- A changed record hashes to a new key, and the triggers below also drop a
+-- patient's entries as soon as their row is updated or deleted.
+CREATE TABLE IF NOT EXISTS ai_content_cache (
+    cache_key TEXT PRIMARY KEY,
+    patient_id TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    model TEXT NOT NULL,
+    content TEXT NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    last_used_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS idx_ai_content_cache_patient ON ai_content_cache (patient_id);
+CREATE INDEX IF NOT EXISTS idx_ai_content_cache_last_used ON ai_content_cache (last_used_at);
+
+CREATE OR REPLACE FUNCTION ai_content_cache_invalidate() RETURNS trigger AS $$
+BEGIN
+    DELETE FROM ai_content_cache c USING old_rows o WHERE c.patient_id = o.desynpuf_id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_ai_content_cache_analysis_update ON patient_analysis;
+CREATE TRIGGER trg_ai_content_cache_analysis_update AFTER UPDATE ON patient_analysis
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION ai_content_cache_invalidate();
+
+DROP TRIGGER IF EXISTS trg_ai_content_cache_analysis_delete ON patient_analysis;
+CREATE TRIGGER trg_ai_content_cache_analysis_delete AFTER DELETE ON patient_analysis
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION ai_content_cache_invalidate();
+
+DROP TRIGGER IF EXISTS trg_ai_content_cache_patients_update ON patients;
+CREATE TRIGGER trg_ai_content_cache_patients_update AFTER UPDATE ON patients
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION ai_content_cache_invalidate();
+
+DROP TRIGGER IF EXISTS trg_ai_content_cache_patients_delete ON patients;
+CREATE TRIGGER trg_ai_content_cache_patients_delete AFTER DELETE ON patients
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION ai_content_cache_invalidate();
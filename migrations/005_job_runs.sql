@@ -0,0 +1,17 @@
+-- One row per run of a background job (see jobs.py). Progress counters and
+-- the resume checkpoint are job-specific JSON; a run that stopped before
+-- completing can be resumed from its checkpoint.
+CREATE TABLE IF NOT EXISTS job_runs (
+    id BIGSERIAL PRIMARY KEY,
+    job TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'running',
+    params JSONB NOT NULL DEFAULT '{}',
+    progress JSONB NOT NULL DEFAULT '{}',
+    checkpoint JSONB,
+    error TEXT,
+    started_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    finished_at TIMESTAMPTZ
+);
+
+CREATE INDEX IF NOT EXISTS idx_job_runs_job ON job_runs (job, id DESC);
@@ -0,0 +1,3 @@
+-- Model version that produced each stored prediction (predictor.ModelBundle.version).
+-- Rows scored before versioning stay NULL.
+ALTER TABLE patient_analysis ADD COLUMN IF NOT EXISTS model_version TEXT;
@@ -0,0 +1,23 @@
+-- Outgoing email, queued by the app and delivered by the sender threads in
+-- outbox.py. Each row holds the complete rendered message; a sender claims
+-- due 'queued' rows with SKIP LOCKED, so any number of processes can drain
+-- the table. Transient failures are re-queued with a later next_attempt_at.
+CREATE TABLE IF NOT EXISTS email_outbox (
+    id BIGSERIAL PRIMARY KEY,
+    patient_id TEXT,
+    sender TEXT NOT NULL,
+    recipient TEXT NOT NULL,
+    subject TEXT,
+    message BYTEA NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    last_error TEXT,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    sent_at TIMESTAMPTZ
+);
+
+CREATE INDEX IF NOT EXISTS idx_email_outbox_due ON email_outbox (next_attempt_at, id)
+    WHERE status IN ('queued', 'sending');
+CREATE INDEX IF NOT EXISTS idx_email_outbox_patient ON email_outbox (patient_id, id DESC);
@@ -0,0 +1,9 @@
+-- Intervention campaigns (campaign.py) email each patient in a cohort, so
+-- patients get a contact address, and every queued email records the
+-- job_runs row of the campaign that produced it for progress reporting and
+-- for skipping patients already queued when a run resumes.
+ALTER TABLE patients ADD COLUMN IF NOT EXISTS email TEXT;
+
+ALTER TABLE email_outbox ADD COLUMN IF NOT EXISTS job_run_id BIGINT;
+CREATE INDEX IF NOT EXISTS idx_email_outbox_job_run ON email_outbox (job_run_id, patient_id)
+    WHERE job_run_id IS NOT NULL;
@@ -0,0 +1,14 @@
+-- Chatbot conversations, one row per (chat user, patient), so whichever
+-- worker receives the next message continues the conversation; see
+-- chat_history.py. version counts the saved replies and lets a worker tell
+-- that its live session is behind the stored history.
+CREATE TABLE IF NOT EXISTS chat_history (
+    user_key TEXT NOT NULL,
+    patient_id TEXT NOT NULL,
+    turns JSONB NOT NULL,
+    version INTEGER NOT NULL DEFAULT 1,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    PRIMARY KEY (user_key, patient_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_chat_history_updated ON chat_history (updated_at);
@@ -0,0 +1,62 @@
+"""Versioned model artifacts on disk.
+
+Each version is a directory under MODEL_ROOT (``models/<version>/``) holding
+preprocessing_pipeline.pkl and risk_models.pkl, and MODEL_ROOT/ACTIVE names
+the version the app serves. Activating a version rewrites ACTIVE atomically;
+every process notices the change (Predictor.watch_active_version), warms
+the new version up and swaps it in. Without an ACTIVE file the pickles in
+the working directory are served as version 'legacy'.
+"""
+import os
+import re
+
+MODEL_ROOT = os.getenv("MODEL_ROOT", "models")
+ACTIVE_FILE = 'ACTIVE'
+LEGACY_VERSION = 'legacy'
+ARTIFACTS = ('preprocessing_pipeline.pkl', 'risk_models.pkl')
+
+_VERSION_PATTERN = re.compile(r'^[A-Za-z0-9][A-Za-z0-9._-]*$')
+
+
+def version_dir(version):
+    """Directory holding ``version``'s artifacts. Raises ValueError for an invalid name."""
+    if version == LEGACY_VERSION:
+        return '.'
+    if not _VERSION_PATTERN.match(version or ''):
+        raise ValueError(f"Invalid model version '{version}'")
+    return os.path.join(MODEL_ROOT, version)
+
+
+def has_artifacts(version):
+    directory = version_dir(version)
+    return all(os.path.exists(os.path.join(directory, name)) for name in ARTIFACTS)
+
+
+def list_versions():
+    """Versions under MODEL_ROOT with a complete set of artifacts, sorted by name."""
+    if not os.path.isdir(MODEL_ROOT):
+        return []
+    return sorted(name for name in os.listdir(MODEL_ROOT)
+                  if _VERSION_PATTERN.match(name) and has_artifacts(name))
+
+
+def active_version():
+    """The version named in MODEL_ROOT/ACTIVE, or LEGACY_VERSION if there is none."""
+    try:
+        with open(os.path.join(MODEL_ROOT, ACTIVE_FILE)) as f:
+            version = f.read().strip()
+    except FileNotFoundError:
+        return LEGACY_VERSION
+    return version or LEGACY_VERSION
+
+
+def set_active_version(version):
+    """Points ACTIVE at ``version``. Raises ValueError if it has no artifacts."""
+    if version == LEGACY_VERSION or not has_artifacts(version):
+        raise ValueError(f"Model version '{version}' not found under {MODEL_ROOT}")
+    temp_path = os.path.join(MODEL_ROOT, f".{ACTIVE_FILE}.{os.getpid()}.tmp")
+    with open(temp_path, 'w') as f:
+        f.write(version + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, os.path.join(MODEL_ROOT, ACTIVE_FILE))
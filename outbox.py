@@ -0,0 +1,256 @@
+"""Durable outgoing email queue.
+
+Requests render a message and store it in the email_outbox table
+(migrations/007_email_outbox.sql) instead of talking to the mail server
+themselves; enqueue_email returns the outbox id at once. Sender threads
+claim due messages in batches and deliver them over an SMTP session that
+stays open and authenticated between messages, reconnecting when the server
+drops it. A failed delivery is retried with exponential backoff until
+OUTBOX_MAX_ATTEMPTS; 5xx rejections fail immediately. Every attempt is
+recorded on the row, so get_email reports the delivery status.
+
+Senders run only in long-lived processes: each web process starts its own
+at startup (app.start_background_threads, with OUTBOX_SENDER_AUTOSTART), or
+they run on their own with ``flask send-emails``. Queuing never starts one,
+so a short-lived process such as ``flask campaign`` cannot exit holding
+claimed rows that then sit in 'sending' until OUTBOX_SENDING_TIMEOUT. The mail server comes from
+SMTP_SERVER and SMTP_PORT; set SMTP_STARTTLS=0 and leave SENDER_PASSWORD
+empty to deliver to a local stand-in such as ``python -m aiosmtpd -n``.
+"""
+import logging
+import os
+import smtplib
+import ssl
+import threading
+import time
+from psycopg2 import Binary
+from data import execute_query
+from metrics import EMAILS, SMTP_SEND_SECONDS
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_SENDER_CONNECTIONS = int(os.getenv("OUTBOX_SENDER_CONNECTIONS", 2))
+OUTBOX_SENDER_AUTOSTART = os.getenv("OUTBOX_SENDER_AUTOSTART", "1") not in ("0", "false", "no")
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", 20))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", 5))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", 6))
+OUTBOX_RETRY_BASE = float(os.getenv("OUTBOX_RETRY_BASE", 30))
+OUTBOX_RETRY_MAX = float(os.getenv("OUTBOX_RETRY_MAX", 3600))
+# A message left 'sending' this long (its sender died) is claimed again
+OUTBOX_SENDING_TIMEOUT = int(os.getenv("OUTBOX_SENDING_TIMEOUT", 600))
+# Open sessions idle this long are closed before the server times them out
+SMTP_IDLE_TIMEOUT = float(os.getenv("SMTP_IDLE_TIMEOUT", 60))
+SMTP_TIMEOUT = float(os.getenv("SMTP_TIMEOUT", 30))
+
+STATUS_COLUMNS = ['id', 'patient_id', 'recipient', 'subject', 'status', 'attempts', 'next_attempt_at',
+                  'last_error', 'created_at', 'updated_at', 'sent_at']
+
+# Set when a message is queued so idle senders pick it up without waiting for the next poll
+_wake = threading.Event()
+
+
+def smtp_settings():
+    return {
+        'server': os.getenv("SMTP_SERVER", "smtp.gmail.com"),
+        'port': int(os.getenv("SMTP_PORT", 587)),
+        'starttls': os.getenv("SMTP_STARTTLS", "1") not in ("0", "false", "no"),
+        'sender': os.getenv("SENDER_EMAIL"),
+        'password': os.getenv("SENDER_PASSWORD"),
+    }
+
+
+def smtp_connect():
+    """Opens an SMTP session, upgraded to TLS and logged in as configured."""
+    settings = smtp_settings()
+    server = smtplib.SMTP(settings['server'], settings['port'], timeout=SMTP_TIMEOUT)
+    try:
+        if settings['starttls']:
+            server.starttls(context=ssl.create_default_context())
+        if settings['password']:
+            server.login(settings['sender'], settings['password'])
+    except BaseException:
+        server.close()
+        raise
+    return server
+
+
+class SmtpConnection:
+    """One SMTP session, opened on first use and reused for every later message."""
+
+    def __init__(self):
+        self._server = None
+        self._last_used = 0.0
+
+    def send(self, sender, recipient, raw_message):
+        for attempt in range(2):
+            if self._server is None:
+                self._server = smtp_connect()
+            try:
+                self._server.sendmail(sender, [recipient], raw_message)
+                self._last_used = time.monotonic()
+                return
+            except smtplib.SMTPServerDisconnected:
+                # The server closed an idle session; one fresh connection gets a retry
+                self._server = None
+                if attempt:
+                    raise
+            except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused):
+                raise  # a refusal leaves the session usable
+            except BaseException:
+                self.close()
+                raise
+
+    def close_if_idle(self, idle_timeout=SMTP_IDLE_TIMEOUT):
+        if self._server is not None and time.monotonic() - self._last_used > idle_timeout:
+            self.close()
+
+    def close(self):
+        server, self._server = self._server, None
+        if server is None:
+            return
+        try:
+            server.quit()
+        except (smtplib.SMTPException, OSError):
+            server.close()
+
+
+def enqueue_email(message, patient_id=None, job_run_id=None):
+    """Stores an email.message.Message for delivery and returns its outbox id.
+
+    ``job_run_id`` ties the email to the background job run that queued it.
+    """
+    rows = execute_query("""
+        INSERT INTO email_outbox (patient_id, sender, recipient, subject, message, job_run_id)
+        VALUES (%s, %s, %s, %s, %s, %s) RETURNING id
+    """, (patient_id, message['From'], message['To'], message['Subject'], Binary(message.as_bytes()), job_run_id))
+    # Wakes this process's senders, if it runs any; others pick the row up on their next poll
+    _wake.set()
+    return rows[0]['id']
+
+
+def get_email(email_id):
+    """Delivery status of one queued email, or None."""
+    rows = execute_query(f"SELECT {', '.join(STATUS_COLUMNS)} FROM email_outbox WHERE id = %s", (email_id,))
+    if not rows:
+        return None
+    email = dict(rows[0])
+    for key in ('next_attempt_at', 'created_at', 'updated_at', 'sent_at'):
+        if email[key] is not None:
+            email[key] = email[key].isoformat()
+    return email
+
+
+def get_delivery_counts(job_run_id):
+    """Number of a job run's queued emails per delivery status."""
+    rows = execute_query("""
+        SELECT status, COUNT(*) AS n FROM email_outbox WHERE job_run_id = %s GROUP BY status
+    """, (job_run_id,))
+    return {row['status']: row['n'] for row in rows}
+
+
+def _claim(limit):
+    """Marks up to ``limit`` due messages as 'sending' and returns them."""
+    return execute_query("""
+        UPDATE email_outbox SET status = 'sending', attempts = attempts + 1, updated_at = now()
+        WHERE id IN (
+            SELECT id FROM email_outbox
+            WHERE (status = 'queued' AND next_attempt_at <= now())
+               OR (status = 'sending' AND updated_at < now() - make_interval(secs => %s))
+            ORDER BY next_attempt_at, id
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id, sender, recipient, message, attempts
+    """, (OUTBOX_SENDING_TIMEOUT, limit))
+
+
+def _is_permanent(error):
+    """True for rejections that will not succeed on a retry (5xx replies other than a login failure)."""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPAuthenticationError):
+        return False  # fixed by correcting the configuration, so keep the message
+    return isinstance(error, smtplib.SMTPResponseException) and error.smtp_code >= 500
+
+
+def retry_delay(attempts):
+    return min(OUTBOX_RETRY_BASE * 2 ** (attempts - 1), OUTBOX_RETRY_MAX)
+
+
+def _deliver(connection, row):
+    """Sends one claimed message and records the outcome: 'sent', 'retry' or 'failed'."""
+    started = time.perf_counter()
+    try:
+        connection.send(row['sender'], row['recipient'], bytes(row['message']))
+    except Exception as e:
+        SMTP_SEND_SECONDS.labels('error').observe(time.perf_counter() - started)
+        error = str(e) or type(e).__name__
+        outcome = 'failed' if _is_permanent(e) or row['attempts'] >= OUTBOX_MAX_ATTEMPTS else 'retry'
+        EMAILS.labels(outcome).inc()
+        execute_query("""
+            UPDATE email_outbox SET status = %s, last_error = %s, updated_at = now(),
+                next_attempt_at = now() + make_interval(secs => %s)
+            WHERE id = %s
+        """, ('failed' if outcome == 'failed' else 'queued', error, retry_delay(row['attempts']), row['id']),
+            name='outbox_mark_unsent')
+        logger.warning(f"Email {row['id']} to {row['recipient']} attempt {row['attempts']} failed ({outcome}): {error}",
+                       extra={'email_id': row['id'], 'attempt': row['attempts'], 'outcome': outcome})
+        return outcome
+    SMTP_SEND_SECONDS.labels('ok').observe(time.perf_counter() - started)
+    EMAILS.labels('sent').inc()
+    execute_query("""
+        UPDATE email_outbox SET status = 'sent', last_error = NULL, sent_at = now(), updated_at = now()
+        WHERE id = %s
+    """, (row['id'],), name='outbox_mark_sent')
+    return 'sent'
+
+
+def run_sender(once=False, batch_size=OUTBOX_BATCH_SIZE):
+    """Delivers queued email over one reused SMTP session.
+
+    Runs until the process exits, or with ``once`` until nothing is due, and
+    then returns the number of messages per outcome.
+    """
+    connection = SmtpConnection()
+    outcomes = {'sent': 0, 'retry': 0, 'failed': 0}
+    try:
+        while True:
+            try:
+                batch = _claim(batch_size)
+                for row in batch:
+                    outcomes[_deliver(connection, row)] += 1
+            except Exception as e:
+                if once:
+                    raise
+                logger.exception("Email sender error")
+                batch = []
+            if batch:
+                continue
+            if once:
+                return outcomes
+            connection.close_if_idle()
+            _wake.wait(OUTBOX_POLL_INTERVAL)
+            _wake.clear()
+    finally:
+        connection.close()
+
+
+_sender_pid = None
+_sender_lock = threading.Lock()
+
+
+def start_sender(connections=OUTBOX_SENDER_CONNECTIONS):
+    """Starts ``connections`` sender threads in this process, each with its own SMTP session.
+
+    Only for long-lived processes (see the module docstring). Threads do not
+    survive fork, so each worker process starts its own; calling again in the
+    same process does nothing.
+    """
+    global _sender_pid
+    if _sender_pid == os.getpid():
+        return
+    with _sender_lock:
+        if _sender_pid != os.getpid():
+            for number in range(max(1, connections)):
+                threading.Thread(target=run_sender, name=f'email-sender-{number}', daemon=True).start()
+            _sender_pid = os.getpid()
@@ -0,0 +1,221 @@
+"""Compact patient context for Gemini prompts.
+
+A patient record has about forty columns, many of them zero, None or
+repeated (risk_30d_hospitalization and hospitalization_30d_score, gender
+and gender_male). build_patient_context renders a curated subset as a few
+dense lines: demographics, risk scores, the conditions the patient actually
+has on one line, utilization and the recommended intervention. Fields that
+are missing or zero are left out, except the risk scores, where 0% is itself
+information.
+
+Lines are ranked. When the estimated token count exceeds the budget, the
+lowest-ranked lines are dropped until it fits; the patient and risk lines
+are always kept. The output depends only on the record's values, never on
+key order, so the text also works as part of a cache key.
+
+Token counts are estimates (words, numbers and punctuation marks each count
+as one), close enough to compare context sizes without calling the API.
+get_context_stats reports the compact contexts this process has built;
+context_token_report, used by ``flask context-report`` on a sample of
+patients, also renders the full context (every column, as the prompt used to
+list them) to show what compaction saves. Prompts never pay for that.
+"""
+import os
+import re
+import threading
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 256))
+
+CONDITION_LABELS = [
+    ('sp_chf', 'congestive heart failure'),
+    ('sp_chrnkidn', 'chronic kidney disease'),
+    ('sp_cncr', 'cancer'),
+    ('sp_copd', 'COPD'),
+    ('sp_diabetes', 'diabetes'),
+    ('sp_ischmcht', 'ischemic heart disease'),
+    ('sp_strketia', 'stroke/TIA'),
+    ('sp_depressn', 'depression'),
+    ('sp_alzhdmta', "Alzheimer's/dementia"),
+    ('sp_osteoprs', 'osteoporosis'),
+    ('sp_ra_oa', 'rheumatoid/osteoarthritis'),
+]
+
+RISK_FIELDS = [
+    ('30d hospitalization', ('risk_30d_hospitalization', 'hospitalization_30d_score')),
+    ('60d hospitalization', ('risk_60d_hospitalization', 'hospitalization_60d_score')),
+    ('90d hospitalization', ('risk_90d_hospitalization', 'hospitalization_90d_score')),
+    ('mortality', ('mortality_risk', 'mortality_score')),
+]
+
+# Lines in rank order; only the first MIN_LINES survive any budget
+MIN_LINES = 2
+
+_TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+_stats = {'contexts': 0, 'compact_tokens': 0, 'trimmed': 0}
+_stats_lock = threading.Lock()
+
+
+def estimate_tokens(text):
+    return len(_TOKEN_PATTERN.findall(text or ''))
+
+
+def _present(value):
+    return value is not None and value != '' and value != 0
+
+
+def _first(patient_data, keys):
+    for key in keys:
+        if patient_data.get(key) is not None:
+            return patient_data[key]
+    return None
+
+
+def _number(value):
+    value = float(value)
+    return f"{value:.0f}" if value == int(value) else f"{value:.2f}".rstrip('0')
+
+
+def _count(value, noun):
+    return f"{_number(value)} {noun}" if float(value) == 1 else f"{_number(value)} {noun}s"
+
+
+def _money(value):
+    return f"${float(value):,.0f}"
+
+
+def _patient_line(patient_data):
+    line = f"Patient {patient_data.get('desynpuf_id', 'N/A')}"
+    if _present(patient_data.get('name')):
+        line += f" ({patient_data['name']})"
+    demographics = []
+    if _present(patient_data.get('age')):
+        demographics.append(f"age {_number(patient_data['age'])}")
+    gender = patient_data.get('gender')
+    if gender is None and patient_data.get('gender_male') is not None:
+        gender = 'Male' if patient_data['gender_male'] == 1 else 'Female'
+    if gender:
+        demographics.append(str(gender).lower())
+    race = patient_data.get('race')
+    if race is None:
+        race = 'White' if patient_data.get('race_white') == 1 else 'Black' if patient_data.get('race_black') == 1 else None
+    if race:
+        demographics.append(f"race {race}")
+    return f"{line}: {', '.join(demographics)}" if demographics else line
+
+
+def _risk_line(patient_data):
+    parts = []
+    if _present(patient_data.get('risk_tier')):
+        tier = f"tier {patient_data['risk_tier']}"
+        if _present(patient_data.get('risk_tier_label')):
+            tier += f" ({patient_data['risk_tier_label']})"
+        parts.append(tier)
+    for label, keys in RISK_FIELDS:
+        value = _first(patient_data, keys)
+        if value is not None:
+            parts.append(f"{label} {float(value):.1%}")
+    return "Risk: " + "; ".join(parts) if parts else None
+
+
+def _conditions_line(patient_data):
+    conditions = [label for key, label in CONDITION_LABELS if patient_data.get(key) == 1]
+    if not conditions:
+        return None
+    line = f"Conditions: {', '.join(conditions)}"
+    counts = []
+    if _present(patient_data.get('chronic_condition_count')):
+        counts.append(f"{_number(patient_data['chronic_condition_count'])} chronic")
+    if _present(patient_data.get('high_impact_conditions')):
+        counts.append(f"{_number(patient_data['high_impact_conditions'])} high-impact")
+    return line + (f" ({', '.join(counts)})" if counts else "")
+
+
+def _utilization_line(patient_data):
+    parts = []
+    if _present(patient_data.get('inpatient_admissions')):
+        admissions = _count(patient_data['inpatient_admissions'], 'inpatient admission')
+        if _present(patient_data.get('inpatient_days')):
+            admissions += f" ({_count(patient_data['inpatient_days'], 'day')})"
+        parts.append(admissions)
+    if _present(patient_data.get('outpatient_visits')):
+        parts.append(_count(patient_data['outpatient_visits'], 'outpatient visit'))
+    if patient_data.get('prior_hospitalization') == 1 and not _present(patient_data.get('inpatient_admissions')):
+        parts.append("prior hospitalization")
+    if _present(patient_data.get('total_medicare_costs')):
+        parts.append(f"Medicare costs {_money(patient_data['total_medicare_costs'])}")
+    return "Utilization: " + "; ".join(parts) if parts else None
+
+
+def _intervention_line(patient_data):
+    if not _present(patient_data.get('care_intervention')):
+        return None
+    parts = [str(patient_data['care_intervention'])]
+    if _present(patient_data.get('annual_intervention_cost')):
+        parts.append(f"{_money(patient_data['annual_intervention_cost'])}/year")
+    if _present(patient_data.get('cost_savings')):
+        parts.append(f"expected savings {_money(patient_data['cost_savings'])}")
+    if _present(patient_data.get('prevented_hospitalizations')):
+        parts.append(f"{float(patient_data['prevented_hospitalizations']):.2f} hospitalizations prevented")
+    return "Recommended intervention: " + "; ".join(parts)
+
+
+# Rank order: earlier lines are kept longest when trimming to a budget
+LINE_BUILDERS = [_patient_line, _risk_line, _conditions_line, _utilization_line, _intervention_line]
+
+
+def format_full_context(patient_data):
+    """Every column as its own Markdown bullet: the prompt context before compaction, for comparison."""
+    details = ["**Patient Record:**"]
+    for key, value in patient_data.items():
+        clean_key = key.replace('_', ' ').title()
+        if 'risk' in key and isinstance(value, float):
+            display_value = f"{value:.1%}"
+        elif key.startswith('sp_') and value in [0, 1]:
+            display_value = 'Yes' if value == 1 else 'No'
+        else:
+            display_value = value if value is not None else "N/A"
+        details.append(f"- **{clean_key}:** {display_value}")
+    return "\n".join(details)
+
+
+def build_patient_context(patient_data, token_budget=CONTEXT_TOKEN_BUDGET):
+    """The compact prompt context for a patient record, trimmed to ``token_budget`` (0 = no limit)."""
+    return _build(patient_data, token_budget)[0]
+
+
+def context_token_report(patient_data, token_budget=CONTEXT_TOKEN_BUDGET):
+    """Estimated tokens of the full and compact contexts and the number of lines dropped for the budget."""
+    text, dropped = _build(patient_data, token_budget, record=False)
+    return {
+        'full_tokens': estimate_tokens(format_full_context(patient_data or {})),
+        'compact_tokens': estimate_tokens(text),
+        'dropped_lines': dropped,
+    }
+
+
+def _build(patient_data, token_budget, record=True):
+    if not patient_data:
+        return "No patient data available.", 0
+    lines = [line for line in (builder(patient_data) for builder in LINE_BUILDERS) if line]
+    tokens = estimate_tokens("\n".join(lines))
+    dropped = 0
+    while token_budget and len(lines) > MIN_LINES and tokens > token_budget:
+        lines.pop()
+        dropped += 1
+        tokens = estimate_tokens("\n".join(lines))
+    if record:
+        with _stats_lock:
+            _stats['contexts'] += 1
+            _stats['compact_tokens'] += tokens
+            _stats['trimmed'] += 1 if dropped else 0
+    return "\n".join(lines), dropped
+
+
+def get_context_stats():
+    """Estimated tokens of the prompt contexts built by this process and how many were trimmed."""
+    with _stats_lock:
+        stats = dict(_stats)
+    if stats['contexts']:
+        stats['avg_compact_tokens'] = round(stats['compact_tokens'] / stats['contexts'], 1)
+    return stats
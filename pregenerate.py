@@ -0,0 +1,138 @@
+"""Pre-generates AI summaries for high-risk patients.
+
+Pages through patient_analysis highest tier first and calls get_ai_summary
+for every patient whose current record has no cached summary yet, so the
+detail page is served from ai_content_cache. Because the cache key is a
+hash of the formatted record, unchanged patients are skipped and changed
+ones regenerated.
+
+Run from the CLI with ``flask pregenerate-summaries`` or start it from the
+admin API; progress and the resume checkpoint live in job_runs.
+"""
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from ai_cache import has_content
+from data import execute_query, PATIENT_DETAILS_SELECT
+from interven import get_ai_summary, summary_cache_key
+from jobs import RateLimiter, job_lock, create_run, find_resumable_run, save_progress, get_run
+
+logger = logging.getLogger(__name__)
+
+JOB_NAME = 'ai_summaries'
+DEFAULT_TIERS = (5, 4)
+DEFAULT_CONCURRENCY = int(os.getenv("SUMMARY_JOB_CONCURRENCY", 4))
+DEFAULT_REQUESTS_PER_MINUTE = int(os.getenv("SUMMARY_JOB_RPM", 60))
+DEFAULT_PAGE_SIZE = 200
+
+
+def _count_patients(tiers):
+    return execute_query("SELECT COUNT(*) AS n FROM patient_analysis WHERE risk_tier = ANY(%s)", (list(tiers),))[0]['n']
+
+
+def _fetch_page(tiers, checkpoint, page_size):
+    """Next page of patient records after ``checkpoint``, ordered by tier desc then id."""
+    query = PATIENT_DETAILS_SELECT + "WHERE pa.risk_tier = ANY(%s)"
+    params = [list(tiers)]
+    if checkpoint:
+        query += " AND (pa.risk_tier, pa.DESYNPUF_ID) < (%s, %s)"
+        params += [checkpoint['risk_tier'], checkpoint['desynpuf_id']]
+    query += " ORDER BY pa.risk_tier DESC, pa.DESYNPUF_ID DESC LIMIT %s"
+    params.append(page_size)
+    return [dict(row) for row in execute_query(query, params)]
+
+
+def _summarize(patient_data, limiter):
+    """Returns 'skipped', 'generated' or 'failed' for one patient."""
+    cache_key = summary_cache_key(patient_data)
+    try:
+        if has_content(cache_key):
+            return 'skipped'
+        limiter.acquire()
+        get_ai_summary(patient_data)
+        # get_ai_summary only caches successful generations
+        return 'generated' if has_content(cache_key) else 'failed'
+    except Exception as e:
+        logger.warning(f"Summary job: patient {patient_data.get('desynpuf_id')} failed: {e}")
+        return 'failed'
+
+
+def run_summary_job(tiers=DEFAULT_TIERS, concurrency=DEFAULT_CONCURRENCY,
+                    requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE, page_size=DEFAULT_PAGE_SIZE,
+                    resume=True, on_start=None):
+    """Runs the job to completion and returns its job_runs row.
+
+    With ``resume`` an unfinished run for the same tiers continues from its
+    checkpoint. ``on_start(run_id)`` is called once the run is registered.
+    Raises JobAlreadyRunning if another process holds the job.
+    """
+    tiers = sorted({int(tier) for tier in tiers}, reverse=True)
+    params = {'tiers': tiers}
+
+    with job_lock(JOB_NAME):
+        run = find_resumable_run(JOB_NAME, params) if resume else None
+        if run:
+            run_id, progress, checkpoint = run['id'], dict(run['progress']), run['checkpoint']
+            logger.info(f"Resuming summary job run {run_id} after {checkpoint}")
+        else:
+            progress = {'total': _count_patients(tiers), 'processed': 0, 'generated': 0, 'skipped': 0, 'failed': 0}
+            run_id, checkpoint = create_run(JOB_NAME, params, progress), None
+        if on_start:
+            on_start(run_id)
+
+        limiter = RateLimiter(requests_per_minute)
+        started = time.perf_counter()
+        processed_here = 0
+        try:
+            save_progress(run_id, progress)
+            with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+                while True:
+                    page = _fetch_page(tiers, checkpoint, page_size)
+                    if not page:
+                        break
+                    for outcome in pool.map(lambda patient: _summarize(patient, limiter), page):
+                        progress[outcome] += 1
+                    progress['processed'] += len(page)
+                    processed_here += len(page)
+                    checkpoint = {'risk_tier': page[-1]['risk_tier'], 'desynpuf_id': page[-1]['desynpuf_id']}
+                    save_progress(run_id, progress, checkpoint)
+                    rate = processed_here / (time.perf_counter() - started)
+                    logger.info(f"Summary job run {run_id}: {progress['processed']}/{progress['total']} processed "
+                                f"({progress['generated']} generated, {progress['skipped']} unchanged, "
+                                f"{progress['failed']} failed, {rate:.1f}/sec)",
+                                extra={'run_id': run_id, 'progress': dict(progress)})
+        except BaseException as e:
+            save_progress(run_id, progress, checkpoint, status='failed', error=str(e) or type(e).__name__)
+            raise
+        save_progress(run_id, progress, checkpoint, status='completed')
+    return get_run(run_id)
+
+
+def start_summary_job(**options):
+    """Starts run_summary_job in a background thread and returns its run id.
+
+    Raises JobAlreadyRunning if the job is already running anywhere.
+    """
+    started = threading.Event()
+    outcome = {}
+
+    def on_start(run_id):
+        outcome['run_id'] = run_id
+        started.set()
+
+    def target():
+        try:
+            run_summary_job(on_start=on_start, **options)
+        except Exception as e:
+            outcome.setdefault('error', e)
+            logger.exception("Summary job failed")
+        finally:
+            started.set()
+
+    threading.Thread(target=target, name='summary-job', daemon=True).start()
+    started.wait()
+    if 'run_id' not in outcome:
+        raise outcome.get('error') or RuntimeError("Summary job did not start")
+    return outcome['run_id']
@@ -0,0 +1,133 @@
+"""Rescores every patient in patient_analysis with the active models.
+
+Rows are streamed in desynpuf_id order through a named (server-side)
+cursor, ``chunk_size`` at a time, and each chunk is scored in a process
+pool. The scores and the columns computed from them are written back in
+read order with ingest.upsert_analysis_frame, skipping rows whose scores did
+not change; stored inputs are only read, so a NULL input is scored as 0 (as
+an upload would be) but stays NULL in the table. The last written id is
+the resume checkpoint in job_runs. At most ``workers * 2`` chunks are in
+flight, so memory stays flat whatever the size of the table.
+
+Run from the CLI with ``flask rescore``.
+"""
+import logging
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+from data import db_connection, execute_query, get_db_connection, invalidate_reference_data, invalidate_patient_records
+from ingest import DERIVED_COLUMNS, INPUT_COLUMNS, derive_features_frame, upsert_analysis_frame
+from jobs import job_lock, create_run, find_resumable_run, save_progress, get_run
+from predictor import predictor, score_frame, ANALYSIS_COLUMNS, CONDITION_FIELDS
+
+logger = logging.getLogger(__name__)
+
+JOB_NAME = 'rescore'
+DEFAULT_CHUNK_SIZE = int(os.getenv("RESCORE_CHUNK_SIZE", 5000))
+DEFAULT_WORKERS = int(os.getenv("RESCORE_WORKERS", os.cpu_count() or 1))
+
+# Stored inputs the features are derived from; everything else is recomputed
+SOURCE_COLUMNS = ['desynpuf_id'] + INPUT_COLUMNS + [field.lower() for field in CONDITION_FIELDS]
+
+# Written back: the scores and what is computed from them, never the inputs or flags derived from them
+RESCORED_COLUMNS = ['desynpuf_id'] + [column for column in ANALYSIS_COLUMNS
+                                      if column not in SOURCE_COLUMNS and column not in DERIVED_COLUMNS]
+
+
+def _score_chunk(chunk):
+    """Derives features for one chunk of stored rows and scores them. Runs in a pool process."""
+    frame, errors = derive_features_frame(chunk)
+    if not frame.empty:
+        score_frame(frame)
+    return frame.reindex(columns=RESCORED_COLUMNS), errors
+
+
+def _read_chunks(checkpoint, chunk_size):
+    """Yields DataFrames of stored rows after ``checkpoint``, streamed by a server-side cursor."""
+    conn = get_db_connection()
+    try:
+        with conn.cursor(name='rescore_patients') as cursor:
+            cursor.itersize = chunk_size
+            cursor.execute(f"""
+                SELECT {', '.join(SOURCE_COLUMNS)} FROM patient_analysis
+                WHERE desynpuf_id > %s ORDER BY desynpuf_id
+            """, (checkpoint or '',))
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    return
+                yield pd.DataFrame(rows, columns=SOURCE_COLUMNS)
+    finally:
+        conn.close()
+
+
+def _write_chunk(frame):
+    """Stores one scored chunk; returns the number of rows whose scores changed."""
+    if frame.empty:
+        return 0
+    with db_connection() as conn:
+        _, updated = upsert_analysis_frame(conn, frame, columns=RESCORED_COLUMNS, insert_missing=False,
+                                           skip_unchanged=True)
+        conn.commit()
+    invalidate_patient_records(frame['desynpuf_id'])
+    return updated
+
+
+def run_rescore(chunk_size=DEFAULT_CHUNK_SIZE, workers=DEFAULT_WORKERS, resume=True):
+    """Rescores the whole table and returns the job_runs row.
+
+    With ``resume`` an unfinished run for the same model version continues
+    after its checkpoint. Raises JobAlreadyRunning if another process holds
+    the job.
+    """
+    params = {'model_version': predictor.model_version}
+
+    with job_lock(JOB_NAME):
+        run = find_resumable_run(JOB_NAME, params) if resume else None
+        if run:
+            run_id, progress, checkpoint = run['id'], dict(run['progress']), run['checkpoint']
+            logger.info(f"Resuming rescore run {run_id} after {checkpoint}")
+        else:
+            total = execute_query("SELECT COUNT(*) AS n FROM patient_analysis")[0]['n']
+            progress = {'total': total, 'processed': 0, 'updated': 0, 'failed': 0}
+            run_id, checkpoint = create_run(JOB_NAME, params, progress), None
+
+        started = time.perf_counter()
+        processed_here = 0
+        chunks = _read_chunks(checkpoint and checkpoint['desynpuf_id'], chunk_size)
+        try:
+            save_progress(run_id, progress)
+            with ProcessPoolExecutor(max_workers=max(1, workers)) as pool:
+                in_flight = deque()
+                while True:
+                    for chunk in chunks:
+                        in_flight.append((chunk['desynpuf_id'].iloc[-1], len(chunk), pool.submit(_score_chunk, chunk)))
+                        if len(in_flight) >= max(1, workers) * 2:
+                            break
+                    if not in_flight:
+                        break
+
+                    # Written in read order, so everything up to the checkpoint is stored
+                    last_id, size, future = in_flight.popleft()
+                    frame, errors = future.result()
+                    progress['updated'] += _write_chunk(frame)
+                    progress['failed'] += len(errors)
+                    progress['processed'] += size
+                    processed_here += size
+                    checkpoint = {'desynpuf_id': last_id}
+                    save_progress(run_id, progress, checkpoint)
+
+                    rate = processed_here / (time.perf_counter() - started)
+                    logger.info(f"Rescore run {run_id}: {progress['processed']}/{progress['total']} rows "
+                                f"({progress['updated']} changed, {progress['failed']} failed, {rate:.0f} rows/sec)",
+                                extra={'run_id': run_id, 'progress': dict(progress)})
+        except BaseException as e:
+            save_progress(run_id, progress, checkpoint, status='failed', error=str(e) or type(e).__name__)
+            raise
+        finally:
+            chunks.close()
+            invalidate_reference_data()
+        save_progress(run_id, progress, checkpoint, status='completed')
+    return get_run(run_id)
@@ -0,0 +1,68 @@
+"""Patient search over member ID, name and age.
+
+Every branch of the match is served by an index from
+migrations/002_patient_search_indexes.sql:
+
+- ID and name prefixes use ``lower(...) text_pattern_ops`` b-tree indexes.
+- ID and name substrings (3+ characters) and fuzzy name matches use pg_trgm GIN indexes.
+- Numeric terms of up to three digits also match ``age`` exactly.
+
+Matches are collected per table in a UNION subquery, so PostgreSQL can use
+the indexes on each table instead of scanning the whole join.
+"""
+
+# Shortest term pg_trgm can narrow down; shorter terms only match prefixes
+MIN_SUBSTRING_LENGTH = 3
+MAX_AGE_DIGITS = 3
+
+# Relevance of a row for the current term, highest first. Exact > prefix > substring > fuzzy.
+SEARCH_RANK_SQL = """(GREATEST(
+        CASE WHEN lower(pa.DESYNPUF_ID) = %(search_term)s THEN 1.0
+             WHEN lower(pa.DESYNPUF_ID) LIKE %(search_prefix)s THEN 0.9
+             WHEN lower(pa.DESYNPUF_ID) LIKE %(search_contains)s THEN 0.6
+             ELSE 0 END,
+        CASE WHEN lower(p.name) = %(search_term)s THEN 0.95
+             WHEN lower(p.name) LIKE %(search_prefix)s THEN 0.8
+             WHEN lower(p.name) LIKE %(search_contains)s THEN 0.7
+             ELSE COALESCE(similarity(lower(p.name), %(search_term)s), 0) * 0.7 END,
+        CASE WHEN pa.age = %(search_age)s THEN 0.5 ELSE 0 END
+    ))::float8"""
+
+
+def _escape_like(term):
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def build_search_clause(search):
+    """Builds the search condition for ``patient_analysis pa``.
+
+    Returns ``(condition_sql, params)`` with named parameters, or ``(None, {})``
+    for a blank term. The params also feed SEARCH_RANK_SQL.
+    """
+    term = (search or '').strip().lower()
+    if not term:
+        return None, {}
+
+    escaped = _escape_like(term)
+    substring = len(term) >= MIN_SUBSTRING_LENGTH
+    params = {
+        'search_term': term,
+        'search_prefix': f'{escaped}%',
+        'search_contains': f'%{escaped}%' if substring else f'{escaped}%',
+        'search_age': int(term) if term.isdigit() and len(term) <= MAX_AGE_DIGITS else None
+    }
+
+    id_matches = ["lower(desynpuf_id) LIKE %(search_contains)s"]
+    if params['search_age'] is not None:
+        id_matches.append("age = %(search_age)s")
+
+    name_matches = ["lower(name) LIKE %(search_contains)s"]
+    if substring:
+        name_matches.append("lower(name) %% %(search_term)s")
+
+    condition = f"""pa.DESYNPUF_ID IN (
+        SELECT desynpuf_id FROM patient_analysis WHERE {' OR '.join(id_matches)}
+        UNION
+        SELECT desynpuf_id FROM patients WHERE {' OR '.join(name_matches)}
+    )"""
+    return condition, params
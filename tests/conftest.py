@@ -0,0 +1,79 @@
+"""Points the app at a small fitted model bundle before predictor is imported.
+
+predictor loads the active models at import time, so the bundle is written
+to a temporary MODEL_ROOT and activated here, ahead of any test module.
+"""
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.linear_model import LogisticRegression
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import StandardScaler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+TEST_VERSION = 'test'
+FEATURE_COLUMNS = [
+    'age', 'gender_male', 'race_white', 'race_black', 'chronic_condition_count', 'high_impact_conditions',
+    'sp_chf', 'sp_diabetes', 'sp_chrnkidn', 'sp_cncr', 'sp_copd', 'sp_depressn', 'sp_ischmcht',
+    'sp_strketia', 'sp_alzhdmta', 'sp_osteoprs', 'sp_ra_oa', 'inpatient_admissions', 'inpatient_days',
+    'outpatient_visits', 'total_medicare_costs', 'prior_hospitalization', 'age_65_74', 'age_75_84', 'age_85_plus',
+]
+
+
+def training_frame(rows, seed=0):
+    """Synthetic patients shaped like patient_analysis rows."""
+    rng = np.random.default_rng(seed)
+    frame = pd.DataFrame(0, index=range(rows), columns=FEATURE_COLUMNS, dtype=float)
+    frame['age'] = rng.integers(20, 100, rows)
+    for column in FEATURE_COLUMNS[1:4] + FEATURE_COLUMNS[6:17]:
+        frame[column] = rng.random(rows) < 0.3
+    frame['chronic_condition_count'] = frame[FEATURE_COLUMNS[6:17]].sum(axis=1)
+    frame['high_impact_conditions'] = frame[['sp_chf', 'sp_chrnkidn', 'sp_cncr', 'sp_copd']].sum(axis=1)
+    frame['inpatient_admissions'] = rng.poisson(0.5, rows)
+    frame['inpatient_days'] = frame['inpatient_admissions'] * rng.integers(1, 8, rows)
+    frame['outpatient_visits'] = rng.poisson(6, rows)
+    frame['total_medicare_costs'] = rng.gamma(2.0, 6000.0, rows).round(2)
+    frame['prior_hospitalization'] = frame['inpatient_admissions'] > 0
+    frame['age_65_74'] = frame['age'].between(65, 74)
+    frame['age_75_84'] = frame['age'].between(75, 84)
+    frame['age_85_plus'] = frame['age'] >= 85
+    return frame.astype(float)
+
+
+def write_bundle(directory):
+    """Fits the preprocessing pipeline and a LogisticRegression/RandomForest pair per target."""
+    frame = training_frame(2000)
+    risk = (0.03 * (frame['age'] - 60) + 0.8 * frame['chronic_condition_count'] - 3
+            + 0.9 * frame['inpatient_admissions'] + np.random.default_rng(1).normal(size=len(frame)))
+    pipeline = Pipeline([('scaler', StandardScaler())]).fit(frame)
+    X = pipeline.transform(frame)
+    models = {
+        '30d_hospitalization': LogisticRegression(max_iter=1000).fit(X, risk > 0.5),
+        '60d_hospitalization': RandomForestClassifier(n_estimators=15, max_depth=8, random_state=0).fit(X, risk > 0),
+        '90d_hospitalization': LogisticRegression(max_iter=1000).fit(X, risk > -0.5),
+        'mortality': RandomForestClassifier(n_estimators=10, max_depth=6, random_state=1).fit(X, risk > 1.5),
+    }
+    os.makedirs(directory)
+    with open(os.path.join(directory, 'preprocessing_pipeline.pkl'), 'wb') as f:
+        pickle.dump(pipeline, f)
+    with open(os.path.join(directory, 'risk_models.pkl'), 'wb') as f:
+        pickle.dump({'models': models, 'feature_columns': FEATURE_COLUMNS}, f)
+
+
+_model_root = tempfile.mkdtemp(prefix='medcare-models-')
+write_bundle(os.path.join(_model_root, TEST_VERSION))
+with open(os.path.join(_model_root, 'ACTIVE'), 'w') as f:
+    f.write(TEST_VERSION + '\n')
+os.environ['MODEL_ROOT'] = _model_root
+os.environ['RECORD_CACHE_BACKEND'] = 'memory'
+
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(_model_root, ignore_errors=True)
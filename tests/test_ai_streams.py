@@ -0,0 +1,54 @@
+"""Streamed Gemini responses abandoned by the client are cancelled, or the failure to is counted."""
+import time
+import types
+
+import pytest
+
+pytest.importorskip('google.generativeai')
+
+import interven
+from metrics import LLM_STREAM_CANCELS
+
+
+class FakeStream:
+    def __init__(self, call):
+        if call is not None:
+            self._iterator = call
+
+    def __iter__(self):
+        for text in ['one ', 'two ', 'three']:
+            yield types.SimpleNamespace(text=text)
+
+
+def cancels(outcome):
+    return LLM_STREAM_CANCELS.labels('chat', outcome)._value.get()
+
+
+def abandon_after_first_chunk(response):
+    stream = interven._stream_text(response, 'chat', time.perf_counter())
+    assert next(stream) == 'one '
+    stream.close()
+
+
+def test_abandoned_stream_cancels_the_call():
+    call = types.SimpleNamespace(cancelled=False)
+    call.cancel = lambda: setattr(call, 'cancelled', True)
+    before = cancels('cancelled')
+    abandon_after_first_chunk(FakeStream(call))
+    assert call.cancelled
+    assert cancels('cancelled') == before + 1
+
+
+def test_uncancellable_stream_is_logged_and_counted(caplog):
+    before = cancels('not_cancellable')
+    abandon_after_first_chunk(FakeStream(None))
+    assert cancels('not_cancellable') == before + 1
+    assert 'Cannot cancel abandoned chat AI stream' in caplog.text
+
+
+def test_finished_stream_is_not_cancelled():
+    call = types.SimpleNamespace(cancelled=False)
+    call.cancel = lambda: setattr(call, 'cancelled', True)
+    stream = interven._stream_text(FakeStream(call), 'chat', time.perf_counter())
+    assert ''.join(stream) == 'one two three'
+    assert not call.cancelled
@@ -0,0 +1,188 @@
+"""Chat sessions: what each message sends to Gemini, and conversations shared between workers.
+
+Gemini is replaced by a fake that records every request a chat message
+would make, and chat_history by an in-memory store.
+"""
+import types
+
+import pytest
+
+pytest.importorskip('google.generativeai')
+
+import interven
+from patient_context import estimate_tokens
+
+PATIENT = {'desynpuf_id': 'P0001', 'name': 'Testpatient Zebulon', 'age': 78, 'gender': 'Female', 'risk_tier': 4,
+           'sp_chf': 1, 'sp_diabetes': 1, 'mortality_score': 0.12, 'inpatient_admissions': 2}
+
+
+class FakeGemini:
+    """Stands in for google.generativeai; ``requests`` holds what each chat message sent."""
+
+    def __init__(self, reply_words):
+        self.reply = ' '.join(['word'] * reply_words)
+        self.requests = []
+        self.caches = []
+        gemini = self
+
+        class CachedContent:
+            @classmethod
+            def create(cls, model, system_instruction, contents, ttl):
+                cache = types.SimpleNamespace(system_instruction=system_instruction, contents=contents or [],
+                                              deleted=False)
+                cache.delete = lambda: setattr(cache, 'deleted', True)
+                gemini.caches.append(cache)
+                return cache
+
+        class GenerativeModel:
+            def __init__(self, model_name=None, system_instruction=None, cache=None):
+                self.system_instruction, self.cache = system_instruction, cache
+
+            @classmethod
+            def from_cached_content(cls, cache):
+                return cls(cache=cache)
+
+            def start_chat(self, history):
+                return FakeChat(gemini, self, history)
+
+        self.caching = types.SimpleNamespace(CachedContent=CachedContent)
+        self.GenerativeModel = GenerativeModel
+
+
+def _content(role, text):
+    return types.SimpleNamespace(role=role, parts=[types.SimpleNamespace(text=text)])
+
+
+class FakeChat:
+    def __init__(self, gemini, model, history):
+        self.gemini, self.model = gemini, model
+        self.history = [_content(turn['role'], ''.join(turn['parts'])) for turn in history]
+
+    def send_message(self, text):
+        self.gemini.requests.append({
+            'cached': self.model.cache,
+            # Everything below is sent, and billed, with this message
+            'sent': '\n'.join([self.model.system_instruction or '']
+                              + [content.parts[0].text for content in self.history] + [text]),
+        })
+        self.history += [_content('user', text), _content('model', self.gemini.reply)]
+        return types.SimpleNamespace(text=self.gemini.reply)
+
+
+@pytest.fixture
+def store(monkeypatch):
+    """chat_history in memory: (user key, patient id) -> [turns, version]."""
+    rows = {}
+    calls = {'version': 0, 'load': 0}
+
+    def history_version(user_key, patient_id):
+        calls['version'] += 1
+        return rows[(user_key, patient_id)][1] if (user_key, patient_id) in rows else 0
+
+    def load_history(user_key, patient_id):
+        calls['load'] += 1
+        turns, version = rows.get((user_key, patient_id), ([], 0))
+        return list(turns), version
+
+    def save_history(user_key, patient_id, turns, version):
+        if rows.get((user_key, patient_id), ([], 0))[1] != version:
+            return None
+        rows[(user_key, patient_id)] = [list(turns), version + 1]
+        return version + 1
+
+    monkeypatch.setattr(interven, 'history_version', history_version)
+    monkeypatch.setattr(interven, 'load_history', load_history)
+    monkeypatch.setattr(interven, 'save_history', save_history)
+    return types.SimpleNamespace(rows=rows, calls=calls)
+
+
+def fake_gemini(monkeypatch, reply_words):
+    gemini = FakeGemini(reply_words)
+    monkeypatch.setattr(interven, 'genai', gemini)
+    monkeypatch.setattr(interven, 'CONTEXT_CACHE_ENABLED', True)
+    return gemini
+
+
+def chat(manager, message, patient=PATIENT, user='user:1'):
+    session = manager.get(user, patient)
+    with session.lock:
+        reply = interven.get_ai_response(session.chat, message)
+        manager.save(session)
+    return session, reply
+
+
+def test_patient_context_alone_is_below_the_cache_minimum():
+    # Why the context cannot simply be cached up front: it is too small on its own
+    assert estimate_tokens(interven.chat_system_instruction(PATIENT)) < interven.CONTEXT_CACHE_MIN_TOKENS
+
+
+def test_follow_up_does_not_resend_the_patient_context(monkeypatch, store):
+    gemini = fake_gemini(monkeypatch, reply_words=interven.CONTEXT_CACHE_MIN_TOKENS)
+    manager = interven.ChatSessionManager()
+    chat(manager, 'What are the main risks?')
+    chat(manager, 'And what should we do first?')
+
+    first, follow_up = gemini.requests
+    assert 'Testpatient Zebulon' in first['sent'] and first['cached'] is None
+    # The first exchange went into cached content with the context, once
+    cache = follow_up['cached']
+    assert cache is gemini.caches[0]
+    assert 'Testpatient Zebulon' in cache.system_instruction
+    assert [turn['parts'] for turn in cache.contents] == [['What are the main risks?'], [gemini.reply]]
+    assert 'Testpatient Zebulon' not in follow_up['sent']
+    assert follow_up['sent'].strip() == 'And what should we do first?'
+    # The second long reply is worth caching too
+    assert manager.stats()['cached'] == len(gemini.caches) == 2
+    assert gemini.caches[0].deleted
+
+
+def test_short_conversation_is_cached_once_it_reaches_the_minimum(monkeypatch, store):
+    gemini = fake_gemini(monkeypatch, reply_words=150)
+    manager = interven.ChatSessionManager()
+    for n in range(12):
+        chat(manager, f'Question {n}?')
+
+    cached_at = next(n for n, request in enumerate(gemini.requests) if request['cached'] is not None)
+    assert cached_at > 1
+    # Until then the context goes with each message, and the resent tokens never pass the minimum by much
+    for request in gemini.requests:
+        assert estimate_tokens(request['sent']) < interven.CONTEXT_CACHE_MIN_TOKENS + 200
+    assert all('Testpatient Zebulon' not in request['sent'] for request in gemini.requests[cached_at:])
+    # Caches that were replaced are deleted
+    assert all(cache.deleted for cache in gemini.caches[:-1]) and not gemini.caches[-1].deleted
+    assert len(store.rows[('user:1', 'P0001')][0]) == 24
+
+
+def test_reused_session_checks_only_the_stored_version(monkeypatch, store):
+    fake_gemini(monkeypatch, reply_words=5)
+    formatted = []
+    format_context = interven._format_patient_context
+    monkeypatch.setattr(interven, '_format_patient_context',
+                        lambda patient_data: formatted.append(1) or format_context(patient_data))
+    manager = interven.ChatSessionManager()
+    first, _ = chat(manager, 'Hello')
+    second, _ = chat(manager, 'Again')
+    assert second is first
+    assert len(formatted) == 1
+    assert store.calls == {'version': 2, 'load': 0}
+    assert manager.stats()['reused'] == 1
+
+    # A changed record rebuilds the context but keeps the conversation
+    third, _ = chat(manager, 'Updated?', patient={**PATIENT, 'age': 79})
+    assert third is not first
+    assert len(formatted) == 2
+    assert len(store.rows[('user:1', 'P0001')][0]) == 6
+
+
+def test_conversation_continues_on_another_worker(monkeypatch, store):
+    fake_gemini(monkeypatch, reply_words=5)
+    worker_a, worker_b = interven.ChatSessionManager(), interven.ChatSessionManager()
+    chat(worker_a, 'First question')
+    session_b, _ = chat(worker_b, 'Second question')
+    assert [turn['text'] for turn in session_b.turns()][::2] == ['First question', 'Second question']
+
+    # worker_a's live session is behind the store now, so it is rebuilt from the stored turns
+    session_a, _ = chat(worker_a, 'Third question')
+    assert [turn['text'] for turn in session_a.turns()][::2] == ['First question', 'Second question', 'Third question']
+    assert worker_a.stats()['synced'] == 1
+    assert store.rows[('user:1', 'P0001')][1] == 3
@@ -0,0 +1,96 @@
+"""FastScorer must score exactly like the pandas + scikit-learn path it replaces."""
+import math
+
+import numpy as np
+import pytest
+
+import predictor
+from conftest import FEATURE_COLUMNS, TEST_VERSION, training_frame
+
+
+@pytest.fixture(scope='module')
+def bundle():
+    return predictor.ModelBundle(TEST_VERSION)
+
+
+def assert_same_scores(bundle, record):
+    fast = bundle.fast_scorer.score(record)
+    slow = bundle._predict_slow(record)
+    assert fast is not None, record
+    assert fast.keys() == slow.keys()
+    for key in slow:
+        # Same floating-point operations in the same order: bit-for-bit equal, not just close
+        assert fast[key] == slow[key], (key, record)
+
+
+def test_bundle_uses_fast_path(bundle):
+    # The load-time probe check falls back to scikit-learn silently; a mismatch must fail here instead
+    assert bundle.fast_scorer is not None
+    assert bundle.fast_scorer.forests and bundle.fast_scorer.linear
+
+
+def test_random_records_match(bundle):
+    frame = training_frame(500, seed=7)
+    rng = np.random.default_rng(7)
+    for i, row in enumerate(frame.to_dict('records')):
+        if i % 3 == 0:
+            # Off-distribution values, not just the whole numbers real input has
+            row = {key: value + rng.normal(scale=5) for key, value in row.items()}
+        if i % 5 == 0:
+            # Missing features default to 0 and keys are case-insensitive, as in predict()
+            row = {(key.upper() if j % 2 else key): value for j, (key, value) in enumerate(row.items()) if j % 4}
+        assert_same_scores(bundle, row)
+
+
+@pytest.mark.parametrize('record', [
+    {},
+    {column: 0 for column in FEATURE_COLUMNS},
+    {column: 1 for column in FEATURE_COLUMNS},
+    {'age': 0},
+    {'age': 120, 'age_85_plus': 1},
+    {'age': 1e6},
+    {'age': -1e6},
+    {column: 1e12 for column in FEATURE_COLUMNS},
+    {'total_medicare_costs': -0.0, 'inpatient_days': 5e-324},
+    {'age': 70, 'unknown_feature': 3, 'name': 'not a feature'},
+], ids=['empty', 'zeros', 'ones', 'age-zero', 'age-120', 'age-huge', 'age-negative', 'all-huge',
+        'signed-zero-subnormal', 'extra-keys'])
+def test_edge_values_match(bundle, record):
+    assert_same_scores(bundle, record)
+
+
+def test_tree_thresholds_match(bundle):
+    # Values exactly at, and one float step either side of, every split threshold
+    forest = bundle.models['60d_hospitalization']
+    mean, scale = bundle.fast_scorer.scalers[0]
+    for estimator in forest.estimators_[:3]:
+        tree = estimator.tree_
+        for node in np.flatnonzero(tree.children_left != -1)[:20]:
+            feature, threshold = tree.feature[node], tree.threshold[node]
+            for scaled in (threshold, np.nextafter(threshold, -np.inf), np.nextafter(threshold, np.inf)):
+                assert_same_scores(bundle, {FEATURE_COLUMNS[feature]: scaled * scale[feature] + mean[feature]})
+
+
+@pytest.mark.parametrize('record', [
+    {column: math.nan for column in FEATURE_COLUMNS},
+    {'age': math.nan},
+    {'age': math.inf},
+    {'age': None},
+], ids=['nan-filled', 'nan-age', 'inf-age', 'none-age'])
+def test_non_finite_records_defer_to_sklearn(bundle, record):
+    assert bundle.fast_scorer.score(record) is None
+    try:
+        expected = bundle._predict_slow(record)
+    except Exception as e:
+        with pytest.raises(type(e)):
+            bundle.predict(record)
+    else:
+        assert bundle.predict(record) == expected
+
+
+def test_large_forests_stay_on_sklearn(bundle):
+    node_count = sum(estimator.tree_.node_count for model in bundle.models.values()
+                     for estimator in getattr(model, 'estimators_', []))
+    with pytest.raises(ValueError, match='nodes'):
+        predictor.FastScorer(bundle.pipeline, bundle.models, bundle.feature_columns, max_nodes=node_count - 1)
+    assert predictor.FastScorer(bundle.pipeline, bundle.models, bundle.feature_columns, max_nodes=node_count)
@@ -0,0 +1,83 @@
+"""InferenceScheduler: when it batches, and that callers never wait forever on a batch."""
+import threading
+
+import pytest
+
+import predictor
+from conftest import training_frame
+
+RECORDS = training_frame(64, seed=11).to_dict('records')
+
+
+def predict_concurrently(scheduler, records):
+    results = [None] * len(records)
+
+    def score(i):
+        results[i] = scheduler.predict(records[i])
+
+    threads = [threading.Thread(target=score, args=(i,)) for i in range(len(records))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_fast_path_scores_inline_by_default():
+    scheduler = predictor.InferenceScheduler(predictor.predictor)
+    assert predictor.predictor.bundle.fast_scorer is not None
+    predict_concurrently(scheduler, RECORDS)
+    assert scheduler.stats()['inline'] == len(RECORDS)
+    assert scheduler.stats()['batches'] == 0
+
+
+def test_batched_scores_match_inline_scores():
+    scheduler = predictor.InferenceScheduler(predictor.predictor, inline_max_concurrency=0, max_wait=0.05)
+    results = predict_concurrently(scheduler, RECORDS)
+    bundle = predictor.predictor.bundle
+    for (scores, version), record in zip(results, RECORDS):
+        # BLAS sums a matrix's dot products in another order than one row's, so only close
+        assert scores == pytest.approx(bundle.predict(record), rel=1e-12)
+        assert version == bundle.version
+    stats = scheduler.stats()
+    assert stats['inline'] == 0 and stats['requests'] == len(RECORDS)
+    assert stats['batches'] < len(RECORDS)
+
+
+def test_stuck_batch_falls_back_to_inline(monkeypatch):
+    scheduler = predictor.InferenceScheduler(predictor.predictor, inline_max_concurrency=0, timeout=0.05)
+    release = threading.Event()
+    monkeypatch.setattr(scheduler, '_score', lambda batch: release.wait())
+    try:
+        bundle = predictor.predictor.bundle
+        assert scheduler.predict(RECORDS[0]) == (bundle.predict(RECORDS[0]), bundle.version)
+        assert scheduler.stats()['timeouts'] == 1
+    finally:
+        release.set()
+
+
+@pytest.mark.filterwarnings('ignore::pytest.PytestUnhandledThreadExceptionWarning')
+def test_dead_batch_thread_is_replaced(monkeypatch):
+    scheduler = predictor.InferenceScheduler(predictor.predictor, inline_max_concurrency=0, timeout=0.05)
+
+    def die(batch):
+        raise SystemExit
+
+    monkeypatch.setattr(scheduler, '_score', die)
+    scheduler.predict(RECORDS[0])
+    scheduler._worker.join(1)
+    assert not scheduler._worker.is_alive()
+
+    monkeypatch.undo()
+    scheduler.timeout = 5
+    bundle = predictor.predictor.bundle
+    assert scheduler.predict(RECORDS[1]) == (bundle.predict(RECORDS[1]), bundle.version)
+    assert scheduler.stats()['batches'] == 1
+
+
+@pytest.mark.parametrize('max_batch_size', [1, 0])
+def test_batch_size_one_turns_batching_off(max_batch_size):
+    scheduler = predictor.InferenceScheduler(predictor.predictor, max_batch_size=max_batch_size,
+                                             inline_max_concurrency=0)
+    scheduler.predict(RECORDS[0])
+    assert scheduler._worker is None
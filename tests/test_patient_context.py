@@ -0,0 +1,85 @@
+"""The token-budgeted patient context: what it keeps, and that it stays within budget."""
+import pytest
+
+import patient_context
+from patient_context import CONTEXT_TOKEN_BUDGET, build_patient_context, estimate_tokens, get_context_stats
+
+FULL_RECORD = {
+    'desynpuf_id': '00013D2EFD8E45D1', 'name': 'Testpatient Zebulon', 'age': 78, 'gender_male': 0,
+    'race_white': 1, 'race_black': 0, 'risk_tier': 4, 'risk_tier_label': 'High Risk',
+    'risk_30d_hospitalization': 0.4213, 'hospitalization_30d_score': 0.4213,
+    'risk_60d_hospitalization': 0.5127, 'risk_90d_hospitalization': 0.6034, 'mortality_risk': 0.0,
+    **{key: 1 for key, _ in patient_context.CONDITION_LABELS},
+    'chronic_condition_count': 11, 'high_impact_conditions': 5,
+    'inpatient_admissions': 3, 'inpatient_days': 17, 'outpatient_visits': 24, 'prior_hospitalization': 1,
+    'total_medicare_costs': 48210.5, 'care_intervention': 'Intensive care management',
+    'annual_intervention_cost': 4200, 'cost_savings': 12875.25, 'prevented_hospitalizations': 0.85,
+    'sp_unused_column': 0, 'notes': None,
+}
+
+
+def lines(text):
+    return text.split('\n')
+
+
+def test_full_record_without_budget():
+    text = build_patient_context(FULL_RECORD, token_budget=0)
+    patient, risk, conditions, utilization, intervention = lines(text)
+    assert patient == 'Patient 00013D2EFD8E45D1 (Testpatient Zebulon): age 78, female, race White'
+    assert risk == ('Risk: tier 4 (High Risk); 30d hospitalization 42.1%; 60d hospitalization 51.3%; '
+                    '90d hospitalization 60.3%; mortality 0.0%')
+    assert conditions.startswith('Conditions: congestive heart failure, ') and '(11 chronic, 5 high-impact)' in conditions
+    assert utilization.startswith('Utilization: 3 inpatient admissions (17 days); 24 outpatient visits')
+    assert intervention.startswith('Recommended intervention: Intensive care management; $4,200/year')
+
+
+@pytest.mark.parametrize('budget', [CONTEXT_TOKEN_BUDGET, 120, 80, 60, 50])
+def test_context_stays_within_budget(budget):
+    text = build_patient_context(FULL_RECORD, token_budget=budget)
+    assert estimate_tokens(text) <= budget
+    assert lines(text)[0].startswith('Patient 00013D2EFD8E45D1')
+    assert lines(text)[1].startswith('Risk: tier 4')
+
+
+@pytest.mark.parametrize('budget', [40, 20, 1])
+def test_required_lines_survive_any_budget(budget):
+    # The patient and risk lines are never dropped, even when they alone are over budget
+    text = build_patient_context(FULL_RECORD, token_budget=budget)
+    assert lines(text) == lines(build_patient_context(FULL_RECORD, token_budget=0))[:patient_context.MIN_LINES]
+
+
+def test_lower_ranked_lines_are_dropped_first():
+    full = lines(build_patient_context(FULL_RECORD, token_budget=0))
+    for budget in range(estimate_tokens('\n'.join(full)), 0, -1):
+        kept = lines(build_patient_context(FULL_RECORD, token_budget=budget))
+        assert kept == full[:len(kept)]
+
+
+def test_output_ignores_key_order():
+    reordered = dict(reversed(list(FULL_RECORD.items())))
+    assert build_patient_context(reordered) == build_patient_context(FULL_RECORD)
+
+
+def test_missing_and_zero_fields_are_left_out():
+    text = build_patient_context({'desynpuf_id': 'P1', 'age': 0, 'risk_tier': 2, 'mortality_score': 0.0,
+                                  'sp_chf': 0, 'inpatient_admissions': 0, 'care_intervention': ''})
+    assert text == 'Patient P1\nRisk: tier 2; mortality 0.0%'
+
+
+def test_stats_count_only_built_contexts():
+    before = get_context_stats()
+    build_patient_context(FULL_RECORD, token_budget=40)
+    patient_context.context_token_report(FULL_RECORD, token_budget=40)
+    after = get_context_stats()
+    assert after['contexts'] == before['contexts'] + 1
+    assert after['trimmed'] == before['trimmed'] + 1
+
+
+def test_chat_context_caching_waits_for_the_conversation():
+    # The chatbot caches its instruction and patient context (user-010) only once what each message
+    # resends reaches Gemini's minimum; within the budget the context alone never does
+    interven = pytest.importorskip('interven')
+    instruction = interven.chat_system_instruction(FULL_RECORD)
+    assert build_patient_context(FULL_RECORD) in instruction
+    assert estimate_tokens(interven.CHATBOT_SYSTEM_INSTRUCTION) + CONTEXT_TOKEN_BUDGET < interven.CONTEXT_CACHE_MIN_TOKENS
+    assert estimate_tokens(instruction) < interven.CONTEXT_CACHE_MIN_TOKENS
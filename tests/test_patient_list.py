@@ -0,0 +1,83 @@
+"""Keyset pagination of the patient list: cursors and page boundaries."""
+import re
+
+import pytest
+
+import data
+
+
+def test_cursor_round_trip():
+    row = {'sort_0': 3, 'sort_1': 0.1 + 0.2, 'sort_2': 'P0000FFF/+='}
+    cursor = data.encode_cursor(row, 3)
+    assert re.fullmatch(r'[A-Za-z0-9_-]+', cursor)
+    key = data.decode_cursor(cursor, 3)
+    assert key == ['3', repr(0.1 + 0.2), 'P0000FFF/+=']
+    # The text goes back to SQL and is cast to the column type there; floats must survive exactly
+    assert float(key[1]) == 0.1 + 0.2
+
+
+@pytest.mark.parametrize('cursor', ['', 'not base64!', 'bm90IGpzb24', data.encode_cursor({'sort_0': 1}, 1)],
+                         ids=['empty', 'not-base64', 'not-json', 'wrong-size'])
+def test_bad_cursor_raises_value_error(cursor):
+    with pytest.raises(ValueError):
+        data.decode_cursor(cursor, 3)
+
+
+def _patients(count):
+    # Ties on tier and score, so the id column has to break them
+    return [{'id': f'P{n:04d}', 'name': f'Patient {n}', 'age': 70, 'risk_tier': n % 3, 'conditions': '',
+             'sort_0': n % 3, 'sort_1': [0.25, 0.5, 1 / 3][n % 2], 'sort_2': f'P{n:04d}'} for n in range(count)]
+
+
+@pytest.fixture
+def patient_table(monkeypatch):
+    rows = _patients(23)
+    key = lambda row: (row['sort_0'], row['sort_1'], row['sort_2'])
+
+    def execute_query(query, params=None, name=None):
+        # Applies the keyset condition the way Postgres does, casting the cursor text to each column's type
+        selected = rows
+        if 'cursor_0' in params:
+            cursor = tuple(type(value)(params[f'cursor_{i}']) for i, value in enumerate(key(rows[0])))
+            newer = ') < (' in query
+            selected = [row for row in rows if (key(row) < cursor if newer else key(row) > cursor)]
+        selected = sorted(selected, key=key, reverse='sort_0 DESC' in query)
+        return [dict(row) for row in selected[params['offset']:params['offset'] + params['limit']]]
+
+    monkeypatch.setattr(data, 'execute_query', execute_query)
+    monkeypatch.setattr(data, 'count_patients', lambda *args, **kwargs: (len(rows), True))
+    return sorted(rows, key=key, reverse=True)
+
+
+def _ids(patients):
+    return [patient['id'] for patient in patients]
+
+
+def test_pages_forward_then_back(patient_table):
+    expected = _ids(patient_table)
+    pages, after = [], None
+    while True:
+        patients, total, page_info = data.get_patient_list(limit=5, after=after)
+        assert total == len(expected)
+        assert bool(page_info['prev_cursor']) == bool(pages)
+        pages.append((_ids(patients), page_info))
+        after = page_info['next_cursor']
+        if not after:
+            break
+    assert [len(ids) for ids, _ in pages] == [5, 5, 5, 5, 3]
+    assert sum((ids for ids, _ in pages), []) == expected
+
+    # Walking back from the last page revisits the same pages in reverse
+    before = pages[-1][1]['prev_cursor']
+    for ids, _ in reversed(pages[:-1]):
+        patients, _, page_info = data.get_patient_list(limit=5, before=before)
+        assert _ids(patients) == ids
+        assert page_info['next_cursor']
+        before = page_info['prev_cursor']
+    assert before is None
+
+
+def test_exact_multiple_of_page_size_has_no_empty_last_page(patient_table):
+    patients, _, page_info = data.get_patient_list(limit=23)
+    assert len(patients) == 23
+    assert page_info['next_cursor'] is None and page_info['prev_cursor'] is None
@@ -0,0 +1,31 @@
+"""Intervention PDFs rendered in the process pool, and their render time metric."""
+import threading
+
+import pytest
+
+pytest.importorskip('google.generativeai')
+
+import interven
+from metrics import PDF_RENDER_SECONDS
+
+PATIENT = {'desynpuf_id': 'P0001', 'name': 'Testpatient Zebulon', 'age': 78, 'gender': 'Female', 'risk_tier': 4}
+PLAN = "## Summary\nKeep the follow-up visit.\n\n- Review medications weekly\n- Daily weight check"
+
+
+def renders(outcome):
+    return PDF_RENDER_SECONDS.labels(outcome)._sum.get(), sum(
+        bucket.get() for bucket in PDF_RENDER_SECONDS.labels(outcome)._buckets)
+
+
+def test_rendered_pdf_time_is_recorded():
+    total_before, count_before = renders('ok')
+    future = interven.submit_intervention_pdf(PATIENT, PLAN)
+    # Done callbacks run in the order they were added, after result() is already available
+    observed = threading.Event()
+    future.add_done_callback(lambda _: observed.set())
+    pdf_bytes, seconds = future.result(timeout=60)
+    assert observed.wait(5)
+    assert pdf_bytes.startswith(b'%PDF')
+    total_after, count_after = renders('ok')
+    assert count_after == count_before + 1
+    assert total_after == pytest.approx(total_before + seconds)
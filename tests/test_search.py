@@ -0,0 +1,54 @@
+"""The patient search clause: generated SQL and parameters."""
+import pytest
+
+from search import SEARCH_RANK_SQL, build_search_clause
+
+
+def render(condition, params):
+    # psycopg2 fills named placeholders with %-formatting, so the SQL must survive it with no stray %
+    return (condition + SEARCH_RANK_SQL) % {key: repr(value) for key, value in params.items()}
+
+
+@pytest.mark.parametrize('search', [None, '', '   ', '\t\n'])
+def test_blank_term_adds_no_condition(search):
+    assert build_search_clause(search) == (None, {})
+
+
+def test_long_term_matches_substrings_and_fuzzy_names():
+    condition, params = build_search_clause('  Smith ')
+    assert params == {'search_term': 'smith', 'search_prefix': 'smith%', 'search_contains': '%smith%',
+                      'search_age': None}
+    assert 'lower(name) %% %(search_term)s' in condition
+    assert 'age = %(search_age)s' not in condition
+    assert condition.count('UNION') == 1
+    assert "'smith'" in render(condition, params)
+
+
+def test_short_term_matches_prefixes_only():
+    condition, params = build_search_clause('ab')
+    assert params['search_contains'] == 'ab%'
+    # pg_trgm cannot narrow down a term this short, so no fuzzy name match
+    assert '%%' not in condition
+
+
+@pytest.mark.parametrize('search, age', [('7', 7), ('85', 85), ('100', 100), ('1000', None), ('8a', None)])
+def test_numeric_terms_also_match_age(search, age):
+    condition, params = build_search_clause(search)
+    assert params['search_age'] == age
+    assert ('age = %(search_age)s' in condition) == (age is not None)
+
+
+@pytest.mark.parametrize('search, prefix, contains', [
+    ('50%', '50\\%%', '%50\\%%'),
+    ('a_b', 'a\\_b%', '%a\\_b%'),
+    ('c:\\x', 'c:\\\\x%', '%c:\\\\x%'),
+    ("o'brien", "o'brien%", "%o'brien%"),
+])
+def test_like_wildcards_in_the_term_are_escaped(search, prefix, contains):
+    condition, params = build_search_clause(search)
+    assert params['search_term'] == search
+    assert params['search_prefix'] == prefix
+    assert params['search_contains'] == contains
+    # The term only ever reaches the database as a parameter
+    assert search not in condition
+    render(condition, params)
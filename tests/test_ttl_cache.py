@@ -0,0 +1,111 @@
+"""TTLCache: expiry, the LRU bound, namespaces and concurrent use."""
+import threading
+import types
+
+import pytest
+
+import cache
+from cache import TTLCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache, 'time', types.SimpleNamespace(monotonic=lambda: now[0]))
+    return now
+
+
+def test_entries_expire_after_their_ttl(clock):
+    ttl_cache = TTLCache(default_ttl=10)
+    ttl_cache.set(('a', 1), 'default ttl')
+    ttl_cache.set(('a', 2), 'own ttl', ttl=30)
+    clock[0] += 9.999
+    assert ttl_cache.get(('a', 1)) == 'default ttl'
+    clock[0] += 0.001
+    assert ttl_cache.get(('a', 1)) is None
+    assert ttl_cache.peek(('a', 2)) == 'own ttl'
+    clock[0] += 20
+    assert ttl_cache.peek(('a', 2)) is None
+    assert ttl_cache.get(('a', 2), 'gone') == 'gone'
+    stats = ttl_cache.stats()
+    assert (stats['hits'], stats['misses'], stats['expirations'], stats['size']) == (1, 2, 2, 0)
+
+
+def test_setting_a_key_again_renews_its_ttl(clock):
+    ttl_cache = TTLCache(default_ttl=10)
+    ttl_cache.set(('a', 1), 'old')
+    clock[0] += 8
+    ttl_cache.set(('a', 1), 'new')
+    clock[0] += 8
+    assert ttl_cache.get(('a', 1)) == 'new'
+
+
+def test_least_recently_used_entry_is_evicted():
+    ttl_cache = TTLCache(maxsize=3)
+    for n in range(3):
+        ttl_cache.set(('a', n), n)
+    assert ttl_cache.get(('a', 0)) == 0  # now the most recently used
+    assert ttl_cache.peek(('a', 1)) == 1  # peek does not count as a use
+    ttl_cache.set(('a', 3), 3)
+    assert ttl_cache.get(('a', 1)) is None
+    assert [ttl_cache.get(('a', n)) for n in (0, 2, 3)] == [0, 2, 3]
+    assert ttl_cache.stats()['evictions'] == 1
+    assert ttl_cache.stats()['size'] == 3
+
+
+def test_get_or_load_calls_the_loader_only_on_a_miss():
+    ttl_cache = TTLCache()
+    calls = []
+    load = lambda: calls.append(1) or 'loaded'
+    assert ttl_cache.get_or_load(('a', 1), load) == 'loaded'
+    assert ttl_cache.get_or_load(('a', 1), load) == 'loaded'
+    assert len(calls) == 1
+    # A cached None is still a hit
+    ttl_cache.set(('a', 2), None)
+    assert ttl_cache.get_or_load(('a', 2), load) is None
+    assert len(calls) == 1
+
+
+def test_invalidation_by_key_and_namespace():
+    ttl_cache = TTLCache()
+    for key in [('patient', 1), ('patient', 2), ('filters',)]:
+        ttl_cache.set(key, key)
+    ttl_cache.invalidate(('patient', 1))
+    ttl_cache.invalidate(('patient', 99))
+    assert ttl_cache.peek(('patient', 1)) is None
+    ttl_cache.invalidate_namespace('patient')
+    assert ttl_cache.peek(('patient', 2)) is None
+    assert ttl_cache.peek(('filters',)) == ('filters',)
+    assert ttl_cache.stats()['invalidations'] == 2
+
+
+def test_concurrent_use_keeps_the_bound_and_the_counts():
+    ttl_cache = TTLCache(maxsize=50)
+    threads, rounds = 8, 2000
+    barrier = threading.Barrier(threads)
+    errors = []
+
+    def hammer(worker):
+        barrier.wait()
+        try:
+            for n in range(rounds):
+                key = ('k', worker, n % 15)  # 120 keys in all, each used by one thread
+                if ttl_cache.get(key) is None:
+                    ttl_cache.set(key, key)
+                if n % 50 == 0:
+                    ttl_cache.invalidate_namespace('other')
+        except Exception as e:
+            errors.append(e)
+
+    workers = [threading.Thread(target=hammer, args=(number,)) for number in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    assert not errors
+    stats = ttl_cache.stats()
+    assert stats['size'] <= 50
+    assert stats['hits'] + stats['misses'] == threads * rounds
+    # Every miss stored a value: whatever is not cached any more was evicted
+    assert stats['misses'] - stats['evictions'] == stats['size']